@@ -64,7 +64,7 @@ ROOT_URLCONF = 'astor.urls'
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
-        'DIRS': [(os.path.join(BASE_DIR, 'media')),],
+        'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
@@ -215,5 +215,51 @@ MESSAGE_TAGS = {
     messages.ERROR: "danger"
 }
 
+# Publish pages with the worker (manage.py run_publisher) instead of
+# the request thread.
+PUBLISH_IN_BACKGROUND = False
+
+# Buffer page visits in memory and insert them in batches from a background
+# thread instead of the request thread.
+BUFFER_PAGE_VISITS = False
+
+# Directory of archived page visits (manage.py archive_visits).
+VISITS_ARCHIVE_DIR = os.path.join(BASE_DIR, 'archive')
+
+# Rendered comments and analyses (see below) are cached with versions
+# stored in the database, so every process sees their invalidations. The
+# default local memory cache is separate in every process, so entries are
+# kept shorter there than in a shared cache (e.g. memcached).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+SHARED_CACHE = not CACHES['default']['BACKEND'].endswith(
+    ('LocMemCache', 'DummyCache')
+)
+
+# Number of seconds rendered comments of analyses are cached for (cached
+# comments are invalidated by changes of comments anyway, 0 disables the
+# cache).
+COMMENTS_CACHE_TIMEOUT = 60 * 60 * 24 if SHARED_CACHE else 60 * 5
+
+# Number of seconds rendered published analyses are cached for (0 disables
+# the cache). Cached responses are invalidated by publishing and comments.
+ANALYSIS_CACHE_TIMEOUT = 60 * 60 * 24 if SHARED_CACHE else 60 * 5
+
+# Header handing transfers of uploaded files over to the web server:
+# "X-Sendfile" (Apache, lighttpd) or "X-Accel-Redirect" (nginx, files are
+# then requested from SENDFILE_URL, an internal location of MEDIA_ROOT).
+# None serves files from Django.
+SENDFILE_HEADER = None
+SENDFILE_URL = '/protected/media/'
+
+# Lists of tags, analyses, comments and replies are paginated with cursors
+# (see astorcore.pagination). Default and max number of objects per page
+# (?page_size=...).
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 200
+
 TAGGIT_FORCE_LOWERCASE = True
 TAGGIT_STOPWORDS = [u'a', u'an', u'and', u'be', u'from', u'of']
\ No newline at end of file
@@ -9,11 +9,29 @@ from astorcore.models import (
 from astorcore.decorators import register_form
 
 
+class ScheduleFormMixin(object):
+    '''
+    Writes scheduling of the page only when it has been changed in the form
+    (saves of pages never write it, see Page.SCHEDULE_FIELDS).
+    '''
+
+    def save(self, commit=True):
+        adding = self.instance._state.adding
+        page = super(ScheduleFormMixin, self).save(commit=commit)
+        if commit and not adding:
+            page.save_schedule([
+                field for field in ("publish_at", "unpublish_at")
+                if field in self.changed_data
+            ])
+        return page
+
+
 @register_form
-class ContentPageForm(ModelForm):
+class ContentPageForm(ScheduleFormMixin, ModelForm):
     class Meta:
         model = ContentPage
-        fields =[ "title", "abstract", "img_url", "body", "tags", "img_url"]
+        fields =[ "title", "abstract", "img_url", "body", "tags", "img_url",
+                  "publish_at", "unpublish_at"]
         widgets = {
             "title": TextInput(attrs={"placeholder": "Enter a title."}),
             "body": CKEditorWidget(),
@@ -28,7 +46,8 @@ class ContentPageForm(ModelForm):
 
 
 @register_form
-class HTMLUploadPageForm(ModelForm):
+class HTMLUploadPageForm(ScheduleFormMixin, ModelForm):
     class Meta:
         model = HTMLUploadPage
-        fields = ["title", "abstract", "img_url", "file"]
\ No newline at end of file
+        fields = ["title", "abstract", "img_url", "file", "publish_at", 
+                  "unpublish_at"]
\ No newline at end of file
@@ -24,6 +24,7 @@ class Activity(models.Model):
     UPDATE_PAGE = 21
     PUBLISH_PAGE = 22
     DELETE_PAGE = 23
+    UNPUBLISH_PAGE = 24
 
 
 class User(AbstractUser):
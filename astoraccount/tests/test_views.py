@@ -6,7 +6,7 @@ import operator
 from unittest.mock import Mock, patch
 from functools import partial
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import resolve, reverse
 from django.contrib.auth import get_user_model, get_user
 from django.contrib.contenttypes.models import ContentType
@@ -168,6 +168,18 @@ class PageEditTest(AstorTestCase):
         page.refresh_from_db()
         self.assertIsNotNone(page.published_page)
 
+    @override_settings(PUBLISH_IN_BACKGROUND=True)
+    def test_for_scheduling_publishing_in_background(self):
+        user = self.create_and_login_user()
+        page = user.add_page(instance=ContentPage())
+        self.client.post(reverse("astoraccount:page_edit", 
+                                 kwargs={"pk": page.pk}),
+                        {"title": "First Edit Ever", "abstract": "Simple Page",
+                         "body": "Nice body", "action_type": "publish"})       
+        self.assertEqual(Page.objects.count(), 1)
+        page.refresh_from_db()
+        self.assertIsNotNone(page.publish_at)
+
     def test_use_tags_names_when_populating_form(self):
         user = self.create_and_login_user()
         page = user.add_page(instance=ContentPage(title="It's time!!!"))
@@ -16,7 +16,7 @@ from django.conf import settings
 from taggit.utils import edit_string_for_tags
 
 from astorcore.models import Page
-from astorcore.decorators import get_page_models, get_forms
+from astorcore.decorators import get_page_models, get_form
 from astoraccount.models import Activity
 from astoraccount.forms import ContentPageForm
 
@@ -27,7 +27,7 @@ class AccountIndexView(LoginRequiredMixin, TemplateView):
     def get_context_data(self, *args, **kwargs):
         context = super(AccountIndexView, self).get_context_data(*args, **kwargs)
         # Find recent edits, but do not show published pages.
-        recent_edits = [page.specific for page in self.request.user.pages.all()]
+        recent_edits = list(self.request.user.pages.all().specific())
         context["recent_edits"] = recent_edits
         return context
 
@@ -38,7 +38,9 @@ class AnalysesView(LoginRequiredMixin, TemplateView):
     def get_context_data(self, *args, **kwargs):
         page = self.request.GET.get("page", 1)
 
-        paginator = Paginator(self.request.user.pages.filter(editable=True), 10)
+        paginator = Paginator(
+            self.request.user.pages.filter(editable=True).specific(), 10
+        )
         try:
             analyses = paginator.page(page)
         except PageNotAnInteger:
@@ -46,9 +48,6 @@ class AnalysesView(LoginRequiredMixin, TemplateView):
         except EmptyPage:
             analyses = paginator.page(paginator.num_pages)
 
-        # Get the most specific type of page.
-        analyses.object_list = [analysis.specific for analysis in analyses]
-
         context = super(AnalysesView, self).get_context_data(*args, **kwargs)
         context["analyses"] = analyses
 
@@ -96,22 +95,18 @@ class CreatePageView(LoginRequiredMixin, View):
 @login_required
 def page_edit(request, pk):
     try:
-        page = Page.objects.get(pk=pk)
+        page = Page.objects.get(pk=pk).specific
     except Page.DoesNotExist:
         return redirect(reverse("astoraccount:404"))
 
     # Find the proper form for the page.
-    form_cls = None
-    for form in get_forms():
-        if type(page.specific) == form._meta.model:
-            form_cls = form
-            break
+    form_cls = get_form(type(page))
 
     form = None
     form_data = dict(
-        instance=page.specific,
+        instance=page,
         initial={
-            "tags": edit_string_for_tags(page.specific.tags.all()).replace('"', '')
+            "tags": edit_string_for_tags(page.tags.all()).replace('"', '')
         }
     )
 
@@ -133,6 +128,14 @@ def page_edit(request, pk):
                 messages.success(
                     request, _("The draft has been saved."), fail_silently=True
                 )
+            elif getattr(settings, "PUBLISH_IN_BACKGROUND", False):
+                # Leave publishing to the worker (manage.py run_publisher).
+                page.schedule_publish()
+                messages.success(
+                    request, 
+                    _("The analysis has been saved and will be published."), 
+                    fail_silently=True
+                )
             else:
                 pub_page = page.publish()
                 messages.success(
@@ -0,0 +1,285 @@
+import gzip
+import json
+import os
+from collections import defaultdict
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from astorcore.models import (
+    Page, PageVisit, HourlyVisitRollup, DailyVisitRollup
+)
+from astorcore.utils import (
+    HyperLogLog, bulk_insert_ignore, pack_ip, unpack_ip
+)
+
+
+# Number of visits rolled up within a single transaction.
+ROLLUP_BATCH_SIZE = 500
+
+# Raw visits older than this are deleted by compact_visits by default.
+VISITS_RETENTION_DAYS = 90
+
+# Number of visits archived (and deleted) or restored at once.
+ARCHIVE_BATCH_SIZE = 500
+
+# Columns of exported visits and rollups (see export_visits).
+VISIT_EXPORT_FIELDS = ("id", "page", "timestamp", "user", "ip_address",
+                       "user_agent", "request_method")
+ROLLUP_EXPORT_FIELDS = ("page", "bucket", "visits", "unique_visitors",
+                        "authenticated_visits")
+
+ROLLUP_MODELS = {
+    "hour": HourlyVisitRollup,
+    "day": DailyVisitRollup
+}
+
+
+def rollup_visits(batch_size=ROLLUP_BATCH_SIZE):
+    '''
+    Adds visits which have not been rolled up yet to hourly and daily
+    rollups, batch by batch. Returns number of rolled up visits.
+    '''
+    count = 0
+    while True:
+        with transaction.atomic():
+            visits = list(PageVisit.objects.select_for_update().filter(
+                rolled_up=False
+            ).order_by("pk").values_list(
+                "pk", "page_id", "timestamp", "ip", "agent_id", "user_id"
+            )[:batch_size])
+            if not visits:
+                break
+            for model in ROLLUP_MODELS.values():
+                _update_rollups(model, visits)
+            PageVisit.objects.filter(
+                pk__in=[ visit[0] for visit in visits ]
+            ).update(rolled_up=True)
+        count += len(visits)
+        if len(visits) < batch_size:
+            break
+    return count
+
+
+class _RollupStats(object):
+
+    def __init__(self):
+        self.visits = 0
+        self.authenticated_visits = 0
+        self.sketch = HyperLogLog()
+
+
+def _update_rollups(model, visits):
+    stats = defaultdict(_RollupStats)
+    for pk, page_id, timestamp, ip, agent_id, user_id in visits:
+        row = stats[(page_id, model.get_bucket(timestamp))]
+        row.visits += 1
+        row.authenticated_visits += user_id is not None
+        key = PageVisit.get_visitor_key(ip, agent_id, user_id)
+        if key is not None:
+            row.sketch.add(key)
+
+    buckets = [ bucket for _, bucket in stats ]
+    existing = model.objects.select_for_update().filter(
+        page__in={ page_id for page_id, _ in stats },
+        bucket__gte=min(buckets), bucket__lte=max(buckets)
+    ).values_list("pk", "page_id", "bucket", "sketch")
+
+    for pk, page_id, bucket, sketch in existing:
+        row = stats.pop((page_id, bucket), None)
+        if row is None:
+            continue
+        row.sketch.merge(HyperLogLog.from_bytes(sketch))
+        model.objects.filter(pk=pk).update(
+            visits=F("visits") + row.visits,
+            authenticated_visits=(
+                F("authenticated_visits") + row.authenticated_visits
+            ),
+            # Rollups made before sketches existed may have empty sketches,
+            # so their original counts are kept as the lower bound.
+            unique_visitors=Greatest(
+                F("unique_visitors"), Value(row.sketch.count())
+            ),
+            sketch=row.sketch.to_bytes()
+        )
+
+    model.objects.bulk_create([
+        model(page_id=page_id, bucket=bucket, visits=row.visits, 
+              authenticated_visits=row.authenticated_visits,
+              unique_visitors=row.sketch.count(), 
+              sketch=row.sketch.to_bytes())
+        for (page_id, bucket), row in stats.items()
+    ])
+
+
+def compact_visits(days=VISITS_RETENTION_DAYS, now=None):
+    '''
+    Rolls up all pending visits and deletes raw visits older than the given
+    number of days. Returns number of deleted visits.
+    '''
+    if days < 1:
+        raise ValueError("Raw visits have to be kept at least one day.")
+    rollup_visits()
+    cutoff = (now or timezone.now()) - timedelta(days=days)
+    deleted, _ = PageVisit.objects.filter(
+        rolled_up=True, timestamp__lt=cutoff
+    ).delete()
+    return deleted
+
+
+def get_visit_stats(pages, period="day", start=None, end=None):
+    '''
+    Returns rollups (of the period: "hour" or "day") of the pages ordered by
+    bucket. Reads only the rollups, so visits which have not been rolled up
+    yet are not included.
+    '''
+    rollups = ROLLUP_MODELS[period].objects.filter(page__in=pages)
+    if start is not None:
+        rollups = rollups.filter(bucket__gte=start)
+    if end is not None:
+        rollups = rollups.filter(bucket__lt=end)
+    return rollups.order_by("bucket", "page")
+
+
+def archive_visits(directory, cutoff, batch_size=ARCHIVE_BATCH_SIZE):
+    '''
+    Moves visits older than cutoff to gzip-compressed JSONL files (one per
+    month: visits-YYYY-MM.jsonl.gz) in the directory. Visits are rolled up
+    first and then archived in chunks ordered by pk. Every chunk is written
+    before it is deleted, so the archiving can be resumed after interruption
+    (the archive may end up with duplicated lines, which are skipped by
+    restore_visits). Returns number of archived visits.
+    '''
+    rollup_visits()
+    os.makedirs(directory, exist_ok=True)
+
+    count, last_pk = 0, 0
+    while True:
+        visits = PageVisit.objects.filter(
+            rolled_up=True, timestamp__lt=cutoff, pk__gt=last_pk
+        ).order_by("pk").values_list(
+            "pk", "page_id", "user_id", "timestamp", "ip", "agent__value",
+            "method", "rolled_up"
+        )[:batch_size]
+
+        lines, pks = defaultdict(list), list()
+        for (pk, page_id, user_id, timestamp, ip, user_agent, method, 
+             rolled_up) in visits.iterator():
+            month = DailyVisitRollup.get_bucket(timestamp).strftime("%Y-%m")
+            lines[month].append(json.dumps(dict(
+                id=pk, page=page_id, user=user_id, timestamp=timestamp,
+                ip_address=unpack_ip(ip), user_agent=user_agent,
+                request_method=(
+                    PageVisit.METHODS[method] if method is not None else None
+                ),
+                rolled_up=rolled_up
+            ), cls=DjangoJSONEncoder) + "\n")
+            pks.append(pk)
+
+        # Every chunk is appended as a complete gzip member and synced to
+        # disk before the visits are deleted.
+        for month, month_lines in lines.items():
+            path = os.path.join(directory, "visits-%s.jsonl.gz" % month)
+            with open(path, "ab") as archive:
+                archive.write(gzip.compress("".join(month_lines).encode()))
+                archive.flush()
+                os.fsync(archive.fileno())
+
+        if not pks:
+            break
+        PageVisit.objects.filter(pk__in=pks).delete()
+        count += len(pks)
+        last_pk = pks[-1]
+    return count
+
+
+def read_archive(path):
+    '''Yields visits (dicts) stored in the archive file.'''
+    with gzip.open(path, "rt") as archive:
+        for line in archive:
+            if line.strip():
+                yield json.loads(line)
+
+
+def restore_visits(paths, batch_size=ARCHIVE_BATCH_SIZE):
+    '''
+    Inserts visits from archive files (see archive_visits) back into the
+    database, skipping visits which already exist or belong to deleted
+    pages. Returns number of restored visits.
+    '''
+    count = 0
+    for path in paths:
+        batch = list()
+        for record in read_archive(path):
+            batch.append(record)
+            if len(batch) >= batch_size:
+                count += _restore_batch(batch)
+                batch = list()
+        if batch:
+            count += _restore_batch(batch)
+    return count
+
+
+def _restore_batch(records):
+    page_ids = set(Page.objects.filter(
+        pk__in={ record["page"] for record in records }
+    ).values_list("pk", flat=True))
+    user_ids = set(get_user_model().objects.filter(
+        pk__in={ record["user"] for record in records if record["user"] }
+    ).values_list("pk", flat=True))
+
+    visits = list()
+    for record in records:
+        if record["page"] not in page_ids:
+            continue
+        visit = PageVisit(
+            pk=record["id"], page_id=record["page"],
+            user_id=record["user"] if record["user"] in user_ids else None,
+            timestamp=record["timestamp"], ip=pack_ip(record["ip_address"]),
+            rolled_up=record["rolled_up"]
+        )
+        visit.user_agent = record["user_agent"]
+        visit.request_method = record["request_method"]
+        visits.append(visit)
+
+    if not visits:
+        return 0
+    with transaction.atomic():
+        PageVisit.resolve_agents(visits)
+        return bulk_insert_ignore(PageVisit, visits)
+
+
+def export_visits(pages, bucket=None, start=None, end=None):
+    '''
+    Returns names of columns and iterator over rows (tuples) of visits of
+    the pages or of their rollups when bucket ("hour" or "day") is given.
+    Rows are fetched from the database chunk by chunk.
+    '''
+    if bucket is not None:
+        rollups = get_visit_stats(pages, bucket, start, end).values_list(
+            *ROLLUP_EXPORT_FIELDS
+        )
+        return ROLLUP_EXPORT_FIELDS, rollups.iterator()
+
+    visits = PageVisit.objects.filter(page__in=pages)
+    if start is not None:
+        visits = visits.filter(timestamp__gte=start)
+    if end is not None:
+        visits = visits.filter(timestamp__lt=end)
+    visits = visits.order_by("timestamp", "pk").values_list(
+        "pk", "page_id", "timestamp", "user_id", "ip", "agent__value", 
+        "method"
+    )
+
+    def rows():
+        for pk, page_id, timestamp, user_id, ip, user_agent, method in \
+                visits.iterator():
+            yield (pk, page_id, timestamp, user_id, unpack_ip(ip), user_agent,
+                   PageVisit.METHODS[method] if method is not None else None)
+
+    return VISIT_EXPORT_FIELDS, rows()
@@ -1,5 +1,33 @@
 from django.apps import AppConfig
+from django.utils.module_loading import autodiscover_modules
+from django.db.models.signals import post_migrate, post_delete
 
 
 class AstorcoreConfig(AppConfig):
     name = 'astorcore'
+
+    def ready(self):
+        from astorcore.models import (
+            page_types, Page, Comment, UserAgent, decrement_comment_counters,
+            invalidate_comments_cache, delete_artifacts
+        )
+        from astorcore.decorators import freeze_registries
+
+        # Forms and serializers of pages are registered on import.
+        autodiscover_modules("forms", "serializers")
+        freeze_registries()
+
+        # Content types of pages are loaded before the first request and
+        # again after migrations, which can recreate them with new ids.
+        page_types.warm()
+        post_migrate.connect(page_types.warm, 
+                             dispatch_uid="astorcore_warm_page_types")
+        # Cached ids of user agents refer to rows removed by flush.
+        post_migrate.connect(UserAgent.cache.clear,
+                             dispatch_uid="astorcore_clear_user_agents")
+        post_delete.connect(decrement_comment_counters, sender=Comment,
+                            dispatch_uid="astorcore_comment_counters")
+        post_delete.connect(invalidate_comments_cache, sender=Comment,
+                            dispatch_uid="astorcore_comments_cache")
+        post_delete.connect(delete_artifacts, sender=Page,
+                            dispatch_uid="astorcore_page_artifacts")
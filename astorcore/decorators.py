@@ -1,15 +1,30 @@
 __all__ = ["register_page", "register_form", "register_serializer",
-           "get_page_models", "get_forms", "get_serializers"]
+           "get_page_models", "get_forms", "get_serializers",
+           "get_page_model", "get_form", "get_serializer",
+           "freeze_registries"]
 
 
 PAGE_REGISTRY = list()
 FORM_REGISTRY = list()
 SERIALIZER_REGISTRY = list()
 
-def create_register_decorator(register):
+# Indexes of registries: model -> registered class
+FORM_INDEX = dict()
+SERIALIZER_INDEX = dict()
+
+# Registries are frozen after loading of apps (see AstorcoreConfig.ready)
+_frozen = False
+
+def create_register_decorator(register, index=None, get_model=None):
     def registrator(cls):
+        if _frozen:
+            raise RuntimeError(
+                "Cannot register '%s' after loading of apps." % cls.__name__
+            )
         if cls not in register:
             register.append(cls)
+            if index is not None:
+                index.setdefault(get_model(cls), cls)
         return cls
     return registrator
 
@@ -18,11 +33,34 @@ def create_register_getter(register):
         return register
     return getter
 
+def create_index_getter(index):
+    def getter(model):
+        return index.get(model)
+    return getter
+
 
 register_page = create_register_decorator(PAGE_REGISTRY)
-register_form = create_register_decorator(FORM_REGISTRY)
-register_serializer = create_register_decorator(SERIALIZER_REGISTRY)
+register_form = create_register_decorator(
+    FORM_REGISTRY, FORM_INDEX, lambda form: form._meta.model
+)
+register_serializer = create_register_decorator(
+    SERIALIZER_REGISTRY, SERIALIZER_INDEX,
+    lambda serializer: serializer.Meta.model
+)
 
 get_page_models = create_register_getter(PAGE_REGISTRY)
 get_forms = create_register_getter(FORM_REGISTRY)
-get_serializers = create_register_getter(SERIALIZER_REGISTRY)
\ No newline at end of file
+get_serializers = create_register_getter(SERIALIZER_REGISTRY)
+
+get_form = create_index_getter(FORM_INDEX)
+get_serializer = create_index_getter(SERIALIZER_INDEX)
+
+def get_page_model(content_type_id):
+    '''Returns page model for the content type id.'''
+    from astorcore.models import page_types
+    return page_types.get_model(content_type_id)
+
+def freeze_registries():
+    '''Forbids further registrations (registries are read without locks).'''
+    global _frozen
+    _frozen = True
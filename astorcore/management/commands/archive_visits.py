@@ -0,0 +1,44 @@
+import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from astorcore.analytics import archive_visits, ARCHIVE_BATCH_SIZE
+
+
+UNITS = { "h": "hours", "d": "days", "w": "weeks" }
+
+
+def parse_age(value):
+    '''Parses age like 12h, 90d or 4w to timedelta.'''
+    match = re.match(r"^(\d+)([hdw])$", value)
+    if not match:
+        raise CommandError(
+            "Invalid age '%s' (expected e.g. 12h, 90d or 4w)." % value
+        )
+    return timedelta(**{ UNITS[match.group(2)]: int(match.group(1)) })
+
+
+class Command(BaseCommand):
+    help = "Moves old page visits to gzip-compressed JSONL files."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than", dest="older_than", default="90d",
+                            help="age of archived visits (e.g. 90d)")
+        parser.add_argument("--directory", dest="directory",
+                            default=settings.VISITS_ARCHIVE_DIR,
+                            help="directory of archive files")
+        parser.add_argument("--batch-size", type=int, dest="batch_size",
+                            default=ARCHIVE_BATCH_SIZE,
+                            help="number of visits per chunk")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - parse_age(options["older_than"])
+        count = archive_visits(
+            options["directory"], cutoff, batch_size=options["batch_size"]
+        )
+        self.stdout.write("Archived %d visit(s) to %s." % (
+            count, options["directory"]
+        ))
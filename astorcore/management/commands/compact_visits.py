@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from astorcore.analytics import compact_visits, VISITS_RETENTION_DAYS
+
+
+class Command(BaseCommand):
+    help = "Rolls up page visits and deletes raw visits older than N days."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, dest="days",
+                            default=VISITS_RETENTION_DAYS,
+                            help="number of days of raw visits to keep")
+
+    def handle(self, *args, **options):
+        try:
+            deleted = compact_visits(days=options["days"])
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write("Deleted %d raw visit(s)." % deleted)
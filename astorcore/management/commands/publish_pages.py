@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from astorcore.models import Page
+from astorcore.publishing import (
+    bulk_publish, bulk_unpublish, PUBLISH_CHUNK_SIZE
+)
+
+
+class Command(BaseCommand):
+    help = "Publishes (or unpublishes) drafts of pages in chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument("ids", nargs="*", type=int, 
+                            help="ids of drafts to publish")
+        parser.add_argument("--all", action="store_true", dest="all",
+                            help="publish all drafts")
+        parser.add_argument("--user", dest="user", 
+                            help="publish drafts of the user (slug)")
+        parser.add_argument("--unpublish", action="store_true", 
+                            dest="unpublish", help="unpublish drafts")
+        parser.add_argument("--chunk-size", type=int, dest="chunk_size",
+                            default=PUBLISH_CHUNK_SIZE,
+                            help="number of pages per transaction")
+
+    def handle(self, *args, **options):
+        if not (options["ids"] or options["all"] or options["user"]):
+            raise CommandError("Provide ids of pages, --user or --all.")
+
+        pages = Page.objects.filter(editable=True).order_by("pk")
+        if options["ids"]:
+            pages = pages.filter(pk__in=options["ids"])
+        if options["user"]:
+            pages = pages.filter(user__slug=options["user"])
+
+        if options["unpublish"]:
+            pages = pages.filter(published_page__isnull=False)
+            count = pages.count()
+            bulk_unpublish(pages, chunk_size=options["chunk_size"])
+            self.stdout.write("Unpublished %d page(s)." % count)
+        else:
+            published = bulk_publish(pages, chunk_size=options["chunk_size"])
+            self.stdout.write("Published %d page(s)." % len(published))
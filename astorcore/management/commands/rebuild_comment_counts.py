@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from astorcore.models import Page, Comment
+from astorcore.utils import set_counters
+
+
+class Command(BaseCommand):
+    help = "Recomputes counters of comments of pages and replies."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", dest="dry_run",
+                            help="only report wrong counters")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            comments = dict(Comment.objects.filter(
+                page__isnull=False
+            ).values_list("page").annotate(Count("pk")))
+            replies = dict(Comment.objects.filter(
+                parent__isnull=False
+            ).values_list("parent").annotate(Count("pk")))
+
+            fixed_pages = set_counters(
+                Page, "comments_count", comments, dry_run=options["dry_run"]
+            )
+            fixed_comments = set_counters(
+                Comment, "replies_count", replies, dry_run=options["dry_run"]
+            )
+
+        self.stdout.write(
+            "Found %d page(s) and %d comment(s) with wrong counters%s." % (
+                fixed_pages, fixed_comments, 
+                "" if options["dry_run"] else " (fixed)"
+            )
+        )
@@ -0,0 +1,37 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from astorcore.models import Page, PageVisit, DailyVisitRollup
+from astorcore.utils import set_counters
+
+
+class Command(BaseCommand):
+    help = "Recomputes visits counters of pages from visits and rollups."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", dest="dry_run",
+                            help="only report pages with wrong counters")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            # Visits deleted by compaction are counted only in rollups.
+            counts = defaultdict(int, 
+                DailyVisitRollup.objects.values_list("page").annotate(
+                    Sum("visits")
+                )
+            )
+            for pk, count in PageVisit.objects.filter(
+                    rolled_up=False).values_list("page").annotate(
+                    Count("pk")):
+                counts[pk] += count
+
+            fixed = set_counters(
+                Page, "visits_count", counts, dry_run=options["dry_run"]
+            )
+
+        self.stdout.write("Found %d page(s) with wrong visits counters%s." % (
+            fixed, "" if options["dry_run"] else " (fixed)"
+        ))
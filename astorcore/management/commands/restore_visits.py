@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from astorcore.analytics import restore_visits, ARCHIVE_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Restores page visits from archive files (see archive_visits)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", help="archive files")
+        parser.add_argument("--batch-size", type=int, dest="batch_size",
+                            default=ARCHIVE_BATCH_SIZE,
+                            help="number of visits per transaction")
+
+    def handle(self, *args, **options):
+        try:
+            count = restore_visits(
+                options["paths"], batch_size=options["batch_size"]
+            )
+        except (IOError, OSError) as e:
+            raise CommandError(str(e))
+        self.stdout.write("Restored %d visit(s)." % count)
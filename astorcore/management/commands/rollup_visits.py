@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from astorcore.analytics import rollup_visits, ROLLUP_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Adds new page visits to hourly and daily rollups."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, dest="batch_size",
+                            default=ROLLUP_BATCH_SIZE,
+                            help="number of visits per transaction")
+
+    def handle(self, *args, **options):
+        count = rollup_visits(batch_size=options["batch_size"])
+        self.stdout.write("Rolled up %d visit(s)." % count)
@@ -0,0 +1,45 @@
+import os
+import signal
+import socket
+import time
+
+from django.core.management.base import BaseCommand
+
+from astorcore.publishing import process_due_pages, PUBLISH_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = "Runs worker which publishes and unpublishes scheduled pages."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, dest="interval",
+                            default=10.0, 
+                            help="seconds between polls when idle")
+        parser.add_argument("--batch-size", type=int, dest="batch_size",
+                            default=PUBLISH_CHUNK_SIZE,
+                            help="number of pages claimed at once")
+        parser.add_argument("--once", action="store_true", dest="once",
+                            help="process due pages and exit")
+
+    def handle(self, *args, **options):
+        worker = "%s:%d" % (socket.gethostname(), os.getpid())
+        self.running = True
+        if not options["once"]:
+            signal.signal(signal.SIGTERM, self.stop)
+
+        try:
+            while self.running:
+                count = process_due_pages(worker, options["batch_size"])
+                if count:
+                    self.stdout.write("Processed %d page(s)." % count)
+                if options["once"]:
+                    break
+                # Drain full batches without waiting.
+                if count < options["batch_size"]:
+                    time.sleep(options["interval"])
+        except KeyboardInterrupt:
+            pass
+
+    def stop(self, signum, frame):
+        '''Finishes the current batch and exits.'''
+        self.running = False
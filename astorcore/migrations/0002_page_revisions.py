@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 18:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('astorcore', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PageRevision',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField(default=0, editable=False)),
+                ('created_date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('content', models.BinaryField()),
+                ('base', models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='astorcore.PageRevision')),
+                ('page', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='revisions', to='astorcore.Page')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='page',
+            name='live_revision',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='astorcore.PageRevision'),
+        ),
+    ]
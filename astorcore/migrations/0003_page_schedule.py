@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 18:36
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('astorcore', '0002_page_revisions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='page',
+            name='publish_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='page',
+            name='schedule_claimed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='page',
+            name='schedule_claimed_by',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='page',
+            name='unpublish_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
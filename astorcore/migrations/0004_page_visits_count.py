@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 18:39
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_visits_count(apps, schema_editor):
+    Page = apps.get_model("astorcore", "Page")
+    PageVisit = apps.get_model("astorcore", "PageVisit")
+    counts = PageVisit.objects.values_list("page").annotate(Count("pk"))
+    for page_id, count in counts:
+        Page.objects.filter(pk=page_id).update(visits_count=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('astorcore', '0003_page_schedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='page',
+            name='visits_count',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.RunPython(fill_visits_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 18:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('astorcore', '0004_page_visits_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyVisitRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('visits', models.PositiveIntegerField(default=0)),
+                ('unique_ips', models.PositiveIntegerField(default=0)),
+                ('authenticated_visits', models.PositiveIntegerField(default=0)),
+                ('page', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_visits', to='astorcore.Page')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='HourlyVisitRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('visits', models.PositiveIntegerField(default=0)),
+                ('unique_ips', models.PositiveIntegerField(default=0)),
+                ('authenticated_visits', models.PositiveIntegerField(default=0)),
+                ('page', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hourly_visits', to='astorcore.Page')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AddField(
+            model_name='pagevisit',
+            name='rolled_up',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AlterIndexTogether(
+            name='pagevisit',
+            index_together=set([('rolled_up', 'timestamp')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='hourlyvisitrollup',
+            unique_together=set([('page', 'bucket')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailyvisitrollup',
+            unique_together=set([('page', 'bucket')]),
+        ),
+    ]
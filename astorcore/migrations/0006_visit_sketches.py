@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 18:43
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('astorcore', '0005_visit_rollups'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='dailyvisitrollup',
+            old_name='unique_ips',
+            new_name='unique_visitors',
+        ),
+        migrations.RenameField(
+            model_name='hourlyvisitrollup',
+            old_name='unique_ips',
+            new_name='unique_visitors',
+        ),
+        migrations.AddField(
+            model_name='dailyvisitrollup',
+            name='sketch',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.AddField(
+            model_name='hourlyvisitrollup',
+            name='sketch',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.AlterUniqueTogether(
+            name='pagevisit',
+            unique_together=set([]),
+        ),
+    ]
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 18:45
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+import hashlib
+import ipaddress
+
+
+METHODS = ("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS")
+
+
+def compact_visits(apps, schema_editor):
+    PageVisit = apps.get_model("astorcore", "PageVisit")
+    UserAgent = apps.get_model("astorcore", "UserAgent")
+    agents = dict()
+    for visit in PageVisit.objects.iterator():
+        if visit.ip_address:
+            try:
+                visit.ip = ipaddress.ip_address(visit.ip_address).packed
+            except ValueError:
+                pass
+        if visit.user_agent:
+            if visit.user_agent not in agents:
+                agents[visit.user_agent] = UserAgent.objects.get_or_create(
+                    hash=hashlib.sha1(visit.user_agent.encode()).hexdigest(),
+                    defaults=dict(value=visit.user_agent)
+                )[0].pk
+            visit.agent_id = agents[visit.user_agent]
+        if visit.request_method in METHODS:
+            visit.method = METHODS.index(visit.request_method)
+        visit.save(update_fields=["ip", "agent", "method"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('astorcore', '0006_visit_sketches'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserAgent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.CharField(max_length=40, unique=True)),
+                ('value', models.TextField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='pagevisit',
+            name='ip',
+            field=models.BinaryField(blank=True, max_length=16, null=True),
+        ),
+        migrations.AddField(
+            model_name='pagevisit',
+            name='method',
+            field=models.PositiveSmallIntegerField(blank=True, choices=[(0, 'GET'), (1, 'HEAD'), (2, 'POST'), (3, 'PUT'), (4, 'PATCH'), (5, 'DELETE'), (6, 'OPTIONS')], null=True),
+        ),
+        migrations.AddField(
+            model_name='pagevisit',
+            name='agent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='astorcore.UserAgent'),
+        ),
+        migrations.RunPython(compact_visits, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='pagevisit',
+            name='ip_address',
+        ),
+        migrations.RemoveField(
+            model_name='pagevisit',
+            name='request_method',
+        ),
+        migrations.RemoveField(
+            model_name='pagevisit',
+            name='user_agent',
+        ),
+    ]
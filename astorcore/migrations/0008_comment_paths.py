@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 18:49
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def encode_step(pk):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    step = ""
+    while pk:
+        pk, digit = divmod(pk, 36)
+        step = digits[digit] + step
+    return step.rjust(6, "0")
+
+
+def fill_comment_paths(apps, schema_editor):
+    Comment = apps.get_model("astorcore", "Comment")
+    # Parents are always created before their replies.
+    positions = dict()
+    for comment in Comment.objects.order_by("pk").iterator():
+        step = encode_step(comment.pk)
+        if comment.parent_id in positions:
+            path, depth, root_page_id = positions[comment.parent_id]
+            position = (path + step, depth + 1, root_page_id)
+        else:
+            position = (step, 0, comment.page_id)
+        positions[comment.pk] = position
+        Comment.objects.filter(pk=comment.pk).update(
+            path=position[0], depth=position[1], root_page=position[2]
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('astorcore', '0007_compact_visits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='root_page',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='astorcore.Page'),
+        ),
+        migrations.AlterIndexTogether(
+            name='comment',
+            index_together=set([('root_page', 'path')]),
+        ),
+        migrations.RunPython(fill_comment_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 18:52
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_comment_counts(apps, schema_editor):
+    Page = apps.get_model("astorcore", "Page")
+    Comment = apps.get_model("astorcore", "Comment")
+    for page_id, count in Comment.objects.filter(
+            page__isnull=False).values_list("page").annotate(Count("pk")):
+        Page.objects.filter(pk=page_id).update(comments_count=count)
+    for parent_id, count in Comment.objects.filter(
+            parent__isnull=False).values_list("parent").annotate(Count("pk")):
+        Comment.objects.filter(pk=parent_id).update(replies_count=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('astorcore', '0008_comment_paths'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='replies_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='page',
+            name='comments_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_comment_counts, migrations.RunPython.noop),
+    ]
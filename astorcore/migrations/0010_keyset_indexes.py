@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 18:54
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def set_latest_changes_date(apps, schema_editor):
+    # Keyset pagination of analyses requires the dates of all pages.
+    Page = apps.get_model("astorcore", "Page")
+    Page.objects.filter(latest_changes_date__isnull=True).update(
+        latest_changes_date=F("created_date")
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('astorcore', '0009_comment_counts'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='page',
+            name='latest_changes_date',
+            field=models.DateTimeField(db_index=True, editable=False, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='comment',
+            index_together=set([('parent', 'timestamp'), ('root_page', 'path'), ('page', 'timestamp')]),
+        ),
+        migrations.RunPython(set_latest_changes_date, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 19:26
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('astorcore', '0010_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='page',
+            name='comments_changed_date',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
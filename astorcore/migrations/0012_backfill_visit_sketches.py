@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.db import migrations
+from django.utils import timezone
+
+from astorcore.utils import HyperLogLog
+
+
+def get_visitor_key(ip, agent_id, user_id):
+    # Copy of PageVisit.get_visitor_key (historical models have no methods).
+    if user_id is not None:
+        return "user:%s" % user_id
+    if ip:
+        return "ip:%s|%s" % (bytes(ip).hex(), agent_id or "")
+    return None
+
+
+def backfill_sketches(apps, schema_editor):
+    '''
+    Rebuilds sketches of rollups created before 0006 from the rolled up raw
+    visits. Unique visitors are never decreased, so buckets whose raw visits
+    are gone keep their original counts.
+    '''
+    PageVisit = apps.get_model("astorcore", "PageVisit")
+    for name, fields in (("HourlyVisitRollup", ("minute",)),
+                         ("DailyVisitRollup", ("hour", "minute"))):
+        model = apps.get_model("astorcore", name)
+        replace = dict.fromkeys(fields + ("second", "microsecond"), 0)
+        rollups = [ rollup for rollup in model.objects.only(
+            "page_id", "bucket", "unique_visitors", "sketch"
+        ).iterator() if not rollup.sketch ]
+        if not rollups:
+            continue
+
+        sketches = defaultdict(HyperLogLog)
+        for page_id, timestamp, ip, agent_id, user_id in (
+                PageVisit.objects.filter(rolled_up=True).values_list(
+                    "page_id", "timestamp", "ip", "agent_id", "user_id"
+                ).iterator()):
+            key = get_visitor_key(ip, agent_id, user_id)
+            if key is not None:
+                bucket = timestamp.astimezone(timezone.utc).replace(**replace)
+                sketches[(page_id, bucket)].add(key)
+
+        for rollup in rollups:
+            sketch = sketches.get((rollup.page_id, rollup.bucket))
+            if sketch is None:
+                continue
+            model.objects.filter(pk=rollup.pk).update(
+                sketch=sketch.to_bytes(),
+                unique_visitors=max(rollup.unique_visitors, sketch.count())
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('astorcore', '0011_comments_changed_date'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_sketches, migrations.RunPython.noop),
+    ]
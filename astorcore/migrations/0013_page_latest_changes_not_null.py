@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-18 19:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F
+import django.utils.timezone
+
+
+def set_latest_changes_date(apps, schema_editor):
+    # Keyset pagination of analyses orders by the date, so it must be set.
+    Page = apps.get_model("astorcore", "Page")
+    Page.objects.filter(latest_changes_date__isnull=True).update(
+        latest_changes_date=F("created_date")
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('astorcore', '0012_backfill_visit_sketches'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_latest_changes_date, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='page',
+            name='latest_changes_date',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, editable=False),
+        ),
+    ]
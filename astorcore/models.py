@@ -1,22 +1,91 @@
+import hashlib
+import logging
+import os
+import shutil
+from collections import defaultdict
+
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Case, When, Value
+from django.db.models.functions import Concat, Substr
+from django.db.models.query import ModelIterable
 from django.conf import settings
 from django.utils import timezone
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey    
 from django.urls import reverse
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 from django.urls.exceptions import NoReverseMatch
 from django.core.exceptions import ValidationError
 
 from taggit.managers import TaggableManager
 
-from astorcore.decorators import register_page
-from astorcore.utils import clone_page, user_directory_path, get_client_ip
+from astorcore.decorators import register_page, get_page_models
+from astorcore.serving import precompress_file, write_artifact
+from astorcore.utils import (
+    clone_page, update_page, get_clone_plan, user_directory_path, 
+    get_client_ip, CLONE_SKIP_FIELDS, ContentTypeMap, WriteBuffer, 
+    HyperLogLog, LRUCache, pack_ip, unpack_ip, set_update_fields, dump_fields,
+    load_fields, compress_data, decompress_data, diff_data, patch_data,
+    bulk_insert_ignore
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+# Max number of primary keys passed to a single IN (...) lookup. Keeps the
+# number of query parameters below SQLite's limit.
+SPECIFIC_BATCH_SIZE = 500
+
+
+class SpecificIterable(ModelIterable):
+    '''Yields pages casted to their specific types. Fetches all pages of the
+    same type with a single query and keeps the original order.'''
+
+    def __iter__(self):
+        pages = list(super(SpecificIterable, self).__iter__())
+        annotations = list(self.queryset.query.annotation_select)
+
+        pks_by_type = defaultdict(list)
+        for page in pages:
+            pks_by_type[page.content_type_id].append(page.pk)
+
+        specific_pages = dict()
+        for content_type_id, pks in pks_by_type.items():
+            if content_type_id is None:
+                continue
+            model_class = page_types.get_model(content_type_id)
+            if model_class is None or model_class is self.queryset.model:
+                continue
+            for i in range(0, len(pks), SPECIFIC_BATCH_SIZE):
+                batch = pks[i:i + SPECIFIC_BATCH_SIZE]
+                for obj in model_class._base_manager.using(
+                        self.queryset.db).filter(pk__in=batch):
+                    specific_pages[obj.pk] = obj
+
+        for page in pages:
+            specific_page = specific_pages.get(page.pk, page)
+            for name in annotations:
+                setattr(specific_page, name, getattr(page, name))
+            yield specific_page
+
+
+class PageQuerySet(models.QuerySet):
+
+    def specific(self):
+        '''Returns queryset which yields pages of the most specific types.'''
+        clone = self._clone()
+        clone._iterable_class = SpecificIterable
+        return clone
 
 
 class Page(models.Model):
     verbose_name = "page"
 
+    objects = PageQuerySet.as_manager()
+
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL, 
         on_delete=models.SET_NULL, blank=True, null=True,
@@ -50,27 +119,70 @@ class Page(models.Model):
         editable=False
     )
     latest_changes_date = models.DateTimeField(
-        null=True,
-        editable=False
+        default=timezone.now,
+        editable=False,
+        db_index=True
     )
 
     comments_on = models.BooleanField(default=True)
 
+    # Denormalized number of visits, maintained by PageVisit (see also
+    # rebuild_visit_counts command).
+    visits_count = models.PositiveIntegerField(
+        default=0, editable=False, db_index=True
+    )
+
+    # Denormalized number of comments (without replies), maintained by
+    # Comment (see also rebuild_comment_counts command).
+    comments_count = models.PositiveIntegerField(default=0, editable=False)
+
+    # Date of the latest change of comments of the page (with replies), the
+    # version of cached comments (see Comment.get_cache_version).
+    comments_changed_date = models.DateTimeField(
+        blank=True, null=True, editable=False
+    )
+
+    # Counters (and the date of changes of comments) are updated only with
+    # queries, save never writes them.
+    COUNTER_FIELDS = ("visits_count", "comments_count", 
+                      "comments_changed_date")
+
+    # Scheduled (un)publishing. Claims let only one worker process a page.
+    publish_at = models.DateTimeField(blank=True, null=True, db_index=True)
+    unpublish_at = models.DateTimeField(blank=True, null=True, db_index=True)
+    schedule_claimed_by = models.CharField(
+        max_length=255, blank=True, null=True, editable=False
+    )
+    schedule_claimed_at = models.DateTimeField(
+        blank=True, null=True, editable=False
+    )
+
+    # Scheduling is written only by schedule_publish, schedule_unpublish and
+    # workers (see publishing), save never writes it. Otherwise saves of
+    # stale instances (e.g. by editors) would reschedule processed pages or
+    # drop claims of workers.
+    SCHEDULE_FIELDS = ("publish_at", "unpublish_at", "schedule_claimed_by",
+                       "schedule_claimed_at")
+
+    # Revision of the draft which has been published most recently
+    live_revision = models.ForeignKey(
+        "PageRevision", related_name="+", blank=True, null=True,
+        editable=False, on_delete=models.SET_NULL
+    )
 
     def __init__(self, *args, **kwargs):
         # Set content type only once
         super(Page, self).__init__(*args, **kwargs)
         if not self.id and not self.content_type_id:
-            self.content_type = ContentType.objects.get_for_model(self)
+            self.content_type_id = page_types.get_id(type(self))
 
     @property
     def specific(self):
         '''Casts Page to specific type stored in content_type.''' 
-        content_type = ContentType.objects.get_for_id(self.content_type_id)
-        model_class = content_type.model_class()
+        model_class = page_types.get_model(self.content_type_id)
         if model_class is None or isinstance(self, model_class):
             return self
-        return content_type.get_object_for_this_type(id=self.id)
+        return model_class._base_manager.using(self._state.db).get(id=self.id)
 
     def get_absolute_url(self):
         '''Returns url to specific page.'''
@@ -81,38 +193,135 @@ class Page(models.Model):
 
     def register_visit(self, request=None, user=None):
         '''Register page visit.'''
+        if settings.BUFFER_PAGE_VISITS:
+            visit = PageVisit.build(self, request, user)
+            visit_buffer.put(visit)
+            return visit
         return PageVisit.create(self, request, user)
 
+    @property
+    def unique_visitors(self):
+        '''
+        Returns estimated number of unique visitors. Merges sketches of daily
+        rollups with visits which have not been rolled up yet.
+        '''
+        sketch = HyperLogLog()
+        for content in self.daily_visits.values_list("sketch", flat=True):
+            sketch.merge(HyperLogLog.from_bytes(content))
+        for visit in self.visits.filter(rolled_up=False).values_list(
+                "ip", "agent_id", "user_id"):
+            key = PageVisit.get_visitor_key(*visit)
+            if key is not None:
+                sketch.add(key)
+        return sketch.count()
+
     def __repr__(self):
         return "{!r} ({:d})".format(self.specific.__class__.__name__, self.pk)
 
     def save(self, *args, **kwargs):
-        '''Saves the page. Sets unpublished changes to True.'''
+        '''
+        Saves the page. Sets unpublished changes to True. Counters and
+        scheduling of existing pages are not written.
+        '''
         self.has_unpublished_changes = True
         self.latest_changes_date = timezone.now()
+        set_update_fields(
+            self, self.COUNTER_FIELDS + self.SCHEDULE_FIELDS, kwargs
+        )
         super(Page, self).save(*args, **kwargs)
 
     '''Add more informative name for save.'''
     save_draft = save
 
-    def publish(self):
-        '''Publish the page.'''
-        if not self.published_page:
-            self.first_published_date = timezone.now()
-        else:
-            self.published_page.delete()
-            self.published_page = None
+    def publish(self, in_place=True):
+        '''
+        Publish the page. By default the already published page is updated
+        in place, so it keeps its pk, visits and comments. Otherwise it is
+        deleted and the page is cloned again.
+        '''
+        now = timezone.now()
+        pub_page = None
+        try:
+            with transaction.atomic():
+                if not self.published_page_id:
+                    self.first_published_date = now
+                    pub_page = clone_page(self, live=True, editable=False)
+                elif in_place:
+                    pub_page = type(self)._base_manager.get(
+                        pk=self.published_page_id
+                    )
+                    # Every publish changes the date (see caching of
+                    # AnalysisView).
+                    update_page(
+                        self, pub_page, live=True, editable=False,
+                        latest_changes_date=now
+                    )
+                else:
+                    self.published_page.delete()
+                    self.published_page = None
+                    pub_page = clone_page(self, live=True, editable=False)
+
+                # Save pending changes of the draft, then mark them published.
+                self.published_page = pub_page
+                self.save()
+                self.mark_published(pub_page, now)
+                Page.objects.filter(pk=self.pk).update(
+                    has_unpublished_changes=False, latest_changes_date=now
+                )
 
-        pub_page = clone_page(self)
-        pub_page.live = True
-        pub_page.editable = False
-        pub_page.save()
+                # Written before commit, so live pages never miss them.
+                pub_page.write_artifacts()
+        except Exception:
+            if pub_page is not None:
+                pub_page.delete_artifacts()
+            raise
+        return pub_page
 
+    def mark_published(self, pub_page, now):
+        '''
+        Sets the state of the draft published (now) as pub_page. Shared by
+        publish and publishing.bulk_publish, which write it.
+        '''
         self.published_page = pub_page
         self.has_unpublished_changes = False
-        self.save()
+        self.latest_changes_date = now
 
-        return pub_page
+    def get_artifacts_dir(self):
+        '''Returns directory of files rendered when the page was published.'''
+        return os.path.join(settings.MEDIA_ROOT, "published", str(self.pk))
+
+    def write_artifacts(self):
+        '''
+        Renders (and compresses) files of the published page once, when it
+        is published (e.g. body of ContentPage, variants of uploaded files).
+        It is called within the transaction of publishing; files of rolled
+        back publishing are deleted (see delete_artifacts).
+        '''
+
+    def delete_artifacts(self):
+        '''Deletes files rendered for the page (see write_artifacts).'''
+        shutil.rmtree(self.get_artifacts_dir(), ignore_errors=True)
+
+    def get_served_file(self):
+        '''Returns path of the file served for the page (ExternalFileView).'''
+        return None
+
+    def schedule_publish(self, when=None):
+        '''Schedules publishing of the page (now by default).'''
+        self.publish_at = when or timezone.now()
+        self.save_schedule(["publish_at"])
+
+    def schedule_unpublish(self, when=None):
+        '''Schedules unpublishing of the page (now by default).'''
+        self.unpublish_at = when or timezone.now()
+        self.save_schedule(["unpublish_at"])
+
+    def save_schedule(self, fields=("publish_at", "unpublish_at")):
+        '''Writes the given scheduling fields of the page.'''
+        if fields:
+            Page.objects.filter(pk=self.pk).update(**{
+                field: getattr(self, field) for field in fields
+            })
 
     def unpublish(self):
         '''Unpublish the page.'''
@@ -126,17 +335,78 @@ class Page(models.Model):
         if comment:
             if not isinstance(comment, Comment):
                 raise TypeError("comment must be a Commend type")
-            if not comment.pk:
-                comment.save()
         else:
             comment = Comment(**kwargs)
-            comment.save()
 
-        self.comments.add(comment)
+        # Save (instead of self.comments.add) to maintain path of comment
+        comment.page = self
+        comment.save()
 
         return comment
 
 
+# Map between page models and their content types shared by the process.
+page_types = ContentTypeMap(lambda: [Page] + get_page_models())
+
+
+class UserAgent(models.Model):
+    '''
+    Interned user agent strings referenced by visits. Ids of user agents are
+    kept in process-wide LRU cache.
+    '''
+    hash = models.CharField(max_length=40, unique=True)
+    value = models.TextField()
+
+    cache = LRUCache(max_size=1024)
+
+    @classmethod
+    def get_id(cls, value):
+        '''Returns id of the user agent, creates it when necessary.'''
+        return cls.get_ids([value])[value]
+
+    @classmethod
+    def get_ids(cls, values):
+        '''
+        Returns dict with ids of the user agents, creates missing ones. User
+        agents missing in the cache are looked up (and inserted) together.
+        '''
+        ids, hashes = dict(), dict()
+        for value in set(values):
+            pk = cls.cache.get(value)
+            if pk is None:
+                hashes[hashlib.sha1(value.encode()).hexdigest()] = value
+            else:
+                ids[value] = pk
+        if not hashes:
+            return ids
+
+        found = dict(cls.objects.filter(
+            hash__in=hashes
+        ).values_list("hash", "pk"))
+        missing = [ 
+            cls(hash=hash, value=value) for hash, value in hashes.items() 
+            if hash not in found 
+        ]
+        if missing:
+            bulk_insert_ignore(cls, missing)
+            found.update(cls.objects.filter(
+                hash__in=[ agent.hash for agent in missing ]
+            ).values_list("hash", "pk"))
+        new_ids = { hashes[hash]: pk for hash, pk in found.items() }
+
+        # Cache only committed rows.
+        def cache_ids():
+            for value, pk in new_ids.items():
+                cls.cache.set(value, pk)
+        if transaction.get_connection().in_atomic_block:
+            transaction.on_commit(cache_ids)
+        else:
+            cache_ids()
+
+        ids.update(new_ids)
+        return ids
+
+
 class PageVisit(models.Model):
     '''Register who and when visit a page.'''
     page = models.ForeignKey(
@@ -148,19 +418,96 @@ class PageVisit(models.Model):
         on_delete=models.SET_NULL, blank=True, null=True,
         related_name="+")
 
+    METHODS = ("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS")
+
     timestamp = models.DateTimeField(default=timezone.now)
-    ip_address = models.GenericIPAddressField(blank=True, null=True)
-    user_agent = models.TextField(blank=True, null=True)
-    request_method = models.CharField(max_length=16, blank=True, null=True)
+
+    # Compact representations of ip_address, user_agent and request_method
+    ip = models.BinaryField(max_length=16, blank=True, null=True)
+    agent = models.ForeignKey(
+        UserAgent, on_delete=models.PROTECT, blank=True, null=True,
+        related_name="+"
+    )
+    method = models.PositiveSmallIntegerField(
+        blank=True, null=True, 
+        choices=[ (i, method) for i, method in enumerate(METHODS) ]
+    )
+
+    # Whether the visit has been counted in rollups (see analytics)
+    rolled_up = models.BooleanField(default=False, editable=False)
 
     class Meta:
-        unique_together = ("page", "ip_address")
+        index_together = ("rolled_up", "timestamp")
+
+    @property
+    def ip_address(self):
+        return unpack_ip(self.ip)
+
+    @ip_address.setter
+    def ip_address(self, value):
+        self.ip = pack_ip(value) if value else None
+
+    # User agent which has not been resolved to its id yet (see
+    # resolve_agents).
+    _user_agent = None
+
+    @property
+    def user_agent(self):
+        if self._user_agent is not None:
+            return self._user_agent
+        return self.agent.value if self.agent_id else None
+
+    @user_agent.setter
+    def user_agent(self, value):
+        # Ids are resolved when visits are saved, so buffered visits do not
+        # hit the database in the request thread.
+        self._user_agent = value or None
+        self.agent_id = None
 
     @classmethod
-    def create(cls, page, request=None, user=None):
-        '''Create PageVisit object.'''
+    def resolve_agents(cls, visits):
+        '''Sets ids of user agents of the visits (with a few queries).'''
+        visits = [ visit for visit in visits if visit._user_agent is not None ]
+        if not visits:
+            return
+        ids = UserAgent.get_ids(visit._user_agent for visit in visits)
+        for visit in visits:
+            visit.agent_id = ids[visit._user_agent]
+            visit._user_agent = None
+
+    def save(self, *args, **kwargs):
+        '''Saves the visit. Resolves id of its user agent.'''
+        self.resolve_agents([self])
+        super(PageVisit, self).save(*args, **kwargs)
+
+    @property
+    def request_method(self):
+        return self.METHODS[self.method] if self.method is not None else None
+
+    @request_method.setter
+    def request_method(self, value):
+        value = (value or "").upper()
+        self.method = (
+            self.METHODS.index(value) if value in self.METHODS else None
+        )
+
+    @staticmethod
+    def get_visitor_key(ip=None, agent_id=None, user_id=None):
+        '''
+        Returns string identifying the visitor for unique visitors sketches
+        (None when the visitor cannot be identified).
+        '''
+        if user_id is not None:
+            return "user:%s" % user_id
+        if ip:
+            return "ip:%s|%s" % (bytes(ip).hex(), agent_id or "")
+        return None
+
+    @classmethod
+    def build(cls, page, request=None, user=None):
+        '''Build (unsaved) PageVisit object.'''
         http_headers = getattr(request, "META", dict())
-        visit = cls(
+        return cls(
             page = page,
             user = user or (
                 getattr(request, "user", None) 
@@ -172,18 +519,112 @@ class PageVisit(models.Model):
             request_method = http_headers.get("REQUEST_METHOD")
         )
 
+    @classmethod
+    def create(cls, page, request=None, user=None):
+        '''Create PageVisit object.'''
+        visit = cls.build(page, request, user)
         try:
             visit.full_clean()
         except ValidationError:
             return None
         else:
-            visit.save()
+            with transaction.atomic():
+                visit.save()
+                Page.objects.filter(pk=visit.page_id).update(
+                    visits_count=F("visits_count") + 1
+                )
             return visit
 
+    @classmethod
+    def insert_many(cls, visits):
+        '''
+        Inserts visits and increments visits counters of pages. Returns
+        number of inserted visits.
+        '''
+        visits = list(visits)
+        counts = defaultdict(int)
+        for visit in visits:
+            counts[visit.page_id] += 1
+
+        with transaction.atomic():
+            cls.resolve_agents(visits)
+            cls.objects.bulk_create(visits)
+            if counts:
+                Page.objects.filter(pk__in=counts).update(
+                    visits_count=F("visits_count") + Case(*[
+                        When(pk=pk, then=Value(count))
+                        for pk, count in counts.items()
+                    ], output_field=models.IntegerField())
+                )
+        return len(visits)
+
+
+# Buffer of visits inserted by a background thread (BUFFER_PAGE_VISITS).
+visit_buffer = WriteBuffer(PageVisit, insert=PageVisit.insert_many)
+
+
+class VisitRollup(models.Model):
+    '''
+    Aggregated visits of the page within the time bucket. Rollups are filled
+    from PageVisit rows by astorcore.analytics.rollup_visits.
+    '''
+    bucket = models.DateTimeField()
+    visits = models.PositiveIntegerField(default=0)
+    authenticated_visits = models.PositiveIntegerField(default=0)
+
+    # HyperLogLog sketch of visitors and its estimate
+    unique_visitors = models.PositiveIntegerField(default=0)
+    sketch = models.BinaryField(default=b"", editable=False)
+
+    class Meta:
+        abstract = True
+        unique_together = ("page", "bucket")
+
+    @classmethod
+    def get_bucket(cls, timestamp):
+        '''Returns beginning of the bucket (in UTC) of the timestamp.'''
+        raise NotImplementedError
+
+
+class HourlyVisitRollup(VisitRollup):
+    page = models.ForeignKey(
+        Page, on_delete=models.CASCADE, related_name="hourly_visits"
+    )
+
+    @classmethod
+    def get_bucket(cls, timestamp):
+        return timestamp.astimezone(timezone.utc).replace(
+            minute=0, second=0, microsecond=0
+        )
+
+
+class DailyVisitRollup(VisitRollup):
+    page = models.ForeignKey(
+        Page, on_delete=models.CASCADE, related_name="daily_visits"
+    )
+
+    @classmethod
+    def get_bucket(cls, timestamp):
+        return timestamp.astimezone(timezone.utc).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+
 
 class Comment(models.Model):
+    '''
+    Comment of the page or reply to another comment. Comments are stored as
+    a tree with materialized paths: path of the comment is the path of its
+    parent followed by base36-encoded pk (PATH_STEP characters), so
+    ordering by path gives depth-first order of the tree.
+    '''
     verbose_name = "comment"
 
+    PATH_STEP = 6
+
+    # Max depth of replies: paths of the deepest replies fill the column.
+    MAX_PATH_LENGTH = 255
+    MAX_DEPTH = MAX_PATH_LENGTH // PATH_STEP - 1
+
     author = models.ForeignKey(
         settings.AUTH_USER_MODEL, 
         on_delete=models.SET_NULL, blank=True, null=True,
@@ -201,21 +642,285 @@ class Comment(models.Model):
     body = models.TextField()
     timestamp = models.DateTimeField(default=timezone.now)
 
+    # Position in the tree of comments (maintained by save)
+    path = models.CharField(
+        max_length=MAX_PATH_LENGTH, blank=True, default="", editable=False
+    )
+    depth = models.PositiveSmallIntegerField(default=0, editable=False)
+    root_page = models.ForeignKey(
+        Page, on_delete=models.CASCADE, blank=True, null=True,
+        editable=False, related_name="+"
+    )
+
+    # Denormalized number of replies (see also rebuild_comment_counts)
+    replies_count = models.PositiveIntegerField(default=0, editable=False)
+
+    COUNTER_FIELDS = ("replies_count",)
+
+    class Meta:
+        index_together = [
+            ("root_page", "path"), ("page", "timestamp"), 
+            ("parent", "timestamp")
+        ]
+
+    @classmethod
+    def encode_step(cls, pk):
+        '''Returns base36-encoded pk padded to PATH_STEP characters.'''
+        digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+        step = ""
+        while pk:
+            pk, digit = divmod(pk, 36)
+            step = digits[digit] + step
+        return step.rjust(cls.PATH_STEP, "0")
+
+    def get_tree_position(self):
+        '''Returns path, depth and root page of the comment.'''
+        step = self.encode_step(self.pk)
+        if self.parent_id is None:
+            return step, 0, self.page_id
+        parent = self.parent
+        return parent.path + step, parent.depth + 1, parent.root_page_id
+
+    @staticmethod
+    def update_counters(page_id, parent_id, delta):
+        '''Adds delta to counters of comments of the page and replies.'''
+        if page_id is not None:
+            Page.objects.filter(
+                pk=page_id, comments_count__gte=-delta
+            ).update(comments_count=F("comments_count") + delta)
+        if parent_id is not None:
+            Comment.objects.filter(
+                pk=parent_id, replies_count__gte=-delta
+            ).update(replies_count=F("replies_count") + delta)
+
+    def save(self, *args, **kwargs):
+        '''
+        Saves the comment, updates its position in the tree and counters of
+        the page and the parent. Invalidates cached comments of the page.
+        '''
+        with transaction.atomic():
+            if self._state.adding:
+                old_position = (None, None)
+            else:
+                old_position = Comment.objects.filter(pk=self.pk).values_list(
+                    "page_id", "parent_id"
+                ).first() or (None, None)
+            set_update_fields(self, self.COUNTER_FIELDS, kwargs)
+            super(Comment, self).save(*args, **kwargs)
+
+            position = (self.page_id, self.parent_id)
+            if position != old_position:
+                self.update_counters(*old_position, delta=-1)
+                self.update_counters(*position, delta=1)
+
+            old_root_page_id = self.root_page_id
+            self.update_tree_position()
+        self.invalidate_cache(old_root_page_id, self.root_page_id)
+
+    def update_tree_position(self):
+        '''Updates position of the comment and its descendants in the tree.'''
+        old_path, old_depth = self.path, self.depth
+        path, depth, root_page_id = self.get_tree_position()
+        if (path, depth, root_page_id) == (
+                old_path, self.depth, self.root_page_id):
+            return
+        self.check_depth(depth + self.get_subtree_depth(old_path, old_depth))
+        self.path, self.depth, self.root_page_id = (
+            path, depth, root_page_id
+        )
+        Comment.objects.filter(pk=self.pk).update(
+            path=path, depth=depth, root_page=root_page_id
+        )
+        if old_path:
+            # Move descendants together with the comment.
+            Comment.objects.filter(path__startswith=old_path).exclude(
+                pk=self.pk
+            ).update(
+                path=Concat(
+                    Value(path), Substr("path", len(old_path) + 1),
+                    output_field=models.CharField()
+                ),
+                depth=F("depth") + (depth - old_depth),
+                root_page=root_page_id
+            )
+
+    @classmethod
+    def check_depth(cls, depth):
+        '''Raises ValidationError when the depth exceeds MAX_DEPTH.'''
+        if depth > cls.MAX_DEPTH:
+            raise ValidationError(
+                "Replies cannot be nested deeper than %d levels." % 
+                cls.MAX_DEPTH, code="max_depth"
+            )
+
+    def get_subtree_depth(self, path, depth):
+        '''Returns depth of the deepest descendant below the comment.'''
+        if not path:
+            return 0
+        max_depth = Comment.objects.filter(
+            path__startswith=path
+        ).aggregate(models.Max("depth"))["depth__max"]
+        return (max_depth or depth) - depth
+
     def reply(self, comment=None, **kwargs):
         '''Reply to the commend.'''
+        self.check_depth(self.depth + 1)
         if comment:
             if not isinstance(comment, Comment):
                 raise TypeError("comment must be a Commend type")
-            if not comment.pk:
-                comment.save()
         else:
             comment = Comment(**kwargs)
-            comment.save()
 
-        self.replies.add(comment)
+        # Save (instead of self.replies.add) to maintain path of comment
+        comment.parent = self
+        comment.save()
 
         return comment
 
+    @classmethod
+    def get_tree(cls, page, max_depth=None):
+        '''
+        Returns list of comments of the page with replies (up to max_depth)
+        stored in children of every comment. Loads the tree with a single
+        query.
+        '''
+        comments = cls.objects.filter(root_page=page).select_related(
+            "author"
+        ).order_by("path")
+        if max_depth is not None:
+            comments = comments.filter(depth__lte=max_depth)
+        return cls.build_tree(comments)
+
+    @staticmethod
+    def get_cache_version(page):
+        '''
+        Returns version of the cached comments of the page: the date of
+        the latest change of comments, stored in the database, so all
+        processes see the same version.
+        '''
+        date = page.comments_changed_date
+        return "%.6f" % date.timestamp() if date else "0"
+
+    @staticmethod
+    def invalidate_cache(*page_ids):
+        '''
+        Replaces versions of the cached comments of the pages. Entries of
+        old versions are never read again (and expire), so readers are not
+        left waiting for one rendering of the comments.
+        '''
+        page_ids = set(page_ids) - {None}
+        if page_ids:
+            Page.objects.filter(pk__in=page_ids).update(
+                comments_changed_date=timezone.now()
+            )
+
+    @staticmethod
+    def build_tree(comments):
+        '''
+        Assembles tree of comments (ordered by path). Returns list of top
+        comments.
+        '''
+        roots, nodes = list(), dict()
+        for comment in comments:
+            comment.children = list()
+            nodes[comment.pk] = comment
+            parent = nodes.get(comment.parent_id)
+            if parent is None:
+                roots.append(comment)
+            else:
+                parent.children.append(comment)
+        return roots
+
+
+def decrement_comment_counters(sender, instance, **kwargs):
+    '''Updates counters of the page and the parent of deleted comment.'''
+    Comment.update_counters(instance.page_id, instance.parent_id, delta=-1)
+
+
+def invalidate_comments_cache(sender, instance, **kwargs):
+    '''Invalidates cached comments of the page of deleted comment.'''
+    Comment.invalidate_cache(instance.root_page_id)
+
+
+class PageRevision(models.Model):
+    '''
+    Compressed snapshot of the content of a page. Revisions are delta-encoded
+    against the previous revision, every KEYFRAME_INTERVAL-th revision stores
+    the full snapshot.
+    '''
+    KEYFRAME_INTERVAL = 20
+
+    # Fields which are not part of the content of the page: fields which are
+    # not copied when publishing and metadata of the page.
+    SKIP_FIELDS = CLONE_SKIP_FIELDS + (
+        "user", "content_type", "created_date", "first_published_date", 
+        "editable", "live", "has_unpublished_changes", "latest_changes_date"
+    )
+
+    page = models.ForeignKey(
+        Page, on_delete=models.CASCADE, related_name="revisions"
+    )
+    base = models.ForeignKey(
+        "self", on_delete=models.CASCADE, blank=True, null=True, 
+        editable=False, related_name="+"
+    )
+    depth = models.PositiveIntegerField(default=0, editable=False)
+    created_date = models.DateTimeField(default=timezone.now)
+    content = models.BinaryField()
+
+    @staticmethod
+    def get_fields(model):
+        '''Returns fields of the model stored in revisions.'''
+        return get_clone_plan(model, PageRevision.SKIP_FIELDS).fields
+
+    @classmethod
+    def create(cls, page):
+        '''
+        Create revision of the page. Returns None when the content of the page
+        has not changed since the previous revision.
+        '''
+        data = dump_fields(page, cls.get_fields(type(page)))
+        base = page.revisions.order_by("-pk").first()
+
+        if base is None:
+            revision = cls(page=page, content=compress_data(data))
+        else:
+            base_data = base.get_data()
+            if base_data == data:
+                return None
+            if base.depth + 1 >= cls.KEYFRAME_INTERVAL:
+                revision = cls(page=page, content=compress_data(data))
+            else:
+                revision = cls(
+                    page=page, base=base, depth=base.depth + 1,
+                    content=compress_data(diff_data(base_data, data))
+                )
+
+        revision.save()
+        return revision
+
+    def get_data(self):
+        '''Returns the content of the page decoded from the chain of deltas.'''
+        if not self.depth:
+            return decompress_data(self.content)
+
+        # Fetch the whole chain with one query (the chain is sequential).
+        revisions = {
+            revision.pk: revision for revision in PageRevision.objects.filter(
+                page_id=self.page_id, pk__lt=self.pk
+            ).order_by("-pk")[:self.depth]
+        }
+        chain = [self]
+        while chain[-1].depth:
+            base_id = chain[-1].base_id
+            chain.append(revisions.get(base_id) or 
+                         PageRevision.objects.get(pk=base_id))
+
+        data = decompress_data(chain.pop().content)
+        for revision in reversed(chain):
+            data = patch_data(data, decompress_data(revision.content))
+        return data
+
 
 class BasePage(Page):
     '''BasePage for creating other pages.'''
@@ -228,6 +933,40 @@ class BasePage(Page):
     abstract = models.TextField(default="", blank=True) 
     img_url = models.CharField(max_length=1024, blank=True)
 
+    def save(self, *args, **kwargs):
+        '''Saves the page. Drafts get a new revision when changed.'''
+        with transaction.atomic():
+            super(BasePage, self).save(*args, **kwargs)
+            if self.editable:
+                PageRevision.create(self)
+
+    '''Add more informative name for save.'''
+    save_draft = save
+
+    def publish(self, *args, **kwargs):
+        '''Publish the page. Points live_revision to the latest revision.'''
+        with transaction.atomic():
+            pub_page = super(BasePage, self).publish(*args, **kwargs)
+            self.live_revision = self.revisions.order_by("-pk").first()
+            Page.objects.filter(pk=self.pk).update(
+                live_revision=self.live_revision
+            )
+        return pub_page
+
+    def revert(self, revision):
+        '''Restores content of the draft from the revision and saves it.'''
+        load_fields(self, PageRevision.get_fields(type(self)), 
+                    revision.get_data())
+        self.save()
+
+    def rollback(self):
+        '''
+        Discards unpublished changes of the draft. Revisions store only fields
+        of the page, so tags are not restored.
+        '''
+        if self.live_revision_id:
+            self.revert(self.live_revision)
+
 
 @register_page
 class ContentPage(BasePage):
@@ -237,6 +976,46 @@ class ContentPage(BasePage):
 
     body = models.TextField(blank=True)
 
+    body_template_name = "astormain/pages/content_body.html"
+
+    def render_body(self):
+        return render_to_string(self.body_template_name, {"page": self})
+
+    def get_body(self):
+        '''
+        Returns rendered body of the page. Published pages return the body
+        rendered when they were published (a missing one is written again),
+        drafts are rendered every time.
+        '''
+        if self.editable:
+            return mark_safe(self.render_body())
+        try:
+            with open(self.get_body_file(), encoding="utf-8") as f:
+                return mark_safe(f.read())
+        except FileNotFoundError:
+            logger.warning(
+                "Body of published page %d is missing, writing it again.",
+                self.pk
+            )
+        body = self.render_body()
+        write_artifact(self.get_body_file(), body)
+        return mark_safe(body)
+
+    def get_body_file(self):
+        return os.path.join(self.get_artifacts_dir(), "body.html")
+
+    def write_artifacts(self):
+        '''
+        Writes the rendered body of the page (see get_body) and its
+        compressed variants.
+        '''
+        write_artifact(self.get_body_file(), self.render_body())
+
+
+def delete_artifacts(sender, instance, **kwargs):
+    '''Deletes files rendered for the deleted (e.g. unpublished) page.'''
+    instance.delete_artifacts()
+
 
 class AbstractUploadPage(BasePage):
     verbose_name = "base file page"
@@ -246,6 +1025,15 @@ class AbstractUploadPage(BasePage):
 
     file = models.FileField(upload_to=user_directory_path)
 
+    def write_artifacts(self):
+        '''Writes compressed variants of the file (if still missing).'''
+        path = self.get_served_file()
+        if path and os.path.isfile(path):
+            precompress_file(path)
+
+    def get_served_file(self):
+        return self.file.path if self.file else None
+
 
 @register_page
 class HTMLUploadPage(AbstractUploadPage):
@@ -0,0 +1,150 @@
+import base64
+import binascii
+import json
+import operator
+from datetime import date
+from functools import reduce
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    '''
+    Cursor pagination which seeks rows by their keys (values of the fields
+    in keyset_ordering of the view, which cannot be NULL; the last one has to
+    be unique) instead of offsets, so every page costs the same. Cursors are
+    opaque (base64 encoded keys). Responses are plain lists of objects,
+    links to the next and previous pages are sent in the Link header.
+    '''
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    ordering = ("-id",)
+
+    invalid_cursor_message = "Invalid cursor."
+
+    @property
+    def page_size(self):
+        return settings.API_PAGE_SIZE
+
+    @property
+    def max_page_size(self):
+        return settings.API_MAX_PAGE_SIZE
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def encode_cursor(self, position, reverse):
+        data = json.dumps([position, reverse])
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    def decode_cursor(self, request):
+        '''Returns position (keys) and direction stored in the cursor.'''
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor is None:
+            return None, False
+        try:
+            position, reverse = json.loads(
+                base64.urlsafe_b64decode(cursor.encode()).decode()
+            )
+        except (TypeError, ValueError, UnicodeDecodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or \
+                len(position) != len(self.ordering) or None in position:
+            raise NotFound(self.invalid_cursor_message)
+        return position, bool(reverse)
+
+    @staticmethod
+    def get_keyset_filter(ordering, position):
+        '''
+        Returns Q selecting rows after the position in the given ordering:
+        (f1 > v1) OR (f1 = v1 AND f2 > v2) OR ...
+        '''
+        conditions = list()
+        for i, field in enumerate(ordering):
+            name = field.lstrip("-")
+            lookup = "__lt" if field.startswith("-") else "__gt"
+            condition = {
+                f.lstrip("-"): value
+                for f, value in zip(ordering[:i], position[:i])
+            }
+            condition[name + lookup] = position[i]
+            conditions.append(Q(**condition))
+        return reduce(operator.or_, conditions)
+
+    def get_position(self, obj):
+        '''Returns keys of the object (dates in full ISO format).'''
+        position = list()
+        for field in self.ordering:
+            value = getattr(obj, field.lstrip("-"))
+            if isinstance(value, date):
+                value = value.isoformat()
+            position.append(value)
+        return position
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = getattr(view, "keyset_ordering", self.ordering)
+        page_size = self.get_page_size(request)
+        position, reverse = self.decode_cursor(request)
+
+        ordering = self.ordering
+        if reverse:
+            ordering = [
+                field[1:] if field.startswith("-") else "-" + field
+                for field in ordering
+            ]
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            try:
+                queryset = queryset.filter(
+                    self.get_keyset_filter(ordering, position)
+                )
+            except (ValueError, ValidationError):
+                raise NotFound(self.invalid_cursor_message)
+
+        rows = list(queryset[:page_size + 1])
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if reverse:
+            rows.reverse()
+
+        has_next = has_more if not reverse else position is not None
+        has_previous = has_more if reverse else position is not None
+        self.next_position = (
+            self.get_position(rows[-1]) if rows and has_next else None
+        )
+        self.previous_position = (
+            self.get_position(rows[0]) if rows and has_previous else None
+        )
+        return rows
+
+    def get_link(self, position, reverse):
+        if position is None:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param,
+            self.encode_cursor(position, reverse)
+        )
+
+    def get_paginated_response(self, data):
+        links = [
+            '<%s>; rel="%s"' % (url, rel) for url, rel in (
+                (self.get_link(self.next_position, False), "next"),
+                (self.get_link(self.previous_position, True), "prev")
+            ) if url is not None
+        ]
+        headers = { "Link": ", ".join(links) } if links else None
+        return Response(data, headers=headers)
+
+    def get_results(self, data):
+        return data
@@ -0,0 +1,221 @@
+from collections import defaultdict
+from datetime import timedelta
+from itertools import islice
+
+from django.db import models, transaction
+from django.db.models import (
+    Case, When, Value, Max, Q, prefetch_related_objects
+)
+from django.utils import timezone
+
+from astorcore.models import Page, PageQuerySet, PageRevision, page_types
+from astorcore.utils import get_clone_plan, CLONE_SKIP_FIELDS
+from astoraccount.models import Activity
+
+
+# Number of pages (un)published within a single transaction.
+PUBLISH_CHUNK_SIZE = 100
+
+# Claims of scheduled pages older than this are taken over by other workers
+# (e.g. after the worker which claimed them has been killed).
+SCHEDULE_CLAIM_TIMEOUT = timedelta(minutes=5)
+
+
+def chunked(iterable, size):
+    '''Splits iterable into lists of the given size.'''
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def create_activities(pages, number, message):
+    '''Registers activities of the owners of pages with a single query.'''
+    Activity.objects.bulk_create([
+        Activity(
+            user_id=page.user_id, number=number, object_id=page.pk,
+            content_type_id=page_types.get_id(type(page)),
+            message="%s: \"%s\" id=%d type=%s" % (
+                message, getattr(page, "title", ""), page.pk,
+                page.verbose_name.title()
+            )
+        )
+        for page in pages if page.user_id
+    ])
+
+
+def bulk_publish(pages, chunk_size=PUBLISH_CHUNK_SIZE):
+    '''
+    Publishes drafts like Page.publish, but chunk by chunk, each within one
+    transaction. Tags of new published pages, drafts and activities are
+    written with a fixed number of queries per chunk. Returns list of
+    published pages.
+    '''
+    if isinstance(pages, PageQuerySet):
+        pages = pages.specific()
+
+    published = list()
+    for chunk in chunked(pages, chunk_size):
+        pub_pages = list()
+        try:
+            with transaction.atomic():
+                pub_pages = _publish_chunk(chunk)
+                # Written before commit like in Page.publish.
+                write_artifacts(pub_pages)
+        except Exception:
+            for pub_page in pub_pages:
+                pub_page.delete_artifacts()
+            raise
+        published.extend(pub_pages)
+    return published
+
+
+def _publish_chunk(pages):
+    now = timezone.now()
+
+    # Fetch already published pages with one query per type of page.
+    pub_ids = defaultdict(list)
+    for page in pages:
+        if page.published_page_id:
+            pub_ids[type(page)].append(page.published_page_id)
+    pub_pages = dict()
+    for model, ids in pub_ids.items():
+        pub_pages.update(model._base_manager.in_bulk(ids))
+
+    new_pages = defaultdict(list)
+    for page in pages:
+        plan = get_clone_plan(type(page), CLONE_SKIP_FIELDS)
+        if page.published_page_id:
+            pub_page = plan.update(
+                page, pub_pages[page.published_page_id],
+                live=True, editable=False, latest_changes_date=now
+            )
+        else:
+            page.first_published_date = now
+            pub_page = plan.clone(
+                page, copy_tags=False, live=True, editable=False
+            )
+            new_pages[plan].append((page, pub_page))
+        page.mark_published(pub_page, now)
+
+    for plan, pairs in new_pages.items():
+        plan.copy_tags(pairs)
+
+    live_revisions = dict(
+        PageRevision.objects.filter(page__in=pages).values_list(
+            "page"
+        ).annotate(Max("pk"))
+    )
+    for page in pages:
+        page.live_revision_id = live_revisions.get(
+            page.pk, page.live_revision_id
+        )
+
+    Page.objects.filter(pk__in=[ page.pk for page in pages ]).update(
+        has_unpublished_changes=False, latest_changes_date=now,
+        published_page=Case(*[
+            When(pk=page.pk, then=Value(page.published_page_id))
+            for page in pages
+        ], output_field=models.IntegerField()),
+        first_published_date=Case(*[
+            When(pk=page.pk, then=Value(
+                page.first_published_date, output_field=models.DateTimeField()
+            ))
+            for page in pages
+        ], output_field=models.DateTimeField()),
+        live_revision=Case(*[
+            When(pk=page.pk, then=Value(page.live_revision_id))
+            for page in pages
+        ], output_field=models.IntegerField())
+    )
+
+    create_activities(pages, Activity.PUBLISH_PAGE, "Analysis published")
+
+    return [ page.published_page for page in pages ]
+
+
+def write_artifacts(pages):
+    '''
+    Writes files rendered for published pages. Tags (rendered with content
+    pages) are prefetched with one query per type of page.
+    '''
+    pages_by_type = defaultdict(list)
+    for page in pages:
+        pages_by_type[type(page)].append(page)
+    for pages in pages_by_type.values():
+        prefetch_related_objects(pages, "tags")
+        for page in pages:
+            page.write_artifacts()
+
+
+def bulk_unpublish(pages, chunk_size=PUBLISH_CHUNK_SIZE):
+    '''
+    Unpublishes drafts like Page.unpublish, chunk by chunk. Returns list of
+    unpublished drafts (drafts which have not been published are skipped).
+    '''
+    if isinstance(pages, PageQuerySet):
+        pages = pages.specific()
+
+    unpublished = list()
+    for chunk in chunked(pages, chunk_size):
+        chunk = [ page for page in chunk if page.published_page_id ]
+        with transaction.atomic():
+            Page.objects.filter(
+                pk__in=[ page.published_page_id for page in chunk ]
+            ).delete()
+            for page in chunk:
+                page.published_page = None
+            create_activities(
+                chunk, Activity.UNPUBLISH_PAGE, "Analysis unpublished"
+            )
+        unpublished.extend(chunk)
+    return unpublished
+
+
+def claim_due_pages(field, worker, batch_size=PUBLISH_CHUNK_SIZE, now=None):
+    '''
+    Claims drafts with the due date stored in the field (publish_at or
+    unpublish_at) for the worker. Returns ids of claimed pages.
+    '''
+    now = now or timezone.now()
+    free = (Q(schedule_claimed_by__isnull=True) | 
+            Q(schedule_claimed_at__lt=now - SCHEDULE_CLAIM_TIMEOUT))
+
+    ids = list(Page.objects.filter(
+        free, editable=True, **{field + "__lte": now}
+    ).order_by(field).values_list("pk", flat=True)[:batch_size])
+    Page.objects.filter(free, pk__in=ids).update(
+        schedule_claimed_by=worker, schedule_claimed_at=now
+    )
+
+    return list(Page.objects.filter(
+        pk__in=ids, schedule_claimed_by=worker
+    ).values_list("pk", flat=True))
+
+
+def process_due_pages(worker, batch_size=PUBLISH_CHUNK_SIZE, now=None):
+    '''
+    Publishes and unpublishes a batch of due pages claimed by the worker.
+    Due dates are cleared in the same transaction, so pages are processed
+    exactly once even if the worker is killed. Returns number of pages.
+    '''
+    now = now or timezone.now()
+    count = 0
+    for field, action in (("publish_at", bulk_publish), 
+                          ("unpublish_at", bulk_unpublish)):
+        ids = claim_due_pages(field, worker, batch_size, now)
+        if not ids:
+            continue
+        with transaction.atomic():
+            # Skip pages taken over by other workers in the meantime.
+            ids = list(Page.objects.select_for_update().filter(
+                pk__in=ids, schedule_claimed_by=worker
+            ).values_list("pk", flat=True))
+            Page.objects.filter(pk__in=ids).update(**{
+                field: None, "schedule_claimed_by": None,
+                "schedule_claimed_at": None
+            })
+            action(Page.objects.filter(pk__in=ids).order_by("pk"))
+        count += len(ids)
+    return count
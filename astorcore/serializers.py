@@ -1,4 +1,5 @@
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import Prefetch, prefetch_related_objects
 from taggit.models import Tag
 from rest_framework import serializers
 from rest_framework.reverse import reverse
@@ -24,6 +25,32 @@ class AnalysisCommentListHyperlink(serializers.HyperlinkedRelatedField):
                        format=format)
 
 
+class EagerLoadingMixin(object):
+    '''
+    Declares related objects read by the serializer, so views can load them
+    with a fixed number of queries (see setup_eager_loading).
+    '''
+    select_related_fields = ()
+    prefetch_related_fields = ()
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        '''Returns queryset loading related objects of the serializer.'''
+        if cls.select_related_fields:
+            queryset = queryset.select_related(*cls.select_related_fields)
+        if cls.prefetch_related_fields:
+            queryset = queryset.prefetch_related(
+                *cls.prefetch_related_fields
+            )
+        return queryset
+
+    @classmethod
+    def load_related_objects(cls, objs):
+        '''Prefetches related objects of already loaded objects.'''
+        prefetch_related_objects(objs, *cls.prefetch_related_fields)
+        return objs
+
+
 class ContentTypeSerializer(serializers.ModelSerializer):
     class Meta:
         model = ContentType
@@ -40,20 +67,25 @@ class TagSerializer(serializers.HyperlinkedModelSerializer):
         fields = ["id", "url", "name", "slug"]
 
 
-class PageSerializer(serializers.HyperlinkedModelSerializer):
+class PageSerializer(EagerLoadingMixin, 
+                     serializers.HyperlinkedModelSerializer):
     url = serializers.HyperlinkedIdentityField(
         view_name="api:analysis-detail", lookup_field="pk",
         lookup_url_kwarg="apk"
     )
     content_type = ContentTypeSerializer()
+    comments_count = serializers.ReadOnlyField()
+
+    select_related_fields = ("content_type",)
 
     class Meta:
         model = Page
-        fields = ["id", "url", "content_type"]
+        fields = ["id", "url", "content_type", "comments_count"]
 
 
 @register_serializer
-class BasePageSerializer(serializers.HyperlinkedModelSerializer):
+class BasePageSerializer(EagerLoadingMixin, 
+                         serializers.HyperlinkedModelSerializer):
     # comments = AnalysisCommentListHyperlink(
     #     lookup_field="pk", lookup_url_kwarg="apk"
     # )
@@ -61,10 +93,15 @@ class BasePageSerializer(serializers.HyperlinkedModelSerializer):
     comments = serializers.PrimaryKeyRelatedField(
         many=True, read_only=True, required=False
     )
+    comments_count = serializers.ReadOnlyField()
+
+    prefetch_related_fields = (
+        Prefetch("comments", queryset=Comment.objects.only("id", "page")),
+    )
     
     class Meta:
         model = BasePage
-        fields = ["id", "title", "comments"]
+        fields = ["id", "title", "comments", "comments_count"]
 
 
 @register_serializer
@@ -74,20 +111,47 @@ class ContentPageSerializer(BasePageSerializer):
         fields = BasePageSerializer.Meta.fields + ["abstract", "body"]
 
 
-class CommentSerializer(serializers.ModelSerializer):
+class CommentSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     replies = serializers.PrimaryKeyRelatedField(
         many=True, read_only=True, required=False
     )
     author = serializers.ReadOnlyField(source="author.username")
 
+    select_related_fields = ("author",)
+    prefetch_related_fields = (
+        Prefetch("replies", queryset=Comment.objects.only("id", "parent")),
+    )
+
     class Meta:
         model = Comment
         fields = ["id", "page", "author", "parent", "body", 
-                  "timestamp", "replies"]
+                  "timestamp", "replies", "replies_count"]
+        read_only_fields = ["replies_count"]
 
     def validate(self, data):
         if "page" not in data and "parent" not in data:
             raise serializers.ValidationError(
                 {"page": ["this field (or parent) is required"]}
             )
-        return data
\ No newline at end of file
+        parent = data.get("parent")
+        if parent is not None and parent.depth >= Comment.MAX_DEPTH:
+            raise serializers.ValidationError({"parent": [
+                "replies cannot be nested deeper than %d levels" % 
+                Comment.MAX_DEPTH
+            ]})
+        return data
+
+class ReplyBatchSerializer(CommentSerializer):
+    '''Serializes replies without ids of their replies (no extra queries).'''
+    prefetch_related_fields = ()
+
+    class Meta(CommentSerializer.Meta):
+        fields = ["id", "page", "author", "parent", "body", 
+                  "timestamp", "replies_count"]
+
+
+class PublishSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField())
+    action = serializers.ChoiceField(
+        choices=["publish", "unpublish"], default="publish"
+    )
@@ -0,0 +1,219 @@
+import mimetypes
+import os
+import re
+import threading
+import zlib
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag, parse_etags
+
+
+# Precompressed variants of files: (encoding, suffix of the variant, wbits
+# of zlib stream). Preferred encodings come first.
+ENCODINGS = (
+    ("gzip", ".gz", 16 + zlib.MAX_WBITS),
+    ("deflate", ".deflate", zlib.MAX_WBITS)
+)
+
+# Size of chunks of files compressed at once.
+COMPRESS_CHUNK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def precompress_file(path):
+    '''
+    Writes compressed variants of the file next to it (e.g. file.html.gz).
+    Variants get the modification time of the file, so stale variants are
+    recognised (and skipped) when the file is replaced.
+    '''
+    stat = os.stat(path)
+    for encoding, suffix, wbits in ENCODINGS:
+        variant = path + suffix
+        if _is_variant_fresh(variant, stat):
+            continue
+        tmp_path = _get_tmp_path(variant)
+        compressor = zlib.compressobj(9, zlib.DEFLATED, wbits)
+        with open(path, "rb") as source, open(tmp_path, "wb") as target:
+            for chunk in iter(lambda: source.read(COMPRESS_CHUNK_SIZE), b""):
+                target.write(compressor.compress(chunk))
+            target.write(compressor.flush())
+        os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(tmp_path, variant)
+
+
+def write_artifact(path, content, compress=True):
+    '''
+    Writes rendered content (e.g. of the published page) to the file and
+    (unless compress is False) its compressed variants, so serving it costs
+    no rendering and no compression.
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = _get_tmp_path(path)
+    with open(tmp_path, "wb") as f:
+        f.write(content.encode("utf-8"))
+    os.replace(tmp_path, path)
+    if compress:
+        precompress_file(path)
+
+
+def _get_tmp_path(path):
+    '''
+    Returns path of a temporary file next to the path, unique for the thread
+    so that concurrent writers (e.g. requests writing a missing body again)
+    do not replace each other's files halfway.
+    '''
+    return "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+
+
+def _is_variant_fresh(variant, stat):
+    try:
+        return os.stat(variant).st_mtime_ns == stat.st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+class RangeFile(object):
+    '''File-like object which reads only length bytes from the offset.'''
+
+    def __init__(self, file, offset, length):
+        self.file = file
+        self.file.seek(offset)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def serve_file(request, path, content_type=None):
+    '''
+    Returns response with the stored file. Supports conditional requests
+    (ETag, Last-Modified), single byte ranges and precompressed variants
+    (see precompress_file). When settings.SENDFILE_HEADER is set, the
+    transfer is left to the web server.
+    '''
+    stat = os.stat(path)
+    etag = "%x-%x" % (stat.st_mtime_ns, stat.st_size)
+    last_modified = int(stat.st_mtime)
+    if content_type is None:
+        content_type = mimetypes.guess_type(path)[0] or \
+            "application/octet-stream"
+
+    match = RANGE_RE.match(request.META.get("HTTP_RANGE", "").strip())
+    if match and not _if_range_matches(request, etag):
+        match = None
+
+    # Ranges are served from the file itself (not from variants).
+    encoding = None
+    if match is None:
+        accepted = _parse_accept_encoding(
+            request.META.get("HTTP_ACCEPT_ENCODING", "")
+        )
+        for name, suffix, _ in ENCODINGS:
+            if accepted.get(name, 0) > 0 and \
+                    _is_variant_fresh(path + suffix, stat):
+                encoding, path = name, path + suffix
+                etag = "%s-%s" % (etag, name)
+                break
+
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified
+    )
+    if response is not None:
+        return response
+
+    byte_range = None
+    if match is not None:
+        byte_range = _get_range(match, stat.st_size)
+        if byte_range is None:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = "bytes */%d" % stat.st_size
+            return response
+
+    sendfile_header = getattr(settings, "SENDFILE_HEADER", None)
+    if sendfile_header:
+        response = HttpResponse(content_type=content_type)
+        response[sendfile_header] = _get_sendfile_path(
+            sendfile_header, path
+        )
+    elif byte_range is not None:
+        start, end = byte_range
+        response = FileResponse(
+            RangeFile(open(path, "rb"), start, end - start + 1),
+            content_type=content_type, status=206
+        )
+        response["Content-Range"] = "bytes %d-%d/%d" % (
+            start, end, stat.st_size
+        )
+        response["Content-Length"] = end - start + 1
+    else:
+        response = FileResponse(open(path, "rb"), content_type=content_type)
+        response["Content-Length"] = os.path.getsize(path)
+
+    if encoding:
+        response["Content-Encoding"] = encoding
+    response["ETag"] = quote_etag(etag)
+    response["Last-Modified"] = http_date(last_modified)
+    response["Accept-Ranges"] = "bytes"
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
+
+
+def _parse_accept_encoding(header):
+    '''Returns dict with q-values of encodings in Accept-Encoding header.'''
+    accepted = dict()
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0
+        if name:
+            accepted[name.lower()] = q
+    return accepted
+
+
+def _if_range_matches(request, etag):
+    '''Returns False when If-Range refers to other version of the file.'''
+    if_range = request.META.get("HTTP_IF_RANGE")
+    return if_range is None or parse_etags(if_range) == [etag]
+
+
+def _get_range(match, size):
+    '''
+    Returns (start, end) of the range matched in the Range header, None if
+    the range is not satisfiable. Multiple ranges are not matched (whole
+    files are served instead).
+    '''
+    start, end = match.groups()
+    if not start:
+        if not end:
+            return None
+        # Suffix range: last N bytes.
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end or size - 1), size - 1)
+    if start >= size or start > end:
+        return None
+    return start, end
+
+
+def _get_sendfile_path(header, path):
+    '''Returns value of the header handing the file over to the server.'''
+    if header.lower() == "x-accel-redirect":
+        # nginx serves files from the internal location mapped to MEDIA_ROOT
+        relative_path = os.path.relpath(path, settings.MEDIA_ROOT)
+        return settings.SENDFILE_URL + relative_path.replace(os.sep, "/")
+    return path
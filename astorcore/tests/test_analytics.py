@@ -0,0 +1,254 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from importlib import import_module
+from io import StringIO
+
+from django.apps import apps
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils import timezone
+
+from astorcore.models import (
+    ContentPage, PageVisit, HourlyVisitRollup, DailyVisitRollup
+)
+from astorcore.analytics import (
+    rollup_visits, compact_visits, get_visit_stats, archive_visits,
+    read_archive, restore_visits
+)
+
+
+User = get_user_model()
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+class RollupVisitsTest(TestCase):
+
+    def setUp(self):
+        self.page = ContentPage.objects.create(title="Test Page")
+
+    def add_visit(self, timestamp, ip_address=None, user=None):
+        return PageVisit.objects.create(
+            page=self.page, timestamp=timestamp, ip_address=ip_address,
+            user=user
+        )
+
+    def test_rollup_aggregates_visits_by_hour_and_day(self):
+        user = User.objects.create_user(username="Test", password="test")
+        self.add_visit(utc(2017, 3, 1, 10, 5), "127.0.0.1")
+        self.add_visit(utc(2017, 3, 1, 10, 55), "127.0.0.2", user)
+        self.add_visit(utc(2017, 3, 1, 11, 0))
+        self.add_visit(utc(2017, 3, 2, 1, 0), "127.0.0.3")
+
+        self.assertEqual(rollup_visits(), 4)
+
+        self.assertEqual(
+            list(HourlyVisitRollup.objects.order_by("bucket").values_list(
+                "bucket", "visits", "unique_visitors", "authenticated_visits"
+            )), [
+                (utc(2017, 3, 1, 10), 2, 2, 1),
+                (utc(2017, 3, 1, 11), 1, 0, 0),
+                (utc(2017, 3, 2, 1), 1, 1, 0)
+            ]
+        )
+        self.assertEqual(
+            list(DailyVisitRollup.objects.order_by("bucket").values_list(
+                "bucket", "visits", "unique_visitors", "authenticated_visits"
+            )), [
+                (utc(2017, 3, 1), 3, 2, 1),
+                (utc(2017, 3, 2), 1, 1, 0)
+            ]
+        )
+
+    def test_rollup_is_incremental(self):
+        self.add_visit(utc(2017, 3, 1, 10, 5), "127.0.0.1")
+        rollup_visits()
+        self.add_visit(utc(2017, 3, 1, 10, 15), "127.0.0.2")
+        self.assertEqual(rollup_visits(), 1)
+        self.assertEqual(rollup_visits(), 0)
+        rollup = DailyVisitRollup.objects.get()
+        self.assertEqual((rollup.visits, rollup.unique_visitors), (2, 2))
+        self.assertFalse(PageVisit.objects.filter(rolled_up=False).exists())
+
+    def test_rollup_merges_sketches_of_visitors(self):
+        self.add_visit(utc(2017, 3, 1, 10, 5), "127.0.0.1")
+        self.add_visit(utc(2017, 3, 1, 11, 5), "127.0.0.2")
+        rollup_visits()
+        self.add_visit(utc(2017, 3, 1, 12, 5), "127.0.0.1")
+        rollup_visits()
+        self.assertEqual(DailyVisitRollup.objects.get().unique_visitors, 2)
+        self.add_visit(utc(2017, 3, 2, 12, 5), "127.0.0.3")
+        self.assertEqual(self.page.unique_visitors, 3)
+
+    def test_rollup_keeps_counts_of_rollups_without_sketch(self):
+        DailyVisitRollup.objects.create(
+            page=self.page, bucket=utc(2017, 3, 1), visits=20,
+            unique_visitors=10
+        )
+        self.add_visit(utc(2017, 3, 1, 10, 5), "127.0.0.1")
+        rollup_visits()
+        rollup = DailyVisitRollup.objects.get()
+        self.assertEqual((rollup.visits, rollup.unique_visitors), (21, 10))
+
+    def test_backfill_of_sketches_from_raw_visits(self):
+        backfill = import_module(
+            "astorcore.migrations.0012_backfill_visit_sketches"
+        ).backfill_sketches
+        self.add_visit(utc(2017, 3, 1, 10, 5), "127.0.0.1")
+        self.add_visit(utc(2017, 3, 1, 11, 5), "127.0.0.2")
+        self.add_visit(utc(2017, 3, 2, 10, 5), "127.0.0.3")
+        rollup_visits()
+        DailyVisitRollup.objects.update(sketch=b"", unique_visitors=1)
+        HourlyVisitRollup.objects.update(sketch=b"", unique_visitors=5)
+        PageVisit.objects.filter(timestamp__gte=utc(2017, 3, 2)).delete()
+
+        backfill(apps, None)
+
+        self.assertEqual(
+            list(DailyVisitRollup.objects.order_by("bucket").values_list(
+                "unique_visitors", flat=True
+            )), [2, 1]
+        )
+        self.assertEqual(
+            set(HourlyVisitRollup.objects.values_list(
+                "unique_visitors", flat=True
+            )), {5}
+        )
+        self.add_visit(utc(2017, 3, 1, 12, 5), "127.0.0.1")
+        rollup_visits()
+        self.assertEqual(
+            DailyVisitRollup.objects.get(bucket=utc(2017, 3, 1)).visits, 3
+        )
+        self.assertEqual(self.page.unique_visitors, 2)
+
+    def test_rollup_works_in_batches(self):
+        for i in range(5):
+            self.add_visit(utc(2017, 3, 1, i), "127.0.0.%d" % i)
+        self.assertEqual(rollup_visits(batch_size=2), 5)
+        self.assertEqual(DailyVisitRollup.objects.get().visits, 5)
+        self.assertEqual(HourlyVisitRollup.objects.count(), 5)
+
+    def test_compact_deletes_old_raw_visits_and_keeps_rollups(self):
+        now = utc(2017, 3, 31)
+        self.add_visit(utc(2017, 3, 1), "127.0.0.1")
+        self.add_visit(utc(2017, 3, 30), "127.0.0.2")
+        self.assertEqual(compact_visits(days=10, now=now), 1)
+        self.assertEqual(PageVisit.objects.count(), 1)
+        self.assertEqual(
+            sum(get_visit_stats([self.page]).values_list("visits", flat=True)),
+            2
+        )
+
+    def test_compact_requires_at_least_one_day(self):
+        with self.assertRaises(CommandError):
+            call_command("compact_visits", days=0, stdout=StringIO())
+
+    def test_get_visit_stats_filters_by_period_and_dates(self):
+        self.add_visit(utc(2017, 3, 1, 10), "127.0.0.1")
+        self.add_visit(utc(2017, 3, 2, 10), "127.0.0.2")
+        rollup_visits()
+        stats = get_visit_stats(
+            [self.page], period="hour", start=utc(2017, 3, 2)
+        )
+        self.assertEqual(
+            list(stats.values_list("bucket", flat=True)), 
+            [utc(2017, 3, 2, 10)]
+        )
+
+    def test_rebuild_visit_counts_includes_compacted_visits(self):
+        self.page.register_visit()
+        PageVisit.objects.update(timestamp=timezone.now() - timedelta(days=5))
+        call_command("compact_visits", days=1, stdout=StringIO())
+        self.assertEqual(PageVisit.objects.count(), 0)
+        self.page.register_visit()
+        call_command("rebuild_visit_counts", stdout=StringIO())
+        self.page.refresh_from_db()
+        self.assertEqual(self.page.visits_count, 2)
+
+
+class ArchiveVisitsTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.page = ContentPage.objects.create(title="Test Page")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def add_visit(self, timestamp, ip_address="127.0.0.1"):
+        return PageVisit.objects.create(
+            page=self.page, timestamp=timestamp, ip_address=ip_address,
+            user_agent="Agent", request_method="GET"
+        )
+
+    def test_archives_old_visits_to_monthly_files(self):
+        self.add_visit(utc(2017, 1, 10))
+        self.add_visit(utc(2017, 2, 10))
+        self.add_visit(utc(2017, 2, 20))
+        recent = self.add_visit(utc(2017, 4, 1))
+
+        count = archive_visits(self.directory, utc(2017, 3, 1), batch_size=2)
+
+        self.assertEqual(count, 3)
+        self.assertEqual(list(PageVisit.objects.all()), [recent])
+        self.assertEqual(
+            sorted(os.listdir(self.directory)), 
+            ["visits-2017-01.jsonl.gz", "visits-2017-02.jsonl.gz"]
+        )
+        records = list(read_archive(
+            os.path.join(self.directory, "visits-2017-02.jsonl.gz")
+        ))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]["ip_address"], "127.0.0.1")
+        self.assertEqual(records[0]["user_agent"], "Agent")
+        self.assertEqual(records[0]["request_method"], "GET")
+
+    def test_archived_visits_stay_in_rollups(self):
+        self.add_visit(utc(2017, 1, 10))
+        archive_visits(self.directory, utc(2017, 3, 1))
+        self.assertEqual(DailyVisitRollup.objects.get().visits, 1)
+
+    def test_restores_archived_visits(self):
+        visit = self.add_visit(utc(2017, 1, 10))
+        archive_visits(self.directory, utc(2017, 3, 1))
+        path = os.path.join(self.directory, "visits-2017-01.jsonl.gz")
+
+        stdout = StringIO()
+        call_command("restore_visits", path, stdout=stdout)
+        self.assertIn("Restored 1 visit(s)", stdout.getvalue())
+
+        restored = PageVisit.objects.get()
+        self.assertEqual(restored.pk, visit.pk)
+        self.assertEqual(restored.timestamp, visit.timestamp)
+        self.assertEqual(restored.ip_address, "127.0.0.1")
+        self.assertEqual(restored.user_agent, "Agent")
+        self.assertTrue(restored.rolled_up)
+
+    def test_restore_skips_existing_visits_and_deleted_pages(self):
+        self.add_visit(utc(2017, 1, 10))
+        other_page = ContentPage.objects.create(title="Other Page")
+        PageVisit.objects.create(page=other_page, timestamp=utc(2017, 1, 11))
+        archive_visits(self.directory, utc(2017, 3, 1))
+        path = os.path.join(self.directory, "visits-2017-01.jsonl.gz")
+        other_page.delete()
+
+        self.assertEqual(restore_visits([path]), 1)
+        self.assertEqual(restore_visits([path]), 0)
+
+    def test_command_parses_age_of_visits(self):
+        self.add_visit(timezone.now() - timedelta(days=10))
+        self.add_visit(timezone.now() - timedelta(days=3))
+        call_command(
+            "archive_visits", older_than="1w", directory=self.directory,
+            stdout=StringIO()
+        )
+        self.assertEqual(PageVisit.objects.count(), 1)
+        with self.assertRaises(CommandError):
+            call_command("archive_visits", older_than="week", 
+                         directory=self.directory, stdout=StringIO())
@@ -1,13 +1,21 @@
+import base64
 import unittest
 import json
+import re
+from datetime import datetime
 
+from django.conf import settings
+from django.db import connection
 from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.http.response import Http404
 from django.contrib.auth import get_user_model
+from django.utils.timezone import utc
 from taggit.models import Tag
 
-from astorcore.models import ContentPage, Comment
+from astorcore.models import Page, ContentPage, Comment, PageVisit
+from astorcore.analytics import rollup_visits
 from astorcore.views import (
     AnalysisList, AnalysisDetail, AnalysisCommentDetail,
     CommentReplyDetail
@@ -28,6 +36,26 @@ class SetupViewMixin(object):
         return view
 
 
+class QueryCountMixin(object):
+
+    def assertConstantQueries(self, url, add_objects, sizes=(1, 5)):
+        '''
+        Asserts that GET of the url runs the same number of queries whatever
+        the number of objects added by add_objects(n).
+        '''
+        counts = list()
+        for size in sizes:
+            add_objects(size)
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            counts.append(len(context.captured_queries))
+        self.assertEqual(
+            len(set(counts)), 1, 
+            "Number of queries depends on number of objects: %s" % counts
+        )
+
+
 class TagsTest(TestCase):
 
     def create_tags(self, tags):
@@ -125,6 +153,67 @@ class AnalysisListTest(SetupViewMixin, TestCase):
         self.assertCountEqual(ids, [ page1.id, page2.id ])
 
 
+class AnalysisPublishTest(TestCase):
+
+    def test_publishes_pages_of_logged_in_user(self):
+        user = User.objects.create_user(username="Test", password="test123")
+        page1 = user.add_page(ContentPage(title="Test Page #1"))
+        page2 = user.add_page(ContentPage(title="Test Page #2"))
+        self.client.login(username="Test", password="test123")
+
+        response = self.client.post(
+            reverse("api:analysis-publish"), 
+            data=json.dumps({"ids": [page1.pk, page2.pk]}),
+            content_type="application/json"
+        )
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode())
+        page1.refresh_from_db()
+        self.assertEqual(data["published"][0], 
+                         {"id": page1.pk, 
+                          "published_page": page1.published_page_id})
+        self.assertEqual(ContentPage.objects.filter(live=True).count(), 2)
+
+    def test_does_not_publish_pages_of_other_users(self):
+        user = User.objects.create_user(username="Test", password="test123")
+        other = User.objects.create_user(username="Other", password="other")
+        page = other.add_page(ContentPage(title="Test Page"))
+        self.client.login(username="Test", password="test123")
+
+        response = self.client.post(
+            reverse("api:analysis-publish"), data={"ids": [page.pk]}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ContentPage.objects.filter(live=True).count(), 0)
+
+    def test_unpublishes_pages(self):
+        user = User.objects.create_user(username="Test", password="test123")
+        page = user.add_page(ContentPage(title="Test Page"))
+        page.publish()
+        draft = user.add_page(ContentPage(title="Draft"))
+        self.client.login(username="Test", password="test123")
+
+        response = self.client.post(
+            reverse("api:analysis-publish"), 
+            data={"ids": [page.pk, draft.pk], "action": "unpublish"}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ContentPage.objects.count(), 2)
+        self.assertEqual(
+            json.loads(response.content.decode()), {"unpublished": [page.pk]}
+        )
+
+    def test_returns_403_for_anonymous_user(self):
+        page = ContentPage.objects.create(title="Test Page")
+        response = self.client.post(
+            reverse("api:analysis-publish"), data={"ids": [page.pk]}
+        )
+        self.assertEqual(response.status_code, 403)
+
+
 class AnalysisCommentDetailTest(SetupViewMixin, TestCase):
 
     def test_get_object_returns_correct_comment(self):
@@ -373,4 +462,308 @@ class CommentReplyListTest(TestCase):
 
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.content.decode())
-        self.assertEqual(len(data), 2)
\ No newline at end of file
+        self.assertEqual(len(data), 2)
+
+    def test_client_gets_all_replies_following_next_links(self):
+        page = ContentPage.objects.create(title="Test Page")
+        comment = page.add_comment(body="Test Comment")
+        replies = [ 
+            comment.reply(body="Test Reply #%d" % i) 
+            for i in range(settings.API_PAGE_SIZE + 1) 
+        ]
+
+        # The same way as getReplies (comments.ajax.js).
+        url = reverse("api:analysis-comment-reply-list",
+                      kwargs=dict(apk=page.pk, cpk=comment.pk))
+        ids = list()
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(
+                item["id"] for item in json.loads(response.content.decode())
+            )
+            url = KeysetPaginationTest.get_links(response).get("next")
+
+        self.assertEqual(ids, [ reply.pk for reply in replies ])
+
+    def test_returns_400_when_reply_is_too_deep(self):
+        page = ContentPage.objects.create(title="Test Page")
+        comment = page.add_comment(body="Test Comment")
+        Comment.objects.filter(pk=comment.pk).update(depth=Comment.MAX_DEPTH)
+        User.objects.create_user(username="Test", password="test123")
+        self.client.login(username="Test", password="test123")
+
+        response = self.client.post(
+            reverse("api:analysis-comment-reply-list", 
+                    kwargs=dict(apk=page.pk, cpk=comment.pk)),
+            data = dict(body="Test Reply")
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("parent", json.loads(response.content.decode()))
+        self.assertEqual(comment.replies.count(), 0)
+
+class CommentReplyBatchTest(TestCase):
+
+    def setUp(self):
+        self.page = ContentPage.objects.create(title="Test Page")
+        self.comments = [ self.page.add_comment(body="Comment #%d" % i)
+                          for i in range(3) ]
+        self.replies = [ comment.reply(body="Reply") 
+                         for comment in self.comments[:2] ]
+        self.reply_2 = self.replies[0].reply(body="Reply to reply")
+
+    def get(self, **params):
+        response = self.client.get(reverse("api:comment-reply-batch"), params)
+        if response.status_code == 200:
+            response.data = json.loads(response.content.decode())
+        return response
+
+    def test_returns_replies_grouped_by_comments(self):
+        ids = [ comment.pk for comment in self.comments ]
+        with self.assertNumQueries(1):
+            response = self.get(ids=",".join(map(str, ids)))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            { key: [ reply["id"] for reply in replies ] 
+              for key, replies in response.data.items() },
+            { str(self.comments[0].pk): [ self.replies[0].pk ],
+              str(self.comments[1].pk): [ self.replies[1].pk ],
+              str(self.comments[2].pk): [] }
+        )
+        self.assertEqual(
+            response.data[str(self.comments[0].pk)][0]["replies_count"], 1
+        )
+
+    def test_returns_replies_of_analysis_up_to_depth(self):
+        response = self.get(analysis=self.page.pk, depth=1)
+        self.assertEqual(len(response.data), 2)
+        self.assertNotIn(str(self.replies[0].pk), response.data)
+
+        response = self.get(analysis=self.page.pk)
+        self.assertEqual(
+            [ reply["id"] 
+              for reply in response.data[str(self.replies[0].pk)] ],
+            [ self.reply_2.pk ]
+        )
+
+    def test_rejects_invalid_parameters(self):
+        self.assertEqual(self.get().status_code, 400)
+        self.assertEqual(self.get(ids="1,a").status_code, 400)
+        self.assertEqual(self.get(analysis="a").status_code, 400)
+        ids = ",".join(map(str, range(1000)))
+        self.assertEqual(self.get(ids=ids).status_code, 400)
+
+
+class AnalysisVisitListTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="Test", 
+                                             password="test123")
+        self.page = self.user.add_page(ContentPage(title="Test Page"))
+        self.client.login(username="Test", password="test123")
+
+    def add_visit(self, page, timestamp, ip_address="127.0.0.1"):
+        return PageVisit.objects.create(
+            page=page, timestamp=timestamp, ip_address=ip_address,
+            user_agent="Agent", request_method="GET"
+        )
+
+    def get(self, **params):
+        response = self.client.get(
+            reverse("api:analysis-visit-list", kwargs={"apk": self.page.pk}),
+            params
+        )
+        if response.status_code == 200:
+            response.text = b"".join(response.streaming_content).decode()
+        return response
+
+    def test_streams_visits_as_ndjson(self):
+        self.page.publish()
+        visit = self.add_visit(
+            self.page.published_page, datetime(2017, 3, 1, tzinfo=utc)
+        )
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        rows = [ json.loads(line) for line in response.text.splitlines() ]
+        self.assertEqual(rows, [{
+            "id": visit.pk, "page": self.page.published_page_id, 
+            "timestamp": "2017-03-01T00:00:00Z", "user": None,
+            "ip_address": "127.0.0.1", "user_agent": "Agent", 
+            "request_method": "GET"
+        }])
+
+    def test_streams_visits_as_csv_filtered_by_date(self):
+        self.add_visit(self.page, datetime(2017, 3, 1, tzinfo=utc))
+        self.add_visit(self.page, datetime(2017, 3, 5, tzinfo=utc), "::1")
+        response = self.get(output="csv", start="2017-03-02")
+        lines = response.text.splitlines()
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertEqual(lines[0].split(",")[:3], ["id", "page", "timestamp"])
+        self.assertEqual(len(lines), 2)
+        self.assertIn("::1", lines[1])
+
+    def test_streams_rollups_when_bucket_is_given(self):
+        self.add_visit(self.page, datetime(2017, 3, 1, 10, tzinfo=utc))
+        self.add_visit(self.page, datetime(2017, 3, 1, 12, tzinfo=utc))
+        rollup_visits()
+        rows = [ json.loads(line) 
+                 for line in self.get(bucket="day").text.splitlines() ]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["visits"], 2)
+        self.assertEqual(rows[0]["bucket"], "2017-03-01T00:00:00Z")
+
+    def test_rejects_invalid_parameters(self):
+        self.assertEqual(self.get(output="xml").status_code, 400)
+        self.assertEqual(self.get(bucket="year").status_code, 400)
+        self.assertEqual(self.get(start="yesterday").status_code, 400)
+
+    def test_returns_404_for_analyses_of_other_users(self):
+        other = User.objects.create_user(username="Other", password="other")
+        self.page = other.add_page(ContentPage(title="Other Page"))
+        self.assertEqual(self.get().status_code, 404)
+
+    def test_requires_authentication(self):
+        self.client.logout()
+        self.assertEqual(self.get().status_code, 403)
+
+
+class KeysetPaginationTest(TestCase):
+
+    def setUp(self):
+        self.page = ContentPage.objects.create(title="Test Page")
+        self.comments = [ 
+            self.page.add_comment(body="Comment #%d" % i) for i in range(5) 
+        ]
+        self.url = reverse("api:analysis-comment-list", 
+                           kwargs=dict(apk=self.page.pk))
+
+    @staticmethod
+    def get_links(response):
+        return dict(
+            (rel, url) for url, rel in 
+            re.findall(r'<([^>]+)>; rel="(\w+)"', response.get("Link", ""))
+        )
+
+    def get_ids(self, response):
+        return [ item["id"] for item in json.loads(response.content.decode()) ]
+
+    def test_returns_first_page_with_link_to_next_page(self):
+        response = self.client.get(self.url, {"page_size": 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.get_ids(response), [ c.pk for c in self.comments[:2] ]
+        )
+        links = self.get_links(response)
+        self.assertIn("next", links)
+        self.assertNotIn("prev", links)
+
+    def test_follows_next_and_prev_links(self):
+        response = self.client.get(self.url, {"page_size": 2})
+        ids = self.get_ids(response)
+        while "next" in self.get_links(response):
+            response = self.client.get(self.get_links(response)["next"])
+            ids.extend(self.get_ids(response))
+        self.assertEqual(ids, [ c.pk for c in self.comments ])
+        self.assertEqual(self.get_ids(response), [ self.comments[4].pk ])
+
+        response = self.client.get(self.get_links(response)["prev"])
+        self.assertEqual(
+            self.get_ids(response), [ c.pk for c in self.comments[2:4] ]
+        )
+        links = self.get_links(response)
+        self.assertIn("next", links)
+        self.assertIn("prev", links)
+
+    def test_limits_page_size(self):
+        with self.settings(API_MAX_PAGE_SIZE=3):
+            response = self.client.get(self.url, {"page_size": 100})
+        self.assertEqual(len(self.get_ids(response)), 3)
+
+    def test_returns_404_for_invalid_cursor(self):
+        response = self.client.get(self.url, {"cursor": "invalid"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_paginates_analyses_by_latest_changes(self):
+        pages = [ ContentPage.objects.create(title="Page #%d" % i) 
+                  for i in range(3) ]
+        url = reverse("api:analysis-list")
+        response = self.client.get(url, {"page_size": 2})
+        ids = self.get_ids(response)
+        response = self.client.get(self.get_links(response)["next"])
+        ids.extend(self.get_ids(response))
+        self.assertEqual(
+            ids, [ page.pk for page in reversed([self.page] + pages) ]
+        )
+
+    def test_paginates_analyses_never_changed(self):
+        Page.objects.bulk_create([ Page() for i in range(3) ])
+        url = reverse("api:analysis-list")
+        response = self.client.get(url, {"page_size": 2})
+        ids = self.get_ids(response)
+        while "next" in self.get_links(response):
+            response = self.client.get(self.get_links(response)["next"])
+            self.assertEqual(response.status_code, 200)
+            ids.extend(self.get_ids(response))
+        self.assertCountEqual(ids, Page.objects.values_list("pk", flat=True))
+
+    def test_returns_404_for_cursor_with_null_key(self):
+        cursor = base64.urlsafe_b64encode(b'[[null, 1], false]').decode()
+        response = self.client.get(reverse("api:analysis-list"), 
+                                   {"cursor": cursor})
+        self.assertEqual(response.status_code, 404)
+
+
+class QueryCountTest(QueryCountMixin, TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="Test", 
+                                             password="test123")
+        self.page = self.user.add_page(ContentPage(title="Test Page"))
+        self.comment = self.page.add_comment(body="Comment", author=self.user)
+
+    def add_comments(self, n):
+        for i in range(n):
+            self.page.add_comment(body="Comment", author=self.user)\
+                .reply(body="Reply", author=self.user)
+
+    def add_replies(self, n):
+        for i in range(n):
+            self.comment.reply(body="Reply", author=self.user)\
+                .reply(body="Reply", author=self.user)
+
+    def test_comment_list(self):
+        self.assertConstantQueries(
+            reverse("api:comment-list"), self.add_comments
+        )
+
+    def test_analysis_comment_list(self):
+        self.assertConstantQueries(
+            reverse("api:analysis-comment-list", kwargs={"apk": self.page.pk}),
+            self.add_comments
+        )
+
+    def test_comment_reply_list(self):
+        self.assertConstantQueries(
+            reverse("api:comment-reply-list", kwargs={"cpk": self.comment.pk}),
+            self.add_replies
+        )
+
+    def test_comment_detail(self):
+        self.assertConstantQueries(
+            reverse("api:comment-detail", kwargs={"cpk": self.comment.pk}),
+            self.add_replies
+        )
+
+    def test_analysis_list(self):
+        def add_pages(n):
+            for i in range(n):
+                self.user.add_page(ContentPage(title="Page"))
+        self.assertConstantQueries(reverse("api:analysis-list"), add_pages)
+
+    def test_analysis_detail(self):
+        self.assertConstantQueries(
+            reverse("api:analysis-detail", kwargs={"apk": self.page.pk}),
+            self.add_comments
+        )
@@ -1,12 +1,36 @@
 import unittest
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-from django.test import TestCase, RequestFactory
+from django.test import (
+    TestCase, TransactionTestCase, RequestFactory, override_settings
+)
+from django.core.management import call_command
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
 from django.urls import reverse
+from django.db import models
+from django.db.models.signals import post_migrate
+from django.apps import apps
+from django.db import connection, transaction, DatabaseError
+from django.test.utils import CaptureQueriesContext
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
 
 from astorcore.models import (
-    ContentPage, Page, Comment, PageVisit
+    ContentPage, Page, Comment, PageVisit, HTMLUploadPage, PageRevision, 
+    DailyVisitRollup, UserAgent, page_types
+)
+from astorcore.decorators import (
+    register_form, get_form, get_serializer, get_page_model
+)
+from astorcore.serializers import ContentPageSerializer
+from astoraccount.forms import ContentPageForm, HTMLUploadPageForm
+from astorcore.utils import (
+    get_clone_plan, bulk_insert_ignore, WriteBuffer, HyperLogLog, LRUCache,
+    pack_ip, unpack_ip, CLONE_SKIP_FIELDS
 )
 
 
@@ -34,6 +58,118 @@ class PageModelTest(TestCase):
         self.assertIs(type(page.specific), ContentPage)
 
 
+class PageTypesTest(TestCase):
+
+    def setUp(self):
+        page_types.clear()
+        page_types.load()
+
+    def test_creating_page_does_not_hit_database(self):
+        with self.assertNumQueries(0):
+            page = ContentPage(title="Test Page")
+        self.assertEqual(
+            page.content_type, ContentType.objects.get_for_model(ContentPage)
+        )
+
+    def test_specific_uses_preloaded_content_types(self):
+        page = ContentPage.objects.create(title="Test Page")
+        page = Page.objects.get(pk=page.pk)
+        with self.assertNumQueries(1):
+            self.assertIsInstance(page.specific, ContentPage)
+
+    def test_counts_hits_and_misses(self):
+        hits, misses = page_types.hits, page_types.misses
+        page_types.get_id(ContentPage)
+        page_types.get_id(User)
+        page_types.get_id(User)
+        self.assertEqual(page_types.hits - hits, 2)
+        self.assertEqual(page_types.misses - misses, 1)
+
+    def test_post_migrate_invalidates_map(self):
+        page_types.get_id(User)
+        app_config = apps.get_app_config("astorcore")
+        post_migrate.send(
+            sender=app_config, app_config=app_config, verbosity=0,
+            interactive=False, using="default", apps=apps
+        )
+        misses = page_types.misses
+        page_types.get_id(User)
+        self.assertEqual(page_types.misses - misses, 1)
+        with self.assertNumQueries(0):
+            page_types.get_id(ContentPage)
+
+    def test_warm_leaves_loading_to_lookups_without_database(self):
+        with mock.patch.object(
+                ContentType.objects, "get_for_models", 
+                side_effect=DatabaseError):
+            page_types.warm()
+        self.assertIsNotNone(page_types.get_id(ContentPage))
+
+
+class RegistryTest(TestCase):
+
+    def test_finds_forms_and_serializers_of_models(self):
+        self.assertEqual(get_form(ContentPage), ContentPageForm)
+        self.assertEqual(get_form(HTMLUploadPage), HTMLUploadPageForm)
+        self.assertEqual(get_serializer(ContentPage), ContentPageSerializer)
+        self.assertIsNone(get_form(Page))
+
+    def test_finds_page_models_by_content_types(self):
+        content_type = ContentType.objects.get_for_model(HTMLUploadPage)
+        self.assertEqual(get_page_model(content_type.pk), HTMLUploadPage)
+
+    def test_registries_are_frozen_after_loading_of_apps(self):
+        with self.assertRaises(RuntimeError):
+            register_form(ContentPageForm)
+
+
+class PageQuerySetTest(TestCase):
+
+    def create_pages(self):
+        return [
+            ContentPage.objects.create(title="Content #1"),
+            HTMLUploadPage.objects.create(title="Upload #1", file="test.html"),
+            ContentPage.objects.create(title="Content #2"),
+            HTMLUploadPage.objects.create(title="Upload #2", file="test.html")
+        ]
+
+    def test_specific_returns_pages_of_specific_types(self):
+        pages = self.create_pages()
+        specific_pages = list(Page.objects.order_by("pk").specific())
+        self.assertEqual(
+            [ type(page) for page in specific_pages ],
+            [ type(page) for page in pages ]
+        )
+
+    def test_specific_keeps_original_order(self):
+        pages = self.create_pages()
+        specific_pages = list(Page.objects.order_by("-pk").specific())
+        self.assertEqual(
+            [ page.pk for page in specific_pages ],
+            [ page.pk for page in reversed(pages) ]
+        )
+
+    def test_specific_runs_one_query_per_page_type(self):
+        self.create_pages()
+        list(Page.objects.all().specific()) # warm up content types cache
+        with self.assertNumQueries(3):
+            list(Page.objects.all().specific())
+
+    def test_specific_preserves_annotations(self):
+        page = ContentPage.objects.create(title="Test Page")
+        page.register_visit()
+        specific_page = Page.objects.annotate(
+            num_visits=models.Count("visits")
+        ).specific().first()
+        self.assertIsInstance(specific_page, ContentPage)
+        self.assertEqual(specific_page.num_visits, 1)
+
+    def test_specific_works_with_related_manager(self):
+        user = User.objects.create(username="Test", password="test")
+        page = user.add_page(instance=ContentPage(title="Test Page"))
+        self.assertEqual(list(user.pages.all().specific()), [page])
+
+
 class ContentPageTest(TestCase):
 
     def test_publish_creates_new_page_with_the_same_data(self):
@@ -115,6 +251,83 @@ class ContentPageTest(TestCase):
         pub_page = page2.publish()
         self.assertEqual(ContentPage.objects.count(), 3)
 
+    def test_publish_copies_tags(self):
+        page = ContentPage.objects.create(title="My First Page")
+        page.tags.add("entry", "intro")
+        pub_page = page.publish()
+        self.assertCountEqual(pub_page.tags.names(), ["entry", "intro"])
+        self.assertCountEqual(page.tags.names(), ["entry", "intro"])
+
+    def test_publish_does_not_copy_comments_and_visits(self):
+        page = ContentPage.objects.create(title="My First Page")
+        page.add_comment(body="Comment #1").reply(body="Reply #1")
+        page.register_visit()
+        pub_page = page.publish()
+        self.assertEqual(pub_page.comments.count(), 0)
+        self.assertEqual(pub_page.visits.count(), 0)
+        self.assertEqual(Comment.objects.count(), 2)
+
+    def test_publish_runs_the_same_queries_regardless_of_related_objects(self):
+        page1 = ContentPage.objects.create(title="Page #1")
+        page2 = ContentPage.objects.create(title="Page #2")
+        for i in range(5):
+            page2.add_comment(body="Comment #{:d}".format(i))
+        with CaptureQueriesContext(connection) as queries1:
+            page1.publish()
+        with CaptureQueriesContext(connection) as queries2:
+            page2.publish()
+        self.assertEqual(len(queries1), len(queries2))
+
+    def test_republish_keeps_published_page_pk(self):
+        page = ContentPage.objects.create(title="My First Page")
+        pub_page = page.publish()
+        page.title = "Updated Title"
+        page.save()
+        new_pub_page = page.publish()
+        self.assertEqual(new_pub_page.pk, pub_page.pk)
+        self.assertEqual(
+            ContentPage.objects.get(pk=pub_page.pk).title, "Updated Title"
+        )
+
+    def test_republish_keeps_comments_and_visits_of_published_page(self):
+        page = ContentPage.objects.create(title="My First Page")
+        pub_page = page.publish()
+        pub_page.add_comment(body="Nice page.")
+        pub_page.register_visit()
+        page.publish()
+        self.assertEqual(pub_page.comments.count(), 1)
+        self.assertEqual(pub_page.visits.count(), 1)
+
+    def test_republish_updates_tags_of_published_page(self):
+        page = ContentPage.objects.create(title="My First Page")
+        page.tags.add("one", "two")
+        pub_page = page.publish()
+        page.tags.remove("one")
+        page.tags.add("three")
+        page.publish()
+        self.assertCountEqual(pub_page.tags.names(), ["two", "three"])
+
+    def test_republish_without_changes_does_not_update_published_page(self):
+        page = ContentPage.objects.create(title="My First Page")
+        pub_page = page.publish()
+        with CaptureQueriesContext(connection) as queries:
+            page.publish()
+        updates = [
+            query["sql"] for query in queries 
+            if query["sql"].startswith('UPDATE "astorcore_contentpage"')
+        ]
+        self.assertEqual(len(updates), 1) # the draft only
+
+    def test_republish_not_in_place_creates_new_published_page(self):
+        page = ContentPage.objects.create(title="My First Page")
+        pub_page = page.publish()
+        new_pub_page = page.publish(in_place=False)
+        self.assertNotEqual(new_pub_page.pk, pub_page.pk)
+        self.assertEqual(ContentPage.objects.count(), 2)
+
+    def test_clone_plan_is_compiled_once_per_model(self):
+        self.assertIs(get_clone_plan(ContentPage), get_clone_plan(ContentPage))
+
     def test_can_add_tags_to_page(self):
         user = User.objects.create_user(username="Test", password="test")
         page = user.add_page(ContentPage(title="My First Entry"))
@@ -142,8 +355,96 @@ class ContentPageTest(TestCase):
         self.assertEqual(page.comments.all()[0].body, comment.body)
 
 
+class PageRevisionTest(TestCase):
+
+    def test_saving_draft_creates_revision(self):
+        page = ContentPage.objects.create(title="My First Page")
+        page.body = "Body"
+        page.save_draft()
+        self.assertEqual(page.revisions.count(), 2)
+        self.assertEqual(
+            page.revisions.order_by("-pk").first().get_data()["body"], "Body"
+        )
+
+    def test_does_not_create_revision_when_nothing_changed(self):
+        page = ContentPage.objects.create(title="My First Page")
+        page.save()
+        page.save()
+        self.assertEqual(page.revisions.count(), 1)
+
+    def test_published_page_has_no_revisions(self):
+        page = ContentPage.objects.create(title="My First Page")
+        pub_page = page.publish()
+        self.assertEqual(pub_page.revisions.count(), 0)
+
+    def test_revisions_are_delta_encoded(self):
+        body = "".join("Line #{:d}\n".format(i) for i in range(1000))
+        page = ContentPage.objects.create(title="My First Page", body=body)
+        page.body = body + "The last line.\n"
+        page.save()
+        first, second = page.revisions.order_by("pk")
+        self.assertEqual(second.base, first)
+        self.assertLess(len(second.content), 100)
+        self.assertEqual(second.get_data()["body"], page.body)
+        self.assertEqual(first.get_data()["body"], body)
+
+    def test_stores_full_snapshot_every_keyframe_interval(self):
+        page = ContentPage.objects.create(title="Title #0")
+        for i in range(1, PageRevision.KEYFRAME_INTERVAL + 1):
+            page.title = "Title #{:d}".format(i)
+            page.save()
+        revision = page.revisions.order_by("-pk").first()
+        self.assertEqual(revision.depth, 0)
+        self.assertIsNone(revision.base)
+        self.assertEqual(revision.get_data()["title"], page.title)
+
+    def test_publish_points_live_revision_to_the_latest_revision(self):
+        page = ContentPage.objects.create(title="My First Page")
+        page.publish()
+        page.refresh_from_db()
+        self.assertEqual(
+            page.live_revision, page.revisions.order_by("-pk").first()
+        )
+
+    def test_revert_restores_content_of_revision(self):
+        page = ContentPage.objects.create(title="Old Title", body="Old Body")
+        revision = page.revisions.first()
+        page.title, page.body = "New Title", "New Body"
+        page.save()
+        page.revert(revision)
+        page = ContentPage.objects.get(pk=page.pk)
+        self.assertEqual(page.title, "Old Title")
+        self.assertEqual(page.body, "Old Body")
+
+    def test_rollback_discards_unpublished_changes(self):
+        page = ContentPage.objects.create(title="Published Title")
+        page.publish()
+        page.title = "Draft Title"
+        page.save()
+        page.rollback()
+        self.assertEqual(
+            ContentPage.objects.get(pk=page.pk).title, "Published Title"
+        )
+
+    def test_rollback_keeps_current_tags(self):
+        page = ContentPage.objects.create(title="Published Title")
+        page.tags.add("old")
+        page.publish()
+        page.tags.set("new")
+        page.rollback()
+        self.assertEqual(list(page.tags.names()), ["new"])
+
+    def test_skip_fields_include_fields_not_copied_when_publishing(self):
+        self.assertTrue(
+            set(CLONE_SKIP_FIELDS).issubset(PageRevision.SKIP_FIELDS)
+        )
+
+
 class PageVisitTest(TestCase):
 
+    def setUp(self):
+        UserAgent.cache.clear()
+
     def test_register_visit_creates_new_pagevisit(self):
         page = ContentPage.objects.create(title="Test Page")
         page.register_visit()
@@ -186,14 +487,290 @@ class PageVisitTest(TestCase):
         page.register_visit()
         self.assertEqual(page.visits.count(), 2)
 
-    def test_ignores_multiple_visits_from_the_same_ip(self):
+    def test_counts_multiple_visits_from_the_same_ip_as_one_visitor(self):
         page = ContentPage.objects.create(title="Test Page")
         request = RequestFactory().get("/fake_url")
         request.user = AnonymousUser()
         request.META = dict(REMOTE_ADDR="127.0.0.1")
         page.register_visit(request)
         page.register_visit(request)
-        self.assertEqual(page.visits.count(), 1)
+        self.assertEqual(page.visits.count(), 2)
+        self.assertEqual(page.unique_visitors, 1)
+
+
+class CompactPageVisitTest(TestCase):
+
+    def test_stores_packed_ip_address(self):
+        page = ContentPage.objects.create(title="Test Page")
+        PageVisit.objects.create(page=page, ip_address="127.0.0.1")
+        PageVisit.objects.create(page=page, ip_address="::1")
+        self.assertEqual(
+            sorted(len(visit.ip) for visit in PageVisit.objects.all()), 
+            [4, 16]
+        )
+        self.assertEqual(
+            sorted(visit.ip_address for visit in PageVisit.objects.all()),
+            ["127.0.0.1", "::1"]
+        )
+
+    def test_pack_ip_ignores_invalid_addresses(self):
+        self.assertIsNone(pack_ip("unknown"))
+        self.assertEqual(unpack_ip(pack_ip("10.0.0.1")), "10.0.0.1")
+
+    def test_interns_user_agents(self):
+        page = ContentPage.objects.create(title="Test Page")
+        request = RequestFactory().get("/fake_url", HTTP_USER_AGENT="Agent")
+        page.register_visit(request)
+        page.register_visit(request)
+        self.assertEqual(UserAgent.objects.count(), 1)
+        visit = PageVisit.objects.first()
+        self.assertEqual(visit.user_agent, "Agent")
+        self.assertEqual(visit.request_method, "GET")
+
+    def test_unknown_request_method_is_not_stored(self):
+        visit = PageVisit(request_method="BREW")
+        self.assertIsNone(visit.method)
+        self.assertIsNone(visit.request_method)
+
+
+class UserAgentCacheTest(TransactionTestCase):
+
+    def setUp(self):
+        UserAgent.cache.clear()
+
+    def tearDown(self):
+        UserAgent.cache.clear()
+
+    def test_get_id_looks_up_user_agent_once(self):
+        pk = UserAgent.get_id("Agent")
+        with self.assertNumQueries(0):
+            self.assertEqual(UserAgent.get_id("Agent"), pk)
+
+    def test_does_not_cache_rolled_back_user_agents(self):
+        try:
+            with transaction.atomic():
+                UserAgent.get_id("Agent")
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertIsNone(UserAgent.cache.get("Agent"))
+
+    def test_post_migrate_clears_cache(self):
+        UserAgent.get_id("Agent")
+        app_config = apps.get_app_config("astorcore")
+        post_migrate.send(
+            sender=app_config, app_config=app_config, verbosity=0,
+            interactive=False, using="default", apps=apps
+        )
+        self.assertIsNone(UserAgent.cache.get("Agent"))
+
+
+class LRUCacheTest(TestCase):
+
+    def test_evicts_least_recently_used_items(self):
+        cache = LRUCache(max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.get("a"), cache.get("c")), (1, 3))
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+
+class VisitsCountTest(TestCase):
+
+    def test_register_visit_increments_visits_count(self):
+        page = ContentPage.objects.create(title="Test Page")
+        page.register_visit()
+        page.register_visit()
+        page.refresh_from_db()
+        self.assertEqual(page.visits_count, 2)
+
+    def test_insert_many_increments_counters_by_inserted_visits(self):
+        page1 = ContentPage.objects.create(title="Page #1")
+        page2 = ContentPage.objects.create(title="Page #2")
+        PageVisit.insert_many([
+            PageVisit(page=page1, ip_address="127.0.0.1"),
+            PageVisit(page=page1, ip_address="127.0.0.2"),
+            PageVisit(page=page2, ip_address="127.0.0.1")
+        ])
+        page1.refresh_from_db()
+        page2.refresh_from_db()
+        self.assertEqual(page1.visits_count, 2)
+        self.assertEqual(page2.visits_count, 1)
+
+    def test_save_of_stale_page_keeps_visits_count(self):
+        page = ContentPage.objects.create(title="Test Page")
+        stale_page = ContentPage.objects.get(pk=page.pk)
+        page.register_visit()
+        stale_page.title = "Edited Title"
+        stale_page.save()
+        page.refresh_from_db()
+        self.assertEqual(page.title, "Edited Title")
+        self.assertEqual(page.visits_count, 1)
+
+    def test_publish_does_not_copy_visits_count(self):
+        page = ContentPage.objects.create(title="Test Page")
+        page.publish()
+        page.published_page.register_visit()
+        page.publish()
+        page.published_page.refresh_from_db()
+        self.assertEqual(page.published_page.visits_count, 1)
+
+    def test_rebuild_visit_counts_fixes_counters(self):
+        page1 = ContentPage.objects.create(title="Page #1")
+        page2 = ContentPage.objects.create(title="Page #2")
+        page1.register_visit()
+        page1.register_visit()
+        Page.objects.filter(pk=page1.pk).update(visits_count=0)
+        Page.objects.filter(pk=page2.pk).update(visits_count=5)
+        stdout = StringIO()
+        call_command("rebuild_visit_counts", stdout=stdout)
+        self.assertIn("Found 2 page(s)", stdout.getvalue())
+        self.assertEqual(
+            dict(Page.objects.values_list("pk", "visits_count")),
+            {page1.pk: 2, page2.pk: 0}
+        )
+
+
+class HyperLogLogTest(TestCase):
+
+    def test_estimates_number_of_distinct_values(self):
+        sketch = HyperLogLog()
+        for i in range(10000):
+            sketch.add("visitor-%d" % (i % 5000))
+        self.assertAlmostEqual(sketch.count(), 5000, delta=5000 * 0.1)
+
+    def test_count_of_small_sets_is_exact_enough(self):
+        sketch = HyperLogLog()
+        for value in ["a", "b", "c", "a"]:
+            sketch.add(value)
+        self.assertEqual(sketch.count(), 3)
+
+    def test_merged_sketch_estimates_union(self):
+        sketch1, sketch2 = HyperLogLog(), HyperLogLog()
+        for i in range(3000):
+            sketch1.add(str(i))
+            sketch2.add(str(i + 1000))
+        sketch1.merge(sketch2)
+        self.assertAlmostEqual(sketch1.count(), 4000, delta=4000 * 0.1)
+
+    def test_serialization(self):
+        sketch = HyperLogLog()
+        sketch.add("a")
+        content = sketch.to_bytes()
+        self.assertLess(len(content), 100)
+        self.assertEqual(HyperLogLog.from_bytes(content).count(), 1)
+        self.assertEqual(HyperLogLog.from_bytes(b"").count(), 0)
+
+
+class VisitBufferTest(TestCase):
+
+    def create_visit(self, page, ip_address):
+        return PageVisit(page=page, ip_address=ip_address)
+
+    def test_bulk_insert_ignore_skips_duplicated_rows(self):
+        page = ContentPage.objects.create(title="Test Page")
+        bucket = timezone.now()
+        DailyVisitRollup.objects.create(page=page, bucket=bucket)
+        inserted = bulk_insert_ignore(DailyVisitRollup, [
+            DailyVisitRollup(page=page, bucket=bucket),
+            DailyVisitRollup(page=page, bucket=bucket + timedelta(days=1)),
+            DailyVisitRollup(page=page, bucket=bucket + timedelta(days=1))
+        ])
+        self.assertEqual(inserted, 1)
+        self.assertEqual(DailyVisitRollup.objects.count(), 2)
+
+    def test_flush_inserts_buffered_visits_with_single_query(self):
+        page = ContentPage.objects.create(title="Test Page")
+        buffer = WriteBuffer(PageVisit, background=False)
+        for i in range(3):
+            buffer.put(self.create_visit(page, "127.0.0.%d" % i))
+        self.assertEqual(page.visits.count(), 0)
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(buffer.flush(), 3)
+        inserts = [ query for query in context.captured_queries 
+                    if query["sql"].startswith("INSERT") ]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(page.visits.count(), 3)
+        self.assertEqual(buffer.flushed, 3)
+        self.assertEqual(buffer.flush(), 0)
+
+    def test_flush_counts_inserted_rows(self):
+        page = ContentPage.objects.create(title="Test Page")
+        visit = PageVisit.objects.create(page=page)
+        buffer = WriteBuffer(PageVisit, background=False)
+        buffer.put(PageVisit(pk=visit.pk, page=page))
+        buffer.put(PageVisit(pk=visit.pk + 1, page=page))
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(buffer.flushed, 1)
+
+    def test_flush_inserts_batches_of_batch_size(self):
+        page = ContentPage.objects.create(title="Test Page")
+        buffer = WriteBuffer(PageVisit, batch_size=2, background=False)
+        for i in range(5):
+            buffer.put(self.create_visit(page, "127.0.0.%d" % i))
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(buffer.flush(), 5)
+        inserts = [ query for query in context.captured_queries 
+                    if query["sql"].startswith("INSERT") ]
+        self.assertEqual(len(inserts), 3)
+
+    def test_buffered_visits_resolve_user_agents_when_flushed(self):
+        page = ContentPage.objects.create(title="Test Page")
+        request = RequestFactory().get("/fake_url", HTTP_USER_AGENT="Agent")
+        request.user = AnonymousUser()
+        buffer = WriteBuffer(PageVisit, background=False, 
+                             insert=PageVisit.insert_many)
+        with override_settings(BUFFER_PAGE_VISITS=True), \
+             mock.patch("astorcore.models.visit_buffer", buffer), \
+             self.assertNumQueries(0):
+            page.register_visit(request)
+            page.register_visit(request)
+        buffer.flush()
+        self.assertEqual(UserAgent.objects.count(), 1)
+        self.assertEqual(
+            [ visit.user_agent for visit in page.visits.all() ], 
+            ["Agent", "Agent"]
+        )
+
+    def test_put_drops_visits_when_buffer_is_full(self):
+        page = ContentPage.objects.create(title="Test Page")
+        buffer = WriteBuffer(
+            PageVisit, max_size=2, block_timeout=0, background=False
+        )
+        results = [ buffer.put(self.create_visit(page, "127.0.0.%d" % i))
+                    for i in range(3) ]
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(buffer.dropped, 1)
+        buffer.flush()
+        self.assertEqual(page.visits.count(), 2)
+
+    def test_register_visit_puts_visit_into_buffer(self):
+        page = ContentPage.objects.create(title="Test Page")
+        request = RequestFactory().get("/fake_url")
+        request.user = AnonymousUser()
+        request.META = dict(REMOTE_ADDR="127.0.0.1")
+        buffer = WriteBuffer(PageVisit, background=False)
+        with override_settings(BUFFER_PAGE_VISITS=True), \
+             mock.patch("astorcore.models.visit_buffer", buffer):
+            page.register_visit(request)
+            page.register_visit(request)
+        self.assertEqual(page.visits.count(), 0)
+        buffer.flush()
+        self.assertEqual(page.visits.count(), 2)
+        self.assertEqual(buffer.flushed, 2)
+
+    def test_background_thread_flushes_buffer(self):
+        buffer = WriteBuffer(PageVisit, interval=0.01)
+        with mock.patch.object(buffer, "flush") as flush:
+            buffer.start()
+            buffer.stop()
+        self.assertTrue(flush.called)
+        self.assertIsNone(buffer._thread)
+
 
 class CommentTest(TestCase):
 
@@ -208,4 +785,152 @@ class CommentTest(TestCase):
         reply = comment.reply(body="Comment #2")
         self.assertEqual(Comment.objects.count(), 2)
         self.assertEqual(reply.parent, comment)
-        self.assertIn(reply, comment.replies.all())
\ No newline at end of file
+        self.assertIn(reply, comment.replies.all())
+
+
+    def test_comments_get_materialized_paths(self):
+        user, page = self.create_user_and_page()
+        comment = page.add_comment(body="Comment #1")
+        reply = comment.reply(body="Comment #2")
+        comment.refresh_from_db()
+        reply.refresh_from_db()
+        self.assertEqual(comment.path, Comment.encode_step(comment.pk))
+        self.assertEqual(
+            reply.path, comment.path + Comment.encode_step(reply.pk)
+        )
+        self.assertEqual((comment.depth, reply.depth), (0, 1))
+        self.assertEqual(reply.root_page_id, page.pk)
+
+    def test_encode_step_keeps_order_of_pks(self):
+        steps = [ Comment.encode_step(pk) for pk in (1, 35, 36, 1000, 10**6) ]
+        self.assertEqual(steps, sorted(steps))
+        self.assertTrue(all(len(step) == Comment.PATH_STEP for step in steps))
+
+    def create_tree(self, page):
+        comment1 = page.add_comment(body="#1")
+        reply11 = comment1.reply(body="#1.1")
+        reply111 = reply11.reply(body="#1.1.1")
+        comment2 = page.add_comment(body="#2")
+        reply12 = comment1.reply(body="#1.2")
+        return comment1, reply11, reply111, comment2, reply12
+
+    def test_get_tree_loads_tree_with_single_query(self):
+        user, page = self.create_user_and_page()
+        comment1, reply11, reply111, comment2, reply12 = self.create_tree(page)
+        with self.assertNumQueries(1):
+            tree = Comment.get_tree(page)
+            self.assertEqual(tree, [comment1, comment2])
+            self.assertEqual(tree[0].children, [reply11, reply12])
+            self.assertEqual(tree[0].children[0].children, [reply111])
+            self.assertEqual(tree[1].children, [])
+            self.assertEqual(tree[0].author, None)
+
+    def test_get_tree_limits_depth(self):
+        user, page = self.create_user_and_page()
+        comment1, reply11, reply111, comment2, reply12 = self.create_tree(page)
+        tree = Comment.get_tree(page, max_depth=1)
+        self.assertEqual(tree[0].children, [reply11, reply12])
+        self.assertEqual(tree[0].children[0].children, [])
+
+    def test_moving_comment_moves_its_replies(self):
+        user, page = self.create_user_and_page()
+        comment1, reply11, reply111, comment2, reply12 = self.create_tree(page)
+        reply11.parent = comment2
+        reply11.save()
+        reply111.refresh_from_db()
+        self.assertEqual(
+            reply111.path, 
+            comment2.path + Comment.encode_step(reply11.pk) + 
+            Comment.encode_step(reply111.pk)
+        )
+        self.assertEqual(reply111.depth, 2)
+        tree = Comment.get_tree(page)
+        self.assertEqual(tree[1].children[0].children, [reply111])
+
+    def create_thread(self, page, depth):
+        comments = [ page.add_comment(body="#0") ]
+        for i in range(depth):
+            comments.append(comments[-1].reply(body="#%d" % (i + 1)))
+        return comments
+
+    def test_replies_are_limited_to_max_depth(self):
+        user, page = self.create_user_and_page()
+        thread = self.create_thread(page, Comment.MAX_DEPTH)
+        thread[-1].refresh_from_db()
+        self.assertLessEqual(
+            len(thread[-1].path), Comment._meta.get_field("path").max_length
+        )
+        count = Comment.objects.count()
+        with self.assertRaises(ValidationError):
+            thread[-1].reply(body="Too deep")
+        self.assertEqual(Comment.objects.count(), count)
+
+    def test_moving_comment_checks_depth_of_its_replies(self):
+        user, page = self.create_user_and_page()
+        thread = self.create_thread(page, Comment.MAX_DEPTH)
+        comment = page.add_comment(body="Comment")
+        comment.reply(body="Reply")
+        comment.parent = thread[-2]
+        with self.assertRaises(ValidationError):
+            comment.save()
+        comment.refresh_from_db()
+        self.assertIsNone(comment.parent)
+
+
+class CommentCountersTest(TestCase):
+
+    def setUp(self):
+        self.page = ContentPage.objects.create(title="Test Page")
+
+    def assertCounters(self, comments_count, *replies_counts):
+        self.page.refresh_from_db()
+        self.assertEqual(self.page.comments_count, comments_count)
+        for comment, replies_count in replies_counts:
+            comment.refresh_from_db()
+            self.assertEqual(comment.replies_count, replies_count)
+
+    def test_add_comment_and_reply_increment_counters(self):
+        comment = self.page.add_comment(body="#1")
+        comment.reply(body="#1.1")
+        comment.reply(body="#1.2")
+        self.assertCounters(1, (comment, 2))
+
+    def test_saving_comment_again_does_not_change_counters(self):
+        comment = self.page.add_comment(body="#1")
+        comment.body = "#1 (edited)"
+        comment.save()
+        self.assertCounters(1, (comment, 0))
+
+    def test_delete_decrements_counters(self):
+        comment = self.page.add_comment(body="#1")
+        reply = comment.reply(body="#1.1")
+        reply.delete()
+        self.assertCounters(1, (comment, 0))
+        comment.delete()
+        self.assertCounters(0)
+
+    def test_moving_reply_updates_counters_of_parents(self):
+        comment1 = self.page.add_comment(body="#1")
+        comment2 = self.page.add_comment(body="#2")
+        reply = comment1.reply(body="#1.1")
+        reply.parent = comment2
+        reply.save()
+        self.assertCounters(2, (comment1, 0), (comment2, 1))
+
+    def test_saving_page_does_not_overwrite_counters(self):
+        page = ContentPage.objects.get(pk=self.page.pk)
+        self.page.add_comment(body="#1")
+        page.title = "New Title"
+        page.save()
+        self.assertCounters(1)
+        self.assertEqual(self.page.title, "New Title")
+
+    def test_rebuild_comment_counts_fixes_counters(self):
+        comment = self.page.add_comment(body="#1")
+        comment.reply(body="#1.1")
+        Page.objects.update(comments_count=5)
+        Comment.objects.update(replies_count=0)
+        stdout = StringIO()
+        call_command("rebuild_comment_counts", stdout=stdout)
+        self.assertIn("Found 1 page(s) and 1 comment(s)", stdout.getvalue())
+        self.assertCounters(1, (comment, 1))
@@ -0,0 +1,381 @@
+import gzip
+import os
+import shutil
+import tempfile
+import zlib
+from unittest import mock
+from io import StringIO
+from datetime import timedelta
+
+from django.test import TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+from astorcore.models import ContentPage, Page
+from astorcore.publishing import (
+    bulk_publish, bulk_unpublish, claim_due_pages, process_due_pages,
+    SCHEDULE_CLAIM_TIMEOUT
+)
+from astorcore.serving import serve_file
+from astoraccount.models import Activity
+from astoraccount.forms import ContentPageForm
+
+
+User = get_user_model()
+
+
+class BulkPublishTest(TestCase):
+
+    def create_pages(self, n=3, user=None):
+        user = user or User.objects.create_user(
+            username="Test", password="test"
+        )
+        pages = list()
+        for i in range(n):
+            page = user.add_page(ContentPage(title="Page #{:d}".format(i)))
+            page.tags.add("tag{:d}".format(i), "common")
+            pages.append(page)
+        return user, pages
+
+    def test_publishes_all_pages(self):
+        user, pages = self.create_pages()
+        published = bulk_publish(pages)
+        self.assertEqual(len(published), 3)
+        for page, pub_page in zip(pages, published):
+            page.refresh_from_db()
+            self.assertEqual(page.published_page_id, pub_page.pk)
+            self.assertIsNotNone(page.first_published_date)
+            self.assertTrue(pub_page.live)
+            self.assertFalse(pub_page.editable)
+            self.assertEqual(pub_page.title, page.title)
+
+    def test_copies_tags_of_each_page(self):
+        user, pages = self.create_pages()
+        published = bulk_publish(pages)
+        for i, pub_page in enumerate(published):
+            self.assertCountEqual(
+                pub_page.tags.names(), ["tag{:d}".format(i), "common"]
+            )
+
+    def test_accepts_queryset_of_pages(self):
+        user, pages = self.create_pages()
+        published = bulk_publish(Page.objects.filter(editable=True))
+        self.assertTrue(all(isinstance(page, ContentPage) 
+                            for page in published))
+        self.assertEqual(Page.objects.filter(live=True).count(), 3)
+
+    def test_republish_updates_published_pages_in_place(self):
+        user, pages = self.create_pages()
+        published = bulk_publish(pages)
+        pages[0].title = "Updated Title"
+        pages[0].save()
+        republished = bulk_publish(pages)
+        self.assertEqual([ page.pk for page in published ], 
+                         [ page.pk for page in republished ])
+        self.assertEqual(
+            ContentPage.objects.get(pk=published[0].pk).title, "Updated Title"
+        )
+
+    def test_sets_live_revision(self):
+        user, pages = self.create_pages(n=1)
+        bulk_publish(pages)
+        page = Page.objects.get(pk=pages[0].pk)
+        self.assertEqual(page.live_revision, page.revisions.latest("pk"))
+
+    def test_registers_activities(self):
+        user, pages = self.create_pages()
+        bulk_publish(pages)
+        self.assertEqual(
+            user.activities.filter(number=Activity.PUBLISH_PAGE).count(), 3
+        )
+
+    def count_queries_except_inserts_of_pages(self, pages):
+        with CaptureQueriesContext(connection) as context:
+            bulk_publish(pages)
+        return len([
+            query for query in context.captured_queries
+            if not query["sql"].startswith((
+                'INSERT INTO "astorcore_page"', 
+                'INSERT INTO "astorcore_contentpage"',
+                "SAVEPOINT", "RELEASE SAVEPOINT"
+            ))
+        ])
+
+    def test_runs_constant_number_of_queries_per_chunk(self):
+        user, pages1 = self.create_pages(n=2)
+        pages2 = self.create_pages(n=5, user=user)[1]
+        self.assertEqual(
+            self.count_queries_except_inserts_of_pages(pages1),
+            self.count_queries_except_inserts_of_pages(pages2)
+        )
+
+    def test_leaves_drafts_in_the_same_state_as_publish(self):
+        user, pages = self.create_pages(n=2)
+        pages[0].publish()
+        bulk_publish(pages[1:])
+
+        def get_state(page):
+            page = Page.objects.get(pk=page.pk)
+            return (
+                page.has_unpublished_changes, page.published_page.live,
+                page.first_published_date is not None,
+                page.latest_changes_date >= page.first_published_date,
+                page.live_revision == page.revisions.latest("pk")
+            )
+
+        self.assertEqual(get_state(pages[0]), (False, True, True, True, True))
+        self.assertEqual(get_state(pages[1]), get_state(pages[0]))
+
+    def test_unpublish_removes_published_pages(self):
+        user, pages = self.create_pages()
+        bulk_publish(pages)
+        bulk_unpublish(pages)
+        self.assertEqual(Page.objects.count(), 3)
+        for page in pages:
+            page.refresh_from_db()
+            self.assertIsNone(page.published_page)
+
+
+class PublishPagesCommandTest(TestCase):
+
+    def test_publishes_pages_with_given_ids(self):
+        page1 = ContentPage.objects.create(title="Page #1")
+        page2 = ContentPage.objects.create(title="Page #2")
+        call_command("publish_pages", str(page1.pk), stdout=StringIO())
+        page1.refresh_from_db()
+        page2.refresh_from_db()
+        self.assertIsNotNone(page1.published_page)
+        self.assertIsNone(page2.published_page)
+
+    def test_publishes_all_drafts(self):
+        ContentPage.objects.create(title="Page #1")
+        ContentPage.objects.create(title="Page #2")
+        call_command("publish_pages", all=True, stdout=StringIO())
+        self.assertEqual(Page.objects.filter(live=True).count(), 2)
+
+    def test_unpublishes_pages(self):
+        page = ContentPage.objects.create(title="Page #1")
+        page.publish()
+        call_command("publish_pages", str(page.pk), unpublish=True, 
+                     stdout=StringIO())
+        self.assertEqual(Page.objects.count(), 1)
+
+    def test_requires_pages_to_publish(self):
+        with self.assertRaises(CommandError):
+            call_command("publish_pages", stdout=StringIO())
+
+
+class ScheduledPublishingTest(TestCase):
+
+    def test_publishes_due_pages(self):
+        page = ContentPage.objects.create(title="Due Page")
+        page.schedule_publish(timezone.now() - timedelta(minutes=1))
+        self.assertEqual(process_due_pages("worker"), 1)
+        page.refresh_from_db()
+        self.assertIsNotNone(page.published_page)
+        self.assertIsNone(page.publish_at)
+        self.assertIsNone(page.schedule_claimed_by)
+
+    def test_does_not_publish_pages_scheduled_in_future(self):
+        page = ContentPage.objects.create(title="Future Page")
+        page.schedule_publish(timezone.now() + timedelta(days=1))
+        self.assertEqual(process_due_pages("worker"), 0)
+        page.refresh_from_db()
+        self.assertIsNone(page.published_page)
+
+    def test_unpublishes_due_pages(self):
+        page = ContentPage.objects.create(title="Due Page")
+        page.publish()
+        page.schedule_unpublish()
+        process_due_pages("worker")
+        page.refresh_from_db()
+        self.assertIsNone(page.published_page)
+        self.assertIsNone(page.unpublish_at)
+
+    def test_published_page_is_not_scheduled(self):
+        page = ContentPage.objects.create(title="Due Page")
+        page.schedule_publish()
+        process_due_pages("worker")
+        page.refresh_from_db()
+        self.assertIsNone(page.published_page.publish_at)
+
+    def test_processes_page_only_once(self):
+        page = ContentPage.objects.create(title="Due Page")
+        page.schedule_publish()
+        self.assertEqual(process_due_pages("worker #1"), 1)
+        self.assertEqual(process_due_pages("worker #2"), 0)
+        self.assertEqual(Page.objects.filter(live=True).count(), 1)
+
+    def test_skips_pages_claimed_by_other_worker(self):
+        page = ContentPage.objects.create(title="Due Page")
+        page.schedule_publish()
+        self.assertEqual(claim_due_pages("publish_at", "worker #1"), [page.pk])
+        self.assertEqual(claim_due_pages("publish_at", "worker #2"), [])
+        self.assertEqual(process_due_pages("worker #2"), 0)
+
+    def test_takes_over_stale_claims(self):
+        page = ContentPage.objects.create(title="Due Page")
+        page.schedule_publish()
+        claim_due_pages("publish_at", "dead worker")
+        now = timezone.now() + SCHEDULE_CLAIM_TIMEOUT + timedelta(seconds=1)
+        self.assertEqual(process_due_pages("worker", now=now), 1)
+        self.assertEqual(Page.objects.filter(live=True).count(), 1)
+
+    def test_run_publisher_command_processes_due_pages(self):
+        page = ContentPage.objects.create(title="Due Page")
+        page.schedule_publish()
+        call_command("run_publisher", once=True, stdout=StringIO())
+        page.refresh_from_db()
+        self.assertIsNotNone(page.published_page)
+
+    def test_save_of_stale_page_does_not_reschedule_processed_page(self):
+        page = ContentPage.objects.create(title="Due Page")
+        page.schedule_publish()
+        stale_page = ContentPage.objects.get(pk=page.pk)
+        process_due_pages("worker")
+        stale_page.title = "Edited Title"
+        stale_page.save()
+        stale_page.refresh_from_db()
+        self.assertIsNone(stale_page.publish_at)
+        self.assertEqual(process_due_pages("worker"), 0)
+
+    def test_save_of_stale_page_keeps_claim_of_worker(self):
+        page = ContentPage.objects.create(title="Due Page")
+        page.schedule_publish()
+        stale_page = ContentPage.objects.get(pk=page.pk)
+        claim_due_pages("publish_at", "worker #1")
+        stale_page.save()
+        self.assertEqual(claim_due_pages("publish_at", "worker #2"), [])
+
+    def test_stale_form_writes_only_changed_scheduling(self):
+        page = ContentPage.objects.create(title="Due Page")
+        page.schedule_publish()
+        stale_page = ContentPage.objects.get(pk=page.pk)
+        process_due_pages("worker")
+        unpublish_at = timezone.now() + timedelta(days=1)
+        form = ContentPageForm({
+            "title": "Edited Title", "publish_at": stale_page.publish_at,
+            "unpublish_at": unpublish_at
+        }, instance=stale_page)
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+        page.refresh_from_db()
+        self.assertEqual(page.title, "Edited Title")
+        self.assertIsNone(page.publish_at)
+        self.assertEqual(page.unpublish_at, unpublish_at)
+
+
+class PublishArtifactsTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        self.media_settings.enable()
+        self.page = ContentPage.objects.create(
+            title="Test Page", body="Body 2501"
+        )
+        self.page.tags.add("tag2502")
+
+    def tearDown(self):
+        self.media_settings.disable()
+        shutil.rmtree(self.media_root)
+
+    def read_artifacts(self, page):
+        with open(page.get_body_file(), encoding="utf-8") as f:
+            return f.read()
+
+    def test_publish_renders_body(self):
+        pub_page = self.page.publish()
+        content = self.read_artifacts(pub_page)
+        self.assertIn("Body 2501", content)
+        self.assertIn("tag2502", content)
+
+    def test_publish_compresses_body(self):
+        pub_page = self.page.publish()
+        path = pub_page.get_body_file()
+        response = serve_file(
+            RequestFactory().get("/", HTTP_ACCEPT_ENCODING="gzip"), path
+        )
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(
+            gzip.decompress(b"".join(response.streaming_content)).decode(),
+            self.read_artifacts(pub_page)
+        )
+        with open(path + ".deflate", "rb") as f:
+            self.assertEqual(
+                zlib.decompress(f.read()).decode(),
+                self.read_artifacts(pub_page)
+            )
+
+    def test_published_page_is_shown_with_stored_body(self):
+        self.page.user = User.objects.create_user(
+            username="Test", password="test"
+        )
+        self.page.save()
+        pub_page = self.page.publish()
+        with open(pub_page.get_body_file(), "w") as f:
+            f.write("<p>Body 2504</p>")
+        response = self.client.get(pub_page.get_absolute_url())
+        self.assertContains(response, "<p>Body 2504</p>")
+
+    def test_missing_body_is_logged_and_written_again(self):
+        pub_page = self.page.publish()
+        pub_page.delete_artifacts()
+        with self.assertLogs("astorcore.models", "WARNING"):
+            self.assertIn("Body 2501", pub_page.get_body())
+        self.assertIn("Body 2501", self.read_artifacts(pub_page))
+        self.assertTrue(os.path.exists(pub_page.get_body_file() + ".gz"))
+
+    def test_drafts_are_shown_with_rendered_body(self):
+        self.page.publish()
+        self.assertIn("Body 2501", self.page.get_body())
+
+    def test_publishing_again_replaces_artifacts(self):
+        self.page.publish()
+        self.page.body = "Body 2503"
+        self.page.save()
+        pub_page = self.page.publish()
+        self.assertIn("Body 2503", self.read_artifacts(pub_page))
+
+    def test_bulk_publish_renders_artifacts(self):
+        pub_page, = bulk_publish([self.page])
+        self.assertIn("Body 2501", self.read_artifacts(pub_page))
+
+    def get_published_dirs(self):
+        return os.listdir(os.path.join(self.media_root, "published"))
+
+    def fail_after_writing(self, pages=1):
+        write_artifacts = ContentPage.write_artifacts
+        written = list()
+
+        def write_and_fail(page):
+            write_artifacts(page)
+            written.append(page)
+            if len(written) == pages:
+                raise OSError("No space left on device")
+
+        return mock.patch.object(
+            ContentPage, "write_artifacts", write_and_fail
+        )
+
+    def test_failed_publish_deletes_artifacts(self):
+        with self.fail_after_writing(), self.assertRaises(OSError):
+            self.page.publish()
+        self.assertEqual(self.get_published_dirs(), [])
+        self.assertFalse(Page.objects.filter(live=True).exists())
+
+    def test_failed_bulk_publish_deletes_artifacts(self):
+        other = ContentPage.objects.create(title="Other Page")
+        with self.fail_after_writing(pages=2), self.assertRaises(OSError):
+            bulk_publish([self.page, other])
+        self.assertEqual(self.get_published_dirs(), [])
+        self.assertFalse(Page.objects.filter(live=True).exists())
+
+    def test_unpublish_deletes_artifacts(self):
+        pub_page = self.page.publish()
+        self.page.unpublish()
+        self.assertFalse(os.path.exists(pub_page.get_artifacts_dir()))
@@ -1,8 +1,11 @@
 import unittest
 
+from django.test import TestCase, RequestFactory
 from django.contrib.auth import get_user_model
 
-from astorcore.serializers import CommentSerializer
+from astorcore.serializers import (
+    CommentSerializer, ContentPageSerializer, PageSerializer
+)
 from astorcore.models import Comment, ContentPage
 
 
@@ -30,3 +33,19 @@ class CommentSerializerTest(unittest.TestCase):
         comment = Comment.objects.first()
         self.assertEqual(comment.page, page)
         self.assertEqual(comment.author, user)
+
+
+class CountersSerializationTest(TestCase):
+
+    def test_serializers_expose_counters(self):
+        page = ContentPage.objects.create(title="Page Test")
+        comment = page.add_comment(body="Comment Test")
+        comment.reply(body="Reply Test")
+        page.refresh_from_db()
+        comment.refresh_from_db()
+        self.assertEqual(ContentPageSerializer(page).data["comments_count"], 1)
+        self.assertEqual(CommentSerializer(comment).data["replies_count"], 1)
+        data = PageSerializer(
+            page, context={"request": RequestFactory().get("/")}
+        ).data
+        self.assertEqual(data["comments_count"], 1)
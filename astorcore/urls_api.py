@@ -12,6 +12,8 @@ urlpatterns = [
         name="tag-detail"),
 
     url(r"^comments/$", views.CommentList.as_view(), name="comment-list"),
+    url(r"^comments/replies/$", views.CommentReplyBatch.as_view(),
+        name="comment-reply-batch"),
     url(r"^comments/(?P<cpk>[-\w]+)$", views.CommentDetail.as_view(), 
         name="comment-detail"),
     url(r"^comments/(?P<cpk>\d+)/replies/$",
@@ -20,8 +22,12 @@ urlpatterns = [
         views.CommentReplyDetail.as_view(), name="comment-reply-detail"),  
 
     url(r"^analyses/$", views.AnalysisList.as_view(), name="analysis-list"),
+    url(r"^analyses/publish/$", views.AnalysisPublish.as_view(), 
+        name="analysis-publish"),
     url(r"^analyses/(?P<apk>\d+)$", views.AnalysisDetail.as_view(),
         name="analysis-detail"),
+    url(r"^analyses/(?P<apk>\d+)/visits/$", 
+        views.AnalysisVisitList.as_view(), name="analysis-visit-list"),
     url(r"^analyses/(?P<apk>\d+)/comments/$", 
         views.AnalysisCommentList.as_view(), name="analysis-comment-list"),
     url(r"^analyses/(?P<apk>\d+)/comments/(?P<cpk>\d+)$",
@@ -1,47 +1,658 @@
-from copy import copy
+import atexit
+import hashlib
+import ipaddress
+import json
+import logging
+import math
+import operator
+import queue
+import threading
+import zlib
+from collections import defaultdict, OrderedDict
+from difflib import SequenceMatcher
+from functools import reduce
 
-from django.db.models.deletion import Collector
-from django.db.models.fields.related import ForeignKey
+from django.contrib.contenttypes.models import ContentType
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction, connections, DatabaseError
+from django.db.models import Q, AutoField
 
+from taggit.managers import TaggableManager
 
-def clone_page(page, skip_fields=["published_page"]):
-    '''Clones the page and its all related models. Saves cloned page in db.'''
 
-    collector = Collector(using="default")
-    collector.collect([page])
-    collector.sort()
+logger = logging.getLogger(__name__)
 
-    # Identify all related models.
-    related_models = collector.data.keys()
-    data_models = list(
-        (key, item.pop()) for key, item in collector.data.items()
+
+class ClonePlan(object):
+    '''
+    Precomputed steps of cloning instances of the model: the inheritance chain
+    with fields copied to each table and taggable managers whose tags have to
+    be copied. Parent pointers are rewired by Model.save while inserting the
+    chain from the root.
+    '''
+
+    def __init__(self, model, skip_fields=()):
+        self.model = model
+        self.chain = list()
+        for cls in reversed([model] + model._meta.get_parent_list()):
+            fields = [
+                field for field in cls._meta.local_concrete_fields
+                if not field.primary_key and field.name not in skip_fields
+                and not (field.remote_field and field.remote_field.parent_link)
+            ]
+            self.chain.append((cls, fields))
+        self.fields = [ field for _, fields in self.chain for field in fields ]
+        self.tag_managers = [
+            field for field in model._meta.many_to_many
+            if isinstance(field, TaggableManager)
+        ]
+
+    def get_values(self, instance, **values):
+        '''Returns values of copied fields. Values override the instance.'''
+        data = {
+            field.attname: getattr(instance, field.attname)
+            for field in self.fields
+        }
+        data.update(values)
+        return data
+
+    def clone(self, instance, copy_tags=True, **values):
+        '''Inserts copy of the instance (and its tags). Returns the copy.'''
+        clone = self.model(**self.get_values(instance, **values))
+        clone.save(force_insert=True)
+        if copy_tags:
+            self.copy_tags([(instance, clone)])
+        return clone
+
+    def copy_tags(self, pairs):
+        '''
+        Links the targets (without any tags yet) with tags of the sources.
+        Reads tags of all sources with one query and inserts links with
+        another.
+        '''
+        pairs = list(pairs)
+        if not pairs:
+            return
+
+        for manager in self.tag_managers:
+            through = manager.through
+            lookups = [ through.lookup_kwargs(source) for source, _ in pairs ]
+            keys = list(lookups[0])
+            rows = through.objects.filter(
+                reduce(operator.or_, (Q(**lookup) for lookup in lookups))
+            ).values_list("tag_id", *keys)
+
+            tag_ids = defaultdict(list)
+            for row in rows:
+                tag_ids[tuple(row[1:])].append(row[0])
+
+            through.objects.bulk_create([
+                through(tag_id=tag_id, **through.lookup_kwargs(target))
+                for lookup, (_, target) in zip(lookups, pairs)
+                for tag_id in tag_ids[tuple(
+                    getattr(lookup[key], "pk", lookup[key]) for key in keys
+                )]
+            ])
+
+    def update(self, instance, target, **values):
+        '''
+        Copies the instance and its tags onto the existing target in place.
+        Only tables with changed columns and changed tag links are touched.
+        '''
+        data = self.get_values(instance, **values)
+        for cls, fields in self.chain:
+            changed = {
+                field.attname: data[field.attname] for field in fields
+                if data[field.attname] != getattr(target, field.attname)
+            }
+            if changed:
+                cls._base_manager.using(target._state.db).filter(
+                    pk=target.pk
+                ).update(**changed)
+                for attname, value in changed.items():
+                    setattr(target, attname, value)
+
+        for manager in self.tag_managers:
+            through = manager.through
+            tag_ids = get_tag_ids(through, instance)
+            target_tag_ids = get_tag_ids(through, target)
+            if target_tag_ids - tag_ids:
+                through.objects.filter(
+                    tag_id__in=target_tag_ids - tag_ids,
+                    **through.lookup_kwargs(target)
+                ).delete()
+            through.objects.bulk_create([
+                through(tag_id=tag_id, **through.lookup_kwargs(target))
+                for tag_id in tag_ids - target_tag_ids
+            ])
+
+        return target
+
+
+def get_tag_ids(through, instance):
+    '''Returns set of ids of tags linked with the instance.'''
+    return set(through.objects.filter(
+        **through.lookup_kwargs(instance)
+    ).values_list("tag_id", flat=True))
+
+
+# Fields which are not copied when publishing pages.
+CLONE_SKIP_FIELDS = ("published_page", "live_revision", "publish_at", 
+                     "unpublish_at", "schedule_claimed_by", 
+                     "schedule_claimed_at", "visits_count", "comments_count",
+                     "comments_changed_date")
+
+# Clone plans are compiled once per model and set of skipped fields.
+_clone_plans = dict()
+
+def get_clone_plan(model, skip_fields=()):
+    '''Returns (cached) clone plan for the model.'''
+    key = (model, tuple(skip_fields))
+    try:
+        return _clone_plans[key]
+    except KeyError:
+        plan = _clone_plans[key] = ClonePlan(model, skip_fields)
+        return plan
+
+
+def clone_page(page, skip_fields=CLONE_SKIP_FIELDS, **values):
+    '''
+    Clones the page with its parents and tags. Saves cloned page in db.
+    Values override attributes of the clone.
+    '''
+    with transaction.atomic():
+        return get_clone_plan(type(page), skip_fields).clone(page, **values)
+
+
+def update_page(page, target, skip_fields=CLONE_SKIP_FIELDS, **values):
+    '''
+    Updates the target (e.g. previously cloned page) in place with the data
+    and tags of the page. The target keeps its pk.
+    '''
+    with transaction.atomic():
+        return get_clone_plan(type(page), skip_fields).update(
+            page, target, **values
+        )
+
+
+class ContentTypeMap(object):
+    '''
+    Process-wide map between models and their content type ids. Content types
+    of all models returned by get_models are loaded with a single query when
+    the app is ready (see warm) or on the first lookup, other models are
+    added on demand.
+    '''
+
+    def __init__(self, get_models):
+        self.get_models = get_models
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self, **kwargs):
+        '''Invalidates the map. Can be used as a signal receiver.'''
+        self._ids = dict()
+        self._models = dict()
+        self._loaded = False
+
+    def warm(self, **kwargs):
+        '''
+        Reloads the map. Can be used as a signal receiver. The map is left
+        to be loaded on the first lookup when the database is not ready
+        (e.g. before the first migration).
+        '''
+        self.clear()
+        try:
+            self.load()
+        except DatabaseError:
+            self.clear()
+
+    def load(self):
+        '''Loads content types of all models returned by get_models.'''
+        content_types = ContentType.objects.get_for_models(*self.get_models())
+        for model, content_type in content_types.items():
+            self._add(model, content_type.pk)
+        self._loaded = True
+
+    def _add(self, model, content_type_id):
+        self._ids[model] = content_type_id
+        self._models[content_type_id] = model
+
+    def get_id(self, model):
+        '''Returns id of the content type for the model.'''
+        if not self._loaded:
+            self.load()
+        try:
+            content_type_id = self._ids[model]
+        except KeyError:
+            self.misses += 1
+            content_type_id = ContentType.objects.get_for_model(model).pk
+            self._add(model, content_type_id)
+        else:
+            self.hits += 1
+        return content_type_id
+
+    def get_model(self, content_type_id):
+        '''Returns model for the content type id (None when stale).'''
+        if not self._loaded:
+            self.load()
+        try:
+            model = self._models[content_type_id]
+        except KeyError:
+            self.misses += 1
+            model = ContentType.objects.get_for_id(
+                content_type_id
+            ).model_class()
+            if model is not None:
+                self._add(model, content_type_id)
+        else:
+            self.hits += 1
+        return model
+
+
+def dump_fields(instance, fields):
+    '''Returns dict with JSON serializable values of the fields.'''
+    data = dict()
+    for field in fields:
+        value = field.value_from_object(instance)
+        if not isinstance(value, (type(None), bool, int, float, str)):
+            value = field.value_to_string(instance)
+        data[field.attname] = value
+    return data
+
+
+def load_fields(instance, fields, data):
+    '''Sets values of the fields present in data (see dump_fields).'''
+    for field in fields:
+        if field.attname in data:
+            setattr(
+                instance, field.attname, field.to_python(data[field.attname])
+            )
+
+
+def compress_data(data):
+    '''Serializes data to JSON and compresses it with zlib.'''
+    return zlib.compress(json.dumps(data, cls=DjangoJSONEncoder).encode())
+
+
+def decompress_data(content):
+    '''Reverses compress_data.'''
+    return json.loads(zlib.decompress(bytes(content)).decode())
+
+
+def diff_lines(base, text):
+    '''
+    Returns delta of the text against the base: list of ranges of lines 
+    copied from the base ([start, end]) and inserted strings.
+    '''
+    base_lines, lines = base.splitlines(True), text.splitlines(True)
+    matcher = SequenceMatcher(None, base_lines, lines, autojunk=False)
+    ops = list()
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append("".join(lines[j1:j2]))
+    return ops
+
+
+def patch_lines(base, ops):
+    '''Reverses diff_lines.'''
+    base_lines = base.splitlines(True)
+    return "".join(
+        "".join(base_lines[op[0]:op[1]]) if isinstance(op, list) else op
+        for op in ops
     )
 
-    # Collect requried data
-    mstor = []
-    for model_class, model_inst in data_models:
-        ptr_names = list()
-        for f in model_inst._meta.fields:
-            if (isinstance(f, ForeignKey) and f.rel.to in related_models
-                    and f.name not in skip_fields): # recursive relation
-                ptr_names.append((f.name, f.rel.to))
-        mstor.append((model_class, model_inst, ptr_names))
-
-    # Create models starting from the first in the hierarchy
-    mstor = reversed(mstor)
-    ptrs = dict()
-    for model_class, model_inst, base_ptrs in mstor:
-        page_clone = copy(model_inst)
-        page_clone.id = None
-        page_clone.pk = None
-        page_clone.published_page = None
-        if base_ptrs:
-            for ptr_name, ptr_class in base_ptrs:
-                setattr(page_clone, ptr_name, ptrs[ptr_class])
-        page_clone.save()
-        ptrs[model_class] = page_clone
-
-    return page_clone
+
+def diff_data(base, data):
+    '''
+    Returns delta of data (see dump_fields) against the base. Changed strings
+    are stored line by line (see diff_lines) when it makes them shorter.
+    '''
+    delta = {"set": dict(), "patch": dict(), 
+             "unset": [ name for name in base if name not in data ]}
+    for name, value in data.items():
+        if name in base and base[name] == value:
+            continue
+        if isinstance(value, str) and isinstance(base.get(name), str):
+            ops = diff_lines(base[name], value)
+            if len(json.dumps(ops)) < len(json.dumps(value)):
+                delta["patch"][name] = ops
+                continue
+        delta["set"][name] = value
+    return delta
+
+
+def patch_data(base, delta):
+    '''Reverses diff_data.'''
+    data = { 
+        name: value for name, value in base.items() 
+        if name not in delta["unset"] 
+    }
+    for name, ops in delta["patch"].items():
+        data[name] = patch_lines(base[name], ops)
+    data.update(delta["set"])
+    return data
+
+
+def set_counters(model, field, counts, dry_run=False):
+    '''
+    Sets counters stored in the field of all objects of the model to values
+    given in counts (pk -> value, missing pks mean 0). Objects are updated
+    with one query per distinct value. Returns number of wrong counters.
+    '''
+    pks_by_count = defaultdict(list)
+    for pk, value in model._base_manager.values_list(
+            "pk", field).iterator():
+        count = counts.get(pk, 0)
+        if count != value:
+            pks_by_count[count].append(pk)
+
+    if not dry_run:
+        for count, pks in pks_by_count.items():
+            for i in range(0, len(pks), 500):
+                model._base_manager.filter(pk__in=pks[i:i + 500]).update(
+                    **{field: count}
+                )
+    return sum(len(pks) for pks in pks_by_count.values())
+
+
+def set_update_fields(instance, skip_fields, kwargs):
+    '''
+    Limits save (with kwargs) of the existing instance to fields other
+    than skip_fields (e.g. counters updated with F() expressions), unless
+    the fields to update are given explicitly.
+    '''
+    if instance._state.adding or kwargs.get("force_insert") or \
+            kwargs.get("update_fields") is not None:
+        return
+    kwargs["update_fields"] = [
+        field.name for field in instance._meta.concrete_fields
+        if not field.primary_key and field.name not in skip_fields
+    ]
+
+
+def bulk_insert_ignore(model, objs, using="default"):
+    '''
+    Inserts objects (like bulk_create) skipping rows which violate unique
+    constraints. Primary keys are inserted only when all objects have them.
+    Returns number of inserted rows.
+    '''
+    connection = connections[using]
+    objs = list(objs)
+    with_pk = all(obj.pk is not None for obj in objs)
+    fields = [ 
+        field for field in model._meta.concrete_fields 
+        if with_pk or not isinstance(field, AutoField)
+    ]
+    if connection.vendor == "sqlite":
+        template = "INSERT OR IGNORE INTO %s (%s) VALUES %s"
+    elif connection.vendor == "mysql":
+        template = "INSERT IGNORE INTO %s (%s) VALUES %s"
+    elif connection.vendor == "postgresql":
+        template = "INSERT INTO %s (%s) VALUES %s ON CONFLICT DO NOTHING"
+    else:
+        raise NotImplementedError(
+            "bulk_insert_ignore does not support %s." % connection.vendor
+        )
+
+    batch_size = max(connection.ops.bulk_batch_size(fields, objs), 1)
+    placeholder = "(%s)" % ", ".join(["%s"] * len(fields))
+    inserted = 0
+    with connection.cursor() as cursor:
+        for i in range(0, len(objs), batch_size):
+            batch = objs[i:i + batch_size]
+            sql = template % (
+                connection.ops.quote_name(model._meta.db_table),
+                ", ".join(connection.ops.quote_name(field.column) 
+                          for field in fields),
+                ", ".join([placeholder] * len(batch))
+            )
+            params = [
+                field.get_db_prep_save(field.pre_save(obj, True), connection)
+                for obj in batch for field in fields
+            ]
+            cursor.execute(sql, params)
+            inserted += cursor.rowcount
+    return inserted
+
+
+class WriteBuffer(object):
+    '''
+    Bounded in-process buffer of model instances which are inserted in
+    batches (by default with bulk_insert_ignore, otherwise with insert
+    callable) by a background thread. When the buffer is full, put waits up
+    to block_timeout seconds for the flush and then drops the instance. The
+    buffer is flushed at exit.
+    '''
+
+    def __init__(self, model, max_size=10000, batch_size=500, interval=1.0,
+                 block_timeout=0.1, background=True, insert=None):
+        self.model = model
+        self.insert = insert or (lambda objs: bulk_insert_ignore(model, objs))
+        self.batch_size = batch_size
+        self.interval = interval
+        self.block_timeout = block_timeout
+        self.background = background
+        self.queue = queue.Queue(maxsize=max_size)
+        self.flushed = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def put(self, obj):
+        '''Adds instance to the buffer. Returns False when it was dropped.'''
+        if self.background:
+            self.start()
+        if self.queue.qsize() >= self.batch_size:
+            self._wakeup.set()
+        try:
+            self.queue.put(obj, timeout=self.block_timeout)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        return True
+
+    def flush(self):
+        '''
+        Inserts all buffered instances in batches of batch_size, each within
+        one transaction. Returns number of inserted rows.
+        '''
+        with self._flush_lock:
+            objs = list()
+            while True:
+                try:
+                    objs.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            inserted = 0
+            for i in range(0, len(objs), self.batch_size):
+                try:
+                    with transaction.atomic():
+                        count = self.insert(objs[i:i + self.batch_size])
+                except Exception:
+                    # Instances of this and the following batches are lost.
+                    with self._lock:
+                        self.dropped += len(objs) - i
+                    raise
+                inserted += count
+                with self._lock:
+                    self.flushed += count
+            return inserted
+
+    def start(self):
+        '''Starts the background thread (once).'''
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._stopped.clear()
+                self._thread = threading.Thread(
+                    target=self._run, 
+                    name="WriteBuffer(%s)" % self.model.__name__
+                )
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def stop(self):
+        '''Stops the background thread and flushes the buffer.'''
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush %s.", self.model.__name__)
+                connections.close_all()
+
+
+class HyperLogLog(object):
+    '''
+    HyperLogLog sketch estimating number of distinct values in fixed memory
+    (2 ** precision one-byte registers; standard error 1.04 / sqrt(m)).
+    Sketches are mergeable and serialize to small (zlib-compressed) blobs.
+    '''
+
+    def __init__(self, precision=10, registers=None):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(registers or self.m)
+        if len(self.registers) != self.m:
+            raise ValueError("Invalid number of registers.")
+
+    def add(self, value):
+        '''Adds value (str) to the sketch.'''
+        digest = hashlib.sha1(value.encode()).digest()
+        h = int.from_bytes(digest[:8], "big")
+        index = h >> (64 - self.precision)
+        width = 64 - self.precision
+        rank = width - (h & ((1 << width) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        '''Merges other sketch (of the same precision) into this one.'''
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge sketches of different precision.")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        '''Returns estimated number of distinct values.'''
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros) # linear counting
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, content, precision=10):
+        '''Reverses to_bytes. Empty content gives empty sketch.'''
+        if not content:
+            return cls(precision)
+        registers = zlib.decompress(bytes(content))
+        return cls(int(math.log2(len(registers))), registers)
+
+
+class LRUCache(object):
+    '''Thread-safe map which keeps max_size most recently used items.'''
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self, **kwargs):
+        '''Removes all items. Can be used as a signal receiver.'''
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class IdentityMap(object):
+    '''
+    Objects loaded while handling a single request, keyed by model and
+    lookup, so every object is loaded at most once per request.
+    '''
+
+    def __init__(self):
+        self._objects = dict()
+
+    @classmethod
+    def for_request(cls, request):
+        '''Returns identity map of the request (created on demand).'''
+        identity_map = getattr(request, "identity_map", None)
+        if identity_map is None:
+            identity_map = request.identity_map = cls()
+        return identity_map
+
+    def get(self, model, key, load):
+        '''Returns object of the model for the key, loads it when missing.'''
+        try:
+            return self._objects[(model, key)]
+        except KeyError:
+            obj = self._objects[(model, key)] = load()
+            return obj
+
+
+def pack_ip(address):
+    '''
+    Returns packed (4 bytes for IPv4, 16 bytes for IPv6) ip address or None
+    when the address is invalid.
+    '''
+    try:
+        return ipaddress.ip_address(address).packed
+    except ValueError:
+        return None
+
+
+def unpack_ip(packed):
+    '''Reverses pack_ip.'''
+    if packed is None:
+        return None
+    return str(ipaddress.ip_address(bytes(packed)))
 
 
 def user_directory_path(instance, filename):
@@ -1,9 +1,16 @@
+import csv
 import operator
+from collections import OrderedDict
+from datetime import datetime
 from functools import reduce
 from copy import copy
 
 from django.db.models import Q
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from taggit.models import Tag
 from rest_framework.exceptions import NotFound
 from rest_framework.views import APIView
@@ -13,10 +20,22 @@ from rest_framework.response import Response
 from rest_framework.decorators import api_view
 
 from astorcore.serializers import (
-    TagSerializer, PageSerializer, CommentSerializer
+    TagSerializer, PageSerializer, CommentSerializer, PublishSerializer,
+    ReplyBatchSerializer
 )
 from astorcore.models import Page, Comment
-from astorcore.decorators import get_serializers
+from astorcore.pagination import KeysetPagination
+from astorcore.decorators import get_serializer
+from astorcore.publishing import bulk_publish, bulk_unpublish
+from astorcore.analytics import export_visits, ROLLUP_MODELS
+
+
+class EagerLoadingViewMixin(object):
+    '''Loads related objects required by the serializer of the view.'''
+
+    def get_queryset(self):
+        queryset = super(EagerLoadingViewMixin, self).get_queryset()
+        return self.get_serializer_class().setup_eager_loading(queryset)
 
 
 class MappingFieldsLookupMixin(object):
@@ -46,6 +65,8 @@ class TagList(generics.ListCreateAPIView):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
+    pagination_class = KeysetPagination
+    keyset_ordering = ("id",)
 
 
 class TagDetail(generics.RetrieveUpdateDestroyAPIView):
@@ -55,10 +76,132 @@ class TagDetail(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
 
-class AnalysisList(generics.ListAPIView):
+class AnalysisList(EagerLoadingViewMixin, generics.ListAPIView):
     queryset = Page.objects.all()
     serializer_class = PageSerializer
     lookup_url_kwarg = "apk"
+    pagination_class = KeysetPagination
+    keyset_ordering = ("-latest_changes_date", "-id")
+
+
+class AnalysisPublish(APIView):
+    '''Publishes (or unpublishes) many drafts of the user at once.'''
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, format=None):
+        serializer = PublishSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, 
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        pages = list(request.user.pages.filter(
+            editable=True, pk__in=serializer.validated_data["ids"]
+        ).order_by("pk").specific())
+
+        if serializer.validated_data["action"] == "unpublish":
+            return Response({"unpublished": [ 
+                page.pk for page in bulk_unpublish(pages) 
+            ]})
+
+        bulk_publish(pages)
+        return Response({
+            "published": [
+                {"id": page.pk, "published_page": page.published_page_id}
+                for page in pages
+            ]
+        })
+
+
+class Echo(object):
+    '''File-like object which returns written values (for csv.writer).'''
+
+    def write(self, value):
+        return value
+
+
+class AnalysisVisitList(APIView):
+    '''
+    Streams visits of the analysis of the user (or their hourly/daily
+    rollups, when bucket is given) as NDJSON or CSV. Visits of the draft
+    include visits of its published page.
+    '''
+    permission_classes = (permissions.IsAuthenticated,)
+    outputs = {
+        "ndjson": "application/x-ndjson",
+        "csv": "text/csv"
+    }
+
+    def get(self, request, apk, format=None):
+        page = get_object_or_404(request.user.pages, pk=apk)
+        pages = [ page.pk ]
+        if page.published_page_id:
+            pages.append(page.published_page_id)
+
+        params = request.query_params
+        output = params.get("output", "ndjson")
+        bucket = params.get("bucket")
+        start, end = params.get("start"), params.get("end")
+        if output not in self.outputs:
+            return self.bad_request("output", output)
+        if bucket is not None and bucket not in ROLLUP_MODELS:
+            return self.bad_request("bucket", bucket)
+        if start is not None:
+            start = self.parse_datetime(start)
+            if start is None:
+                return self.bad_request("start", params["start"])
+        if end is not None:
+            end = self.parse_datetime(end)
+            if end is None:
+                return self.bad_request("end", params["end"])
+
+        fields, rows = export_visits(pages, bucket, start, end)
+        if output == "csv":
+            content = self.stream_csv(fields, rows)
+        else:
+            content = self.stream_ndjson(fields, rows)
+        response = StreamingHttpResponse(
+            content, content_type=self.outputs[output]
+        )
+        response["Content-Disposition"] = (
+            "attachment; filename=\"visits-%s.%s\"" % (page.pk, output)
+        )
+        return response
+
+    @staticmethod
+    def parse_datetime(value):
+        '''Parses date or datetime (UTC by default). None if invalid.'''
+        try:
+            result = parse_datetime(value)
+            if result is None:
+                date = parse_date(value)
+                if date is None:
+                    return None
+                result = datetime(date.year, date.month, date.day)
+        except ValueError:
+            return None
+        if timezone.is_naive(result):
+            result = timezone.make_aware(result, timezone.utc)
+        return result
+
+    @staticmethod
+    def bad_request(param, value):
+        return Response(
+            {param: "Invalid value '%s'." % value},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    @staticmethod
+    def stream_ndjson(fields, rows):
+        encoder = DjangoJSONEncoder()
+        for row in rows:
+            yield encoder.encode(dict(zip(fields, row))) + "\n"
+
+    @staticmethod
+    def stream_csv(fields, rows):
+        writer = csv.writer(Echo())
+        yield writer.writerow(fields)
+        for row in rows:
+            yield writer.writerow(row)
 
 
 class AnalysisDetail(generics.RetrieveUpdateDestroyAPIView):
@@ -68,19 +211,19 @@ class AnalysisDetail(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
     def get_object(self):
-        obj = super(AnalysisDetail, self).get_object()
-        return obj.specific 
+        # Cached, both retrieving and serializing require the object.
+        if not hasattr(self, "_object"):
+            obj = super(AnalysisDetail, self).get_object().specific
+            self._object = self.get_serializer_class_for(obj)\
+                .load_related_objects([obj])[0]
+        return self._object
 
     def get_serializer_class(self):
-        obj = self.get_object()
-        serializers = get_serializers()
-
-        serializer_class = None
-        for serializer in get_serializers():
-            if type(obj) == serializer.Meta.model:
-                serializer_class = serializer
-                break
+        return self.get_serializer_class_for(self.get_object())
 
+    @staticmethod
+    def get_serializer_class_for(obj):
+        serializer_class = get_serializer(type(obj))
         assert serializer_class is not None, (
             "No serializer registered for '%s'." % obj.__class__.__name__
         )
@@ -88,13 +231,16 @@ class AnalysisDetail(generics.RetrieveUpdateDestroyAPIView):
         return serializer_class
 
 
-class CommentList(generics.ListCreateAPIView):
+class CommentList(EagerLoadingViewMixin, generics.ListCreateAPIView):
     queryset = Comment.objects.all()
     serializer_class = CommentSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
+    pagination_class = KeysetPagination
+    keyset_ordering = ("timestamp", "id")
 
 
-class CommentDetail(generics.RetrieveUpdateDestroyAPIView):
+class CommentDetail(EagerLoadingViewMixin, 
+                    generics.RetrieveUpdateDestroyAPIView):
     queryset = Comment.objects.all()
     serializer_class = CommentSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
@@ -110,6 +256,8 @@ class AnalysisCommentList(generics.ListCreateAPIView):
 
     lookup_field = "pk"
     lookup_url_kwarg = "apk"
+    pagination_class = KeysetPagination
+    keyset_ordering = ("timestamp", "id")
 
     def get_object(self, format=None):
         obj = super(AnalysisCommentList, self).get_object()
@@ -117,11 +265,13 @@ class AnalysisCommentList(generics.ListCreateAPIView):
 
     def get(self, request, format=None, **kwargs):
         analysis = self.get_object()
-        comments = analysis.comments.all()
+        comments = self.paginate_queryset(
+            CommentSerializer.setup_eager_loading(analysis.comments.all())
+        )
         serializer = CommentSerializer(
             comments, many=True, context={"request": request}
         )
-        return Response(serializer.data)       
+        return self.get_paginated_response(serializer.data)
 
     def post(self, request, format=None, **kwargs):
         analysis = self.get_object()
@@ -134,7 +284,7 @@ class AnalysisCommentList(generics.ListCreateAPIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)     
 
 
-class AnalysisCommentDetail(MappingFieldsLookupMixin, 
+class AnalysisCommentDetail(EagerLoadingViewMixin, MappingFieldsLookupMixin, 
                             generics.RetrieveUpdateAPIView):
     queryset = Comment.objects.all()
     serializer_class = CommentSerializer
@@ -152,14 +302,18 @@ class CommentReplyList(#MappingFieldsLookupMixin,
 
     lookup_field = "pk"
     lookup_url_kwarg = "cpk"
+    pagination_class = KeysetPagination
+    keyset_ordering = ("timestamp", "id")
 
     def get(self, request, format=None, **kwargs):
         comment = self.get_object()
-        replies = comment.replies.all()
+        replies = self.paginate_queryset(
+            CommentSerializer.setup_eager_loading(comment.replies.all())
+        )
         serializer = CommentSerializer(
             replies, many=True, context={"request": request}
         )
-        return Response(serializer.data)     
+        return self.get_paginated_response(serializer.data)
 
     def post(self, request, format=None, **kwargs):
         comment = self.get_object()
@@ -172,7 +326,65 @@ class CommentReplyList(#MappingFieldsLookupMixin,
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)  
 
 
-class CommentReplyDetail(MappingFieldsLookupMixin, 
+class CommentReplyBatch(APIView):
+    '''
+    Returns replies of many comments grouped by their parents, loaded with
+    a single query. Comments are selected with ids (?ids=1,2,3) or with
+    analysis and depth (?analysis=1&depth=2 returns replies up to the 
+    second level of the tree of comments of the analysis).
+    '''
+    permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
+    max_ids = 200
+
+    def get(self, request, format=None):
+        params = request.query_params
+        if "ids" in params:
+            try:
+                ids = [ int(id) for id in params["ids"].split(",") ]
+            except ValueError:
+                return self.bad_request("ids", params["ids"])
+            if len(ids) > self.max_ids:
+                return self.bad_request("ids", params["ids"])
+            replies = Comment.objects.filter(parent__in=ids)
+        elif "analysis" in params:
+            try:
+                analysis = int(params["analysis"])
+            except ValueError:
+                return self.bad_request("analysis", params["analysis"])
+            try:
+                depth = int(params.get("depth", 0)) or None
+            except ValueError:
+                return self.bad_request("depth", params["depth"])
+            ids = list()
+            replies = Comment.objects.filter(
+                root_page=analysis, parent__isnull=False
+            )
+            if depth is not None:
+                replies = replies.filter(depth__lte=depth)
+        else:
+            return Response(
+                {"ids": "This parameter (or analysis) is required."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        groups = OrderedDict((str(id), list()) for id in ids)
+        serializer = ReplyBatchSerializer(
+            replies.select_related("author").order_by("path"), many=True,
+            context={"request": request}
+        )
+        for reply in serializer.data:
+            groups.setdefault(str(reply["parent"]), list()).append(reply)
+        return Response(groups)
+
+    @staticmethod
+    def bad_request(param, value):
+        return Response(
+            {param: "Invalid value '%s'." % value},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+
+class CommentReplyDetail(EagerLoadingViewMixin, MappingFieldsLookupMixin, 
                          generics.RetrieveUpdateAPIView):
     queryset = Comment.objects.all()
     serializer_class = CommentSerializer
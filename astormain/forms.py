@@ -65,6 +65,7 @@ class ReplyForm(forms.ModelForm):
             raise ValidationError(_("Invalid author."), code="invalid")
         if not self.comment or not self.comment.pk:
             raise ValidationError(_("Invalid comment."), code="invalid")
+        Comment.check_depth(self.comment.depth + 1)
         return True
 
     def save(self, commit=True):
@@ -72,7 +72,8 @@ function addReply(cid, body, callbackDone, callbackFail) {
 }
 
 /**
- * Get replies for a comment with specific id.
+ * Get replies for a comment with specific id. Lists are paginated, so pages
+ * are requested one by one (following "next" links) and passed together.
  * @param {cid} comment' id
  * @param {callbackDone} callback to call when successfull request
  * @param {callbackFail} callback to call when failure request
@@ -81,12 +82,60 @@ function getReplies(cid, callbackDone, callbackFail) {
     if (cid === undefined) {
         throw "Undefined comment's id.";
     }
+    var replies = [];
+    var getPage = function(url) {
+        sendRequest({
+            method: "GET",
+            url: url
+        }, function(data, textStatus, jqXHR) {
+            replies = replies.concat(data);
+            var next = getLink(jqXHR.getResponseHeader("Link"), "next");
+            if (next) {
+                getPage(next);
+            } else {
+                callbackDone(replies, textStatus, jqXHR);
+            }
+        }, callbackFail);
+    };
+    getPage("/api/comments/" + cid + "/replies/");
+}
+
+/**
+ * Get replies for many comments with a single request.
+ * @param {cids} list of comments' ids
+ * @param {callbackDone} callback to call with replies grouped by comments' ids
+ * @param {callbackFail} callback to call when failure request
+ */
+function getRepliesBatch(cids, callbackDone, callbackFail) {
+    if (cids === undefined || cids.length == 0) {
+        throw "Undefined comments' ids.";
+    }
     sendRequest({
         method: "GET",
-        url: "/api/comments/" + cid + "/replies/"
+        url: "/api/comments/replies/",
+        data: {
+            ids: cids.join(",")
+        }
     }, callbackDone, callbackFail);
 }
 
+/**
+ * Get url of the page of the list with the relation (e.g. "next") from the
+ * Link header.
+ * @param {header} value of the Link header
+ * @param {rel} relation of the link
+ */
+function getLink(header, rel) {
+    var pattern = /<([^>]+)>;\s*rel="([^"]+)"/g;
+    var match;
+    while (header && (match = pattern.exec(header)) !== null) {
+        if (match[2] === rel) {
+            return match[1];
+        }
+    }
+    return null;
+}
+
 /**
  * Get cookie.
  * @param {name} cookie's name
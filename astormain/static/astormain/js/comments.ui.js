@@ -22,7 +22,8 @@ $(document).on("click", ".send-reply-btn", function() {
                     $commentList = $("<ul class='commentlist'></ul>");
                 }
                 $commentList.append(createCommentItem(data));
-                $self.append($commentList);
+                $self.append($commentList.show());
+                $self.children(".show-replies-btn").hide();
                 hideReplyForm($replyForm);
             },
             function(jqXHR, textStatus, errorThrown) {
@@ -41,6 +42,14 @@ $(document).on("click", ".show-replies-btn", function() {
     var cid = $(this).closest("li").data("cid");
     $(this).hide();
     var $self = $(this).closest("section");
+
+    // Replies rendered with the page are only hidden.
+    var $renderedList = $self.children(".commentlist");
+    if ($renderedList.length > 0) {
+        $renderedList.show();
+        return false;
+    }
+
     getReplies(
         cid,
         function(comments, textStatus, jqXHR) {
@@ -54,6 +63,7 @@ $(document).on("click", ".show-replies-btn", function() {
                 );
             }
             $self.append($commentList);
+            loadHiddenReplies($commentList);
         },
         function(jqXHR, textStatus, errorThrown) {
             alert("ERROR");
@@ -77,6 +87,35 @@ $("#id_send_comment_btn").click(function() {
 });
 
 
+/**
+ * Load replies of all comments in the list with a single request and
+ * render them hidden (shown by show-replies-btn).
+ * @param {commentList} list of comments
+ */
+function loadHiddenReplies(commentList) {
+    var cids = [];
+    commentList.children("li").each(function() {
+        if ($(this).find(".show-replies-btn").length > 0) {
+            cids.push($(this).data("cid"));
+        }
+    });
+    if (cids.length == 0) return;
+
+    getRepliesBatch(
+        cids,
+        function(groups, textStatus, jqXHR) {
+            commentList.children("li").each(function() {
+                var replies = groups[$(this).data("cid")];
+                if (replies === undefined || replies.length == 0) return;
+                $(this).children(".comment-replies").append(
+                    createCommentList(replies).hide()
+                );
+            });
+        },
+        function(jqXHR, textStatus, errorThrown) {}
+    );
+}
+
 /**
  * Hide and clear reply form.
  * @param {replyForm} elemtn to hide
@@ -138,10 +177,10 @@ function createCommentItem(comment) {
 
         $commentReplies.append($replyForm);
     }
-    if (comment.replies.length > 0) {
+    if (comment.replies_count > 0) {
         $commentReplies.append(
             "<a href='#' class='show-replies-btn'>Show replies (" +
-            comment.replies.length +")</a>"
+            comment.replies_count +")</a>"
         );
     }
 
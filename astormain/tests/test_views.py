@@ -1,8 +1,18 @@
+import gzip
+import os
+import shutil
+import tempfile
 import unittest
+import zlib
 
-from django.test import TestCase, RequestFactory
+from django.test import TestCase, RequestFactory, override_settings
 from django.urls import resolve, reverse
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.http import http_date
 
 from astorcore.models import (
     ContentPage, Page, Comment, HTMLUploadPage, PageVisit
@@ -179,6 +189,212 @@ class PagesTest(TestCase):
         self.assertEqual(comment.page.specific, page)
         self.assertEqual(page.comments.count(), 1)
 
+    def test_renders_tree_of_comments(self):
+        user, page = self.create_user_with_page()
+        comment = page.add_comment(body="Comment 2201", author=user)
+        reply = comment.reply(body="Reply 2202", author=user)
+        reply.reply(body="Reply 2203", author=user)
+        response = self.client.get(page.get_absolute_url())
+        self.assertEqual(response.context["comments"], [comment])
+        self.assertContains(response, "Show replies (1)", count=2)
+        self.assertContains(response, "Reply 2203")
+
+
+class CommentsCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="Test", password="test")
+        self.page = self.user.add_page(ContentPage(title="Test Page"))
+        self.comment = self.page.add_comment(body="Comment 1905")
+
+    def get(self):
+        return self.client.get(self.page.get_absolute_url())
+
+    def test_serves_cached_comments(self):
+        self.get()
+        Comment.objects.filter(pk=self.comment.pk).update(body="Comment 1906")
+        response = self.get()
+        self.assertContains(response, "Comment 1905")
+        self.assertNotContains(response, "Comment 1906")
+
+    def test_editing_comment_invalidates_cache(self):
+        self.get()
+        self.comment.body = "Comment 1906"
+        self.comment.save()
+        self.assertContains(self.get(), "Comment 1906")
+
+    def test_replies_and_deletes_invalidate_cache(self):
+        self.get()
+        reply = self.comment.reply(body="Reply 1907")
+        self.assertContains(self.get(), "Reply 1907")
+        reply.delete()
+        self.assertNotContains(self.get(), "Reply 1907")
+
+    def test_caches_comments_per_viewer_class(self):
+        self.get()
+        self.client.login(username="Test", password="test")
+        self.assertContains(self.get(), "show-reply-form-btn")
+
+    def test_does_not_change_version_of_other_pages(self):
+        other = self.user.add_page(ContentPage(title="Other Page"))
+        version = Comment.get_cache_version(other)
+        page_version = Comment.get_cache_version(self.page)
+        self.comment.reply(body="Reply 1908")
+        other.refresh_from_db()
+        self.page.refresh_from_db()
+        self.assertEqual(Comment.get_cache_version(other), version)
+        self.assertNotEqual(
+            Comment.get_cache_version(self.page), page_version
+        )
+
+    def test_version_is_shared_by_processes(self):
+        self.get()
+        # Other processes have separate local memory caches.
+        cache.clear()
+        version = Comment.get_cache_version(
+            Page.objects.get(pk=self.page.pk)
+        )
+        self.comment.reply(body="Reply 1909")
+        self.assertNotEqual(
+            Comment.get_cache_version(Page.objects.get(pk=self.page.pk)), 
+            version
+        )
+
+    def test_saving_page_keeps_version(self):
+        stale_page = ContentPage.objects.get(pk=self.page.pk)
+        self.comment.reply(body="Reply 1910")
+        stale_page.save()
+        self.assertNotEqual(
+            Page.objects.get(pk=self.page.pk).comments_changed_date, 
+            stale_page.comments_changed_date
+        )
+
+
+@override_settings(ANALYSIS_CACHE_TIMEOUT=0)
+class IdentityMapTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="Test", password="test")
+        self.page = self.user.add_page(ContentPage(title="Test Page"))
+
+    def count_queries(self, url, table, method="get", **kwargs):
+        with CaptureQueriesContext(connection) as context:
+            getattr(self.client, method)(url, **kwargs)
+        return len([
+            query for query in context.captured_queries
+            if query["sql"].startswith('SELECT "') and 
+               ' FROM "%s"' % table in query["sql"]
+        ])
+
+    def test_analysis_view_loads_user_and_page_once(self):
+        url = self.page.get_absolute_url()
+        self.assertEqual(self.count_queries(url, User._meta.db_table), 1)
+        self.assertEqual(self.count_queries(url, Page._meta.db_table), 1)
+        self.assertEqual(
+            self.count_queries(url, ContentPage._meta.db_table), 1
+        )
+
+    def test_posting_comment_loads_page_once(self):
+        self.client.login(username="Test", password="test")
+        self.assertEqual(self.count_queries(
+            self.page.get_absolute_url(), Page._meta.db_table, 
+            method="post", data={"body": "Comment"}
+        ), 1)
+
+    def test_returns_404_for_unknown_user(self):
+        response = self.client.get(
+            reverse("astormain:page", kwargs={"slug": "nobody", "pk": 1})
+        )
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(
+            reverse("astormain:profile", kwargs={"slug": "nobody"})
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class AnalysisCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="Test", password="test")
+        self.draft = self.user.add_page(ContentPage(title="Title 2301"))
+        self.page = self.draft.publish()
+        self.url = self.page.get_absolute_url()
+
+    def change_title(self, page, title):
+        ContentPage.objects.filter(pk=page.pk).update(title=title)
+
+    def test_serves_cached_published_pages(self):
+        self.client.get(self.url)
+        self.change_title(self.page, "Title 2302")
+        self.assertContains(self.client.get(self.url), "Title 2301")
+
+    def test_does_not_cache_drafts(self):
+        url = self.draft.get_absolute_url()
+        self.client.get(url)
+        self.change_title(self.draft, "Title 2302")
+        self.assertContains(self.client.get(url), "Title 2302")
+
+    def test_registers_visits_of_cached_pages(self):
+        self.client.get(self.url)
+        self.client.get(self.url)
+        self.assertEqual(PageVisit.objects.filter(page=self.page).count(), 2)
+        self.assertEqual(Page.objects.get(pk=self.page.pk).visits_count, 2)
+
+    def test_publishing_invalidates_cache(self):
+        self.client.get(self.url)
+        self.draft.title = "Title 2302"
+        self.draft.save()
+        self.draft.publish()
+        self.assertContains(self.client.get(self.url), "Title 2302")
+
+    def test_comments_invalidate_cache(self):
+        self.client.get(self.url)
+        self.page.add_comment(body="Comment 2303")
+        self.assertContains(self.client.get(self.url), "Comment 2303")
+
+    def test_caches_pages_per_viewer_class(self):
+        self.client.get(self.url)
+        self.client.login(username="Test", password="test")
+        self.assertContains(self.client.get(self.url), "Log Out")
+
+    def test_returns_304_for_unchanged_pages(self):
+        response = self.client.get(self.url)
+        self.assertIn("ETag", response)
+        self.assertEqual(self.client.get(
+            self.url, HTTP_IF_NONE_MATCH=response["ETag"]
+        ).status_code, 304)
+        self.assertEqual(self.client.get(
+            self.url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]
+        ).status_code, 304)
+
+        self.page.add_comment(body="Comment 2304")
+        self.assertEqual(self.client.get(
+            self.url, HTTP_IF_NONE_MATCH=response["ETag"]
+        ).status_code, 200)
+
+    def test_last_modified_is_date_of_latest_change(self):
+        response = self.client.get(self.url)
+        page = Page.objects.get(pk=self.page.pk)
+        self.assertEqual(
+            response["Last-Modified"], 
+            http_date(int(page.latest_changes_date.timestamp()))
+        )
+        # Refills of the cache (e.g. by other processes) keep the date.
+        cache.clear()
+        self.assertEqual(
+            self.client.get(self.url)["Last-Modified"], 
+            response["Last-Modified"]
+        )
+
+        self.page.add_comment(body="Comment 2305")
+        page = Page.objects.get(pk=self.page.pk)
+        self.assertEqual(
+            self.client.get(self.url)["Last-Modified"], 
+            http_date(int(page.comments_changed_date.timestamp()))
+        )
+
 
 class RegisterVisitTest(TestCase):
 
@@ -207,14 +423,12 @@ class RegisterVisitTest(TestCase):
         visit = page.visits.first()
         self.assertEqual(visit.user, user)
 
-    def test_registers_only_the_first_visit_from_given_id(self):
+    def test_counts_repeated_visits_from_given_ip_as_one_visitor(self):
         user, page = self.create_user_with_page()
         self.client.get(page.get_absolute_url())
-        self.client.login(username="Test", password="test")
         self.client.get(page.get_absolute_url())
-        self.assertEqual(page.visits.count(), 1)
-        visit = page.visits.first()
-        self.assertIsNone(visit.user)
+        self.assertEqual(page.visits.count(), 2)
+        self.assertEqual(page.unique_visitors, 1)
 
 
 class ExternalFileView(TestCase):
@@ -243,17 +457,129 @@ class ExternalFileView(TestCase):
 
         self.assertEqual(page, page_view)
 
-    def test_returns_correct_template(self):
+    def test_returns_404_when_file_is_missing(self):
         user = User.objects.create_user(username="Test", password="test")
         page = user.add_page(HTMLUploadPage(title="File Page", file="test.html"))
+        response = self.client.get(
+            reverse("astormain:external_file", 
+                    kwargs={"slug": user.slug, "pk": page.pk})
+        )
+        self.assertEqual(response.status_code, 404)
 
-        request_factory = RequestFactory()
-        request = request_factory.get(
-            "/fake_url", data={"slug": user.slug, "pk": page.pk}
+
+class ServeFileTest(TestCase):
+
+    content = b"<html><body>{{ not a template }}</body></html>" * 10
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        self.media_settings.enable()
+        user = User.objects.create_user(username="Test", password="test")
+        self.draft = user.add_page(HTMLUploadPage(
+            title="File Page", user=user,
+            file=SimpleUploadedFile("test.html", self.content)
+        ))
+        self.page = self.draft.publish()
+        self.url = reverse("astormain:external_file", 
+                           kwargs={"slug": user.slug, "pk": self.page.pk})
+
+    def tearDown(self):
+        self.media_settings.disable()
+        shutil.rmtree(self.media_root)
+
+    def get(self, **headers):
+        response = self.client.get(self.url, **headers)
+        if response.status_code in (200, 206):
+            response.data = b"".join(response.streaming_content)
+        return response
+
+    def test_serves_file_as_stored(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.content)
+        self.assertEqual(response["Content-Type"], "text/html")
+        self.assertEqual(response["Content-Length"], str(len(self.content)))
+
+    def test_serves_precompressed_variant(self):
+        response = self.get(HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(response.data), self.content)
+        self.assertIn("Accept-Encoding", response["Vary"])
+
+    def test_serves_variants_accepted_by_client(self):
+        response = self.get(HTTP_ACCEPT_ENCODING="gzip;q=0, deflate")
+        self.assertEqual(response["Content-Encoding"], "deflate")
+        self.assertEqual(zlib.decompress(response.data), self.content)
+
+        response = self.get(HTTP_ACCEPT_ENCODING="br")
+        self.assertNotIn("Content-Encoding", response)
+
+    def test_variants_are_written_when_published(self):
+        draft = self.page.user.add_page(HTMLUploadPage(
+            title="Draft Page", user=self.page.user,
+            file=SimpleUploadedFile("draft.html", self.content)
+        ))
+        draft.save()
+        self.assertFalse(os.path.exists(draft.file.path + ".gz"))
+        draft.publish()
+        self.assertTrue(os.path.exists(draft.file.path + ".gz"))
+        self.assertTrue(os.path.exists(draft.file.path + ".deflate"))
+
+    def test_returns_404_for_pages_without_files(self):
+        draft = self.page.user.add_page(
+            ContentPage(title="Content Page", body="Body 2504")
+        )
+        pub_page = draft.publish()
+        response = self.client.get(reverse(
+            "astormain:external_file", 
+            kwargs={"slug": pub_page.user.slug, "pk": pub_page.pk}
+        ))
+        self.assertEqual(response.status_code, 404)
+
+    def test_skips_stale_variants(self):
+        path = self.page.file.path
+        with open(path, "wb") as f:
+            f.write(b"new content")
+        os.utime(path, ns=(0, 10 ** 9))
+        response = self.get(HTTP_ACCEPT_ENCODING="gzip")
+        self.assertNotIn("Content-Encoding", response)
+        self.assertEqual(response.data, b"new content")
+
+    def test_returns_304_for_unchanged_file(self):
+        response = self.get()
+        self.assertEqual(
+            self.get(HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304
+        )
+        self.assertEqual(
+            self.get(HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])\
+                .status_code, 304
         )
 
-        view = views.ExternalFileView()
-        view = ExternalFileView.setup_view(view, request, slug=user.slug, 
-                                         pk=page.pk)
-                                                 
-        self.assertEqual("/media/" + view.get_template_names()[0], page.file.url)
\ No newline at end of file
+    def test_serves_byte_ranges(self):
+        response = self.get(HTTP_RANGE="bytes=6-11")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, self.content[6:12])
+        self.assertEqual(
+            response["Content-Range"], "bytes 6-11/%d" % len(self.content)
+        )
+
+        response = self.get(HTTP_RANGE="bytes=-7")
+        self.assertEqual(response.data, self.content[-7:])
+
+        response = self.get(HTTP_RANGE="bytes=100000-")
+        self.assertEqual(response.status_code, 416)
+
+    def test_serves_whole_file_when_if_range_does_not_match(self):
+        response = self.get(HTTP_RANGE="bytes=0-5", HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.content)
+
+    def test_hands_transfer_over_to_web_server(self):
+        with self.settings(SENDFILE_HEADER="X-Accel-Redirect"):
+            response = self.client.get(self.url)
+        self.assertEqual(
+            response["X-Accel-Redirect"], 
+            "/protected/media/" + self.page.file.name
+        )
+        self.assertEqual(response.content, b"")
@@ -1,13 +1,23 @@
+import hashlib
+import os
+
+from django.conf import settings
 from django.shortcuts import render, get_object_or_404
-from django.http import Http404
+from django.http import Http404, HttpResponse
+from django.core.cache import cache
+from django.contrib.messages import get_messages
 from django.contrib.auth import get_user_model
-from django.db.models import Count
-from django.views.generic import TemplateView
+from django.views.generic import TemplateView, View
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.views.generic.detail import SingleObjectMixin
 from django.views.generic.edit import FormView
+from django.utils.functional import SimpleLazyObject
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
 
-from astorcore.models import Page
+from astorcore.models import Page, Comment
+from astorcore.utils import IdentityMap
+from astorcore.serving import serve_file
 from astormain.forms import CommentForm, ReplyForm
 
 
@@ -21,15 +31,14 @@ class HomePageView(TemplateView):
         context = super(HomePageView, self).get_context_data(**kwargs)
 
         # Create list of features analyses (temporary solution)
-        featured_analyses = [ page.specific for page in Page.objects.all() 
-                                            if page.specific.live ]
+        featured_analyses = list(Page.objects.filter(live=True).specific())
 
         # Create list of most pouplar analyses (by number of visits)
-        pages = Page.objects.all().annotate(
-            visits_count=Count("visits")
-        ).order_by("-visits_count")[:5]
-        popular_analyses = [ page.specific for page in pages 
-                                           if page.specific.live ]
+        popular_analyses = list(
+            Page.objects.filter(live=True).order_by(
+                "-visits_count"
+            ).specific()[:5]
+        )
 
         # Create list of the latest/newest analyses
         newest_analyses = []
@@ -41,46 +50,158 @@ class HomePageView(TemplateView):
         return context
 
 
-class ExternalFileView(SingleObjectMixin, TemplateView):
+class UserLookupMixin(object):
+    '''
+    Resolves the owner (and the page) from the url. Objects are kept in the
+    identity map of the request, so they are loaded once per request.
+    '''
 
-    def get_object(self):
-        try:
-            user = User.objects.filter(slug=self.kwargs["slug"]).first()
-        except User.DoesNotExist:
+    def get_identity_map(self):
+        return IdentityMap.for_request(self.request)
+
+    def get_user(self):
+        slug = self.kwargs["slug"]
+        user = self.get_identity_map().get(
+            User, ("slug", slug), 
+            lambda: User.objects.filter(slug=slug).first()
+        )
+        if user is None:
             raise Http404("User does not exist.")
+        return user
 
-        try:
-            page = user.pages.get(pk=self.kwargs["pk"]).specific
-        except Page.DoesNotExist:
+    def get_page(self):
+        user = self.get_user()
+
+        def load_page():
+            try:
+                page = user.pages.get(pk=self.kwargs["pk"]).specific
+            except Page.DoesNotExist:
+                return None
+            page.user = user
+            return page
+
+        page = self.get_identity_map().get(
+            Page, ("pk", int(self.kwargs["pk"])), load_page
+        )
+        if page is None or page.user_id != user.pk:
             raise Http404("Analysis does not exist.")
-
         return page
 
-    def get_context_data(self, **kwargs):
-        self.object = self.get_object()
-        context = super(ExternalFileView, self).get_context_data(**kwargs)
-        return context
 
-    def get_template_names(self):
-        return [ self.get_object().file.name ]
+class ExternalFileView(UserLookupMixin, View):
+    '''
+    Serves the uploaded file of the analysis as stored (with variants
+    compressed when the file was saved).
+    '''
 
+    def get_object(self):
+        return self.get_page()
 
-class AnalysisView(SingleObjectMixin, FormView):
+    def get(self, request, *args, **kwargs):
+        path = self.get_object().get_served_file()
+        if not path or not os.path.isfile(path):
+            raise Http404("File does not exist.")
+        return serve_file(request, path)
+
+
+class AnalysisView(UserLookupMixin, SingleObjectMixin, FormView):
+    '''
+    Renders the analysis. Responses for published pages are cached (see
+    get_cache_key) and served with ETag and Last-Modified headers.
+    '''
     model = Page
     form_class = CommentForm
 
     def get_object(self):
-        try:
-            user = User.objects.filter(slug=self.kwargs["slug"]).first()
-        except User.DoesNotExist:
-            raise Http404("User does not exist.")
-
-        try:
-            page = user.pages.get(pk=self.kwargs["pk"]).specific
-        except Page.DoesNotExist:
-            raise Http404("Analysis does not exist.")
-
-        return page
+        return self.get_page()
+
+    def get(self, request, *args, **kwargs):
+        page = self.get_cached_page()
+        key = page and self.get_cache_key(page)
+        if key is None:
+            return super(AnalysisView, self).get(request, *args, **kwargs)
+
+        entry = cache.get(key)
+        if entry is None:
+            response = super(AnalysisView, self).get(request, *args, **kwargs)
+            response.render()
+            if response.status_code != 200:
+                return response
+            entry = {
+                "content": response.content,
+                "content_type": response["Content-Type"]
+            }
+            cache.set(key, entry, settings.ANALYSIS_CACHE_TIMEOUT)
+        else:
+            # Only pk of the page is required to register the visit.
+            Page(pk=page.pk).register_visit(request)
+            response = HttpResponse(
+                entry["content"], content_type=entry["content_type"]
+            )
+
+        etag = key.split(":")[-1]
+        last_modified = self.get_last_modified(page)
+        response["ETag"] = quote_etag(etag)
+        response["Last-Modified"] = http_date(last_modified)
+        patch_vary_headers(response, ("Cookie",))
+        return get_conditional_response(
+            request, etag=etag, last_modified=last_modified,
+            response=response
+        )
+
+    def get_cached_page(self):
+        '''
+        Returns the page (only dates of its changes) when its response can
+        be cached, None otherwise. Only published pages (which change only
+        when published again) are cached.
+        '''
+        if not settings.ANALYSIS_CACHE_TIMEOUT or get_messages(self.request):
+            return None
+        return Page.objects.filter(
+            pk=self.kwargs["pk"], user__slug=self.kwargs["slug"],
+            live=True, editable=False
+        ).only(
+            "latest_changes_date", "created_date", "comments_changed_date"
+        ).first()
+
+    def get_cache_key(self, page):
+        '''
+        Returns key of the cached response of the page, None if the response
+        can not be cached. Keys include the date of the last publish, the
+        version of comments of the page and the class of the viewer.
+        '''
+        user = self.request.user
+        if user.is_authenticated():
+            # Pages of authenticated users contain their CSRF tokens.
+            csrf_cookie = self.request.COOKIES.get(settings.CSRF_COOKIE_NAME)
+            if not csrf_cookie:
+                return None
+            viewer = "%d:%s" % (user.pk, csrf_cookie)
+        else:
+            viewer = "anonymous"
+
+        key = ":".join(map(str, (
+            page.pk, 
+            page.latest_changes_date and page.latest_changes_date.timestamp(),
+            page.created_date.timestamp(), Comment.get_cache_version(page),
+            viewer
+        )))
+        return "analysis:%d:%s" % (
+            page.pk, hashlib.md5(key.encode()).hexdigest()
+        )
+
+    @staticmethod
+    def get_last_modified(page):
+        '''
+        Returns timestamp of the latest change of the page or its comments
+        (the same in every process and for every refill of the cache).
+        '''
+        return int(max(
+            date.timestamp() for date in (
+                page.latest_changes_date, page.created_date,
+                page.comments_changed_date
+            ) if date is not None
+        ))
 
     def get_template_names(self):
         return [self.get_object().template_name]
@@ -89,6 +210,12 @@ class AnalysisView(SingleObjectMixin, FormView):
         self.object = self.get_object()
         context = super(AnalysisView, self).get_context_data(**kwargs)
         context["page"] = self.object
+        # Comments are loaded only when their cached fragment is missing.
+        context["comments"] = SimpleLazyObject(
+            lambda: Comment.get_tree(self.object)
+        )
+        context["comments_version"] = Comment.get_cache_version(self.object)
+        context["comments_cache_timeout"] = settings.COMMENTS_CACHE_TIMEOUT
 
         # Register visit. get_context_data is run only once before rendering
         # the page, so it's not the worst place to put this code
@@ -112,23 +239,20 @@ class AnalysisView(SingleObjectMixin, FormView):
         return super(AnalysisView, self).form_valid(form)
 
 
-class UserProfileView(SingleObjectMixin, TemplateView):
+class UserProfileView(UserLookupMixin, SingleObjectMixin, TemplateView):
     model = User
     template_name = "astormain/profile.html"
 
     def get_object(self):
-        try:
-            user = User.objects.filter(slug=self.kwargs["slug"]).first()
-        except User.DoesNotExist:
-            raise Http404("User does not exist.")
-        return user
+        return self.get_user()
 
     def get_context_data(self, **kwargs):
         self.object = self.get_object()
         context = super(UserProfileView, self).get_context_data(**kwargs)
-        analyses = [page.specific for page in self.object.pages.all() 
-                                  if page.specific.live ]
-        analyses = sorted(analyses, key=lambda item: item.first_published_date, 
-                          reverse=True)
+        analyses = list(
+            self.object.pages.filter(live=True).order_by(
+                "-first_published_date"
+            ).specific()
+        )
         context["analyses"] = analyses
         return context
\ No newline at end of file